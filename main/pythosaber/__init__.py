@@ -0,0 +1,4 @@
+'''
+Pythosaber - an RP2040-based lightsaber soundboard written in CircuitPython.
+'''
+__version__ = "1.0.0"
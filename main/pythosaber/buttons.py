@@ -0,0 +1,180 @@
+'''
+Button gestures.
+
+The buttons are scanned and debounced in the background by the keypad
+module, which queues an event with a timestamp whenever a button goes down
+or up. Nothing waits for a button: each tick the queue is drained into one
+preallocated event, and the presses and releases are turned into gestures:
+
+    PRESS         the button went down
+    RELEASE       the button went up
+    CLICK         a short press with no second one following it,
+                  reported once the double click window has passed
+    DOUBLE_CLICK  a second short press within the double click window
+    LONG_PRESS    the button has been held down for the long press time,
+                  and again every long press time while it's held
+
+A press of one button while another is held down can be taken as a
+combination with consume(): the held button then gives no click and no more
+long presses for that press.
+
+Gestures are queued in preallocated arrays and read one at a time with get(),
+which leaves the button and gesture in attributes instead of returning a tuple.
+With no button down and no click pending, update() only checks the empty queue.
+'''
+from pythosaber.hal import ticks_add, ticks_diff
+
+# Key numbers of the buttons in device.keys
+KEY_MAIN = 0
+KEY_AUX = 1
+KEY_BOARD = 2
+KEY_COUNT = 3
+
+PRESS = 1
+RELEASE = 2
+CLICK = 3
+DOUBLE_CLICK = 4
+LONG_PRESS = 5
+
+GESTURE_NAMES = ("", "press", "release", "click", "double click", "long press")
+
+LONG_PRESS_MS = 600
+DOUBLE_CLICK_MS = 300
+
+QUEUE_LENGTH = 16
+
+
+class ButtonGestures:
+    def __init__(self, device, long_press_ms=LONG_PRESS_MS, double_click_ms=DOUBLE_CLICK_MS,
+                 queue_length=QUEUE_LENGTH):
+        self.device = device
+        self.keys = device.keys
+        self.event = device.new_key_event()
+        self.long_press_ms = long_press_ms
+        self.double_click_ms = double_click_ms
+
+        # Per button: down, when the next long press is due, whether this press was long,
+        # clicks so far and when the pending click is reported
+        self.down = bytearray(KEY_COUNT)
+        self.long_due = [0] * KEY_COUNT
+        self.long = bytearray(KEY_COUNT)
+        self.clicks = bytearray(KEY_COUNT)
+        self.click_due = [0] * KEY_COUNT
+        self.waiting = 0
+        # Per button: whether this press was consumed by a combination
+        self.consumed = bytearray(KEY_COUNT)
+
+        # Queue of gestures
+        self.queue_keys = bytearray(queue_length)
+        self.queue_gestures = bytearray(queue_length)
+        self.queue_start = 0
+        self.queue_count = 0
+        self.dropped = 0
+
+        # The gesture read by get()
+        self.key = 0
+        self.gesture = 0
+
+    def put(self, key, gesture):
+        length = len(self.queue_keys)
+        if self.queue_count == length:
+            self.dropped += 1
+            return
+        i = (self.queue_start + self.queue_count) % length
+        self.queue_keys[i] = key
+        self.queue_gestures[i] = gesture
+        self.queue_count += 1
+
+    def get(self):
+        '''
+        Reads the next gesture into key and gesture. Returns False if there's none.
+        '''
+        if not self.queue_count:
+            return False
+        i = self.queue_start
+        self.key = self.queue_keys[i]
+        self.gesture = self.queue_gestures[i]
+        self.queue_start = (i + 1) % len(self.queue_keys)
+        self.queue_count -= 1
+        return True
+
+    def clear(self):
+        '''
+        Drops the queued gestures and pending clicks, e.g. those from before a state change.
+        '''
+        self.queue_count = 0
+        waiting = 0
+        for key in range(KEY_COUNT):
+            self.clicks[key] = 0
+            waiting += self.down[key]
+        self.waiting = waiting
+
+    def consume(self, key):
+        '''
+        Takes the current press of a held button as part of a combination,
+        so it's neither a click nor a long press from now on.
+        '''
+        if self.down[key]:
+            self.long[key] = 1
+            self.consumed[key] = 1
+
+    def update(self):
+        '''
+        Turns the key events since the last update into gestures,
+        and adds the long presses and clicks that are due.
+        '''
+        event = self.event
+        events = self.keys.events
+        while events.get_into(event):
+            key = event.key_number
+            if key >= KEY_COUNT:
+                continue
+            now = event.timestamp
+            if event.pressed:
+                self.pressed(key, now)
+            else:
+                self.released(key, now)
+
+        # Nothing held down and no click waiting for a second one
+        if not self.waiting:
+            return
+        now = self.device.ticks_ms()
+        for key in range(KEY_COUNT):
+            if self.down[key] and ticks_diff(now, self.long_due[key]) >= 0:
+                self.long[key] = 1
+                self.long_due[key] = ticks_add(self.long_due[key], self.long_press_ms)
+                if not self.consumed[key]:
+                    self.put(key, LONG_PRESS)
+            elif self.clicks[key] and not self.down[key] and ticks_diff(now, self.click_due[key]) >= 0:
+                self.clicks[key] = 0
+                self.waiting -= 1
+                self.put(key, CLICK)
+
+    def pressed(self, key, now):
+        if self.down[key]:
+            return
+        self.down[key] = 1
+        self.long[key] = 0
+        self.consumed[key] = 0
+        self.long_due[key] = ticks_add(now, self.long_press_ms)
+        if not self.clicks[key]:
+            self.waiting += 1
+        self.put(key, PRESS)
+
+    def released(self, key, now):
+        if not self.down[key]:
+            return
+        self.down[key] = 0
+        self.put(key, RELEASE)
+        if self.long[key]:
+            # A long press is no click
+            if self.clicks[key]:
+                self.clicks[key] = 0
+            self.waiting -= 1
+        elif self.clicks[key]:
+            self.clicks[key] = 0
+            self.waiting -= 1
+            self.put(key, DOUBLE_CLICK)
+        else:
+            self.clicks[key] = 1
+            self.click_due[key] = ticks_add(now, self.double_click_ms)
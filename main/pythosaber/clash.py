@@ -0,0 +1,141 @@
+'''
+Clash detection.
+
+A clash is a spike in acceleration a few milliseconds long, too short to
+catch by polling the accelerometer from the main loop. The LSM6DSOX's own
+tap engine watches every accelerometer sample instead: it flags a single tap
+when the change in acceleration between two samples on any axis goes over
+the threshold, and latches it until it's read.
+
+The main loop then only has to read one status register per tick, or
+nothing at all if the sensor's INT1 pin is wired to the board (see
+IMU_INT_PIN in pythosaber.hal), in which case the register is only read
+once the pin goes high.
+
+The threshold is the profile's clash_threshold, in m/s^2 of change
+between two accelerometer samples. The tap engine takes it in steps of a
+32nd of the accelerometer's full scale, so it's rounded to a step.
+
+The tap engine runs at the accelerometer's output data rate, which is
+imu_active_rate while the blade is on, 208 Hz by default. ST recommends
+at least 416 Hz for tap detection: at 208 Hz the samples are 4.8 ms apart,
+so a short, sharp clash can peak between two of them and is seen with a
+smaller change than it had, or missed. The default is kept at 208 Hz as
+416 Hz doubles the samples the FIFO hands to SmoothSwing every tick; set
+imu_active_rate to 416 for the most sensitive clash detection, or lower
+clash_threshold a step or two at 208 Hz.
+'''
+from pythosaber.hal import ticks_diff
+from pythosaber.motion import ACCEL_FULL_SCALE
+
+# LSM6DSOX registers
+ALL_INT_SRC = 0x1A
+TAP_SRC = 0x1C
+TAP_CFG0 = 0x56
+TAP_CFG1 = 0x57
+TAP_CFG2 = 0x58
+TAP_THS_6D = 0x59
+INT_DUR2 = 0x5A
+WAKE_UP_THS = 0x5B
+MD1_CFG = 0x5E
+
+# TAP_CFG0: clear the latch when TAP_SRC is read, tap on all axes, latch the interrupt
+INT_CLR_ON_READ = 0x40
+TAP_X_EN = 0x08
+TAP_Y_EN = 0x04
+TAP_Z_EN = 0x02
+LIR = 0x01
+
+# TAP_CFG2
+INTERRUPTS_ENABLE = 0x80
+
+# MD1_CFG
+INT1_SINGLE_TAP = 0x40
+
+# TAP_SRC
+TAP_IA = 0x40
+SINGLE_TAP = 0x20
+
+# Threshold steps of TAP_THS_X/Y/Z
+TAP_THRESHOLD_MAX = 0x1F
+TAP_THRESHOLD_STEP = ACCEL_FULL_SCALE / 32
+
+# Shock window 4 samples, quiet window 2 samples
+TAP_DURATION = 0x00
+
+# A second clash within this time is the same one bouncing
+CLASH_LOCKOUT_MS = 200
+
+
+def threshold_code(threshold):
+    '''
+    The tap threshold register value closest to a threshold in m/s^2, from 1 to 31.
+    '''
+    code = int(threshold / TAP_THRESHOLD_STEP + 0.5)
+    if code < 1:
+        return 1
+    if code > TAP_THRESHOLD_MAX:
+        return TAP_THRESHOLD_MAX
+    return code
+
+
+class ClashDetector:
+    def __init__(self, device, sampler, lockout_ms=CLASH_LOCKOUT_MS):
+        self.device = device
+        self.sampler = sampler
+        self.pin = device.imu_int
+        self.lockout_ms = lockout_ms
+        self.threshold = 0.0
+        self.status = bytearray(1)
+        self.last_clash = device.ticks_ms()
+
+        self.reads = 0
+        self.clashes = 0
+        self.bounces = 0
+
+    def configure(self, threshold):
+        '''
+        Sets up the tap engine for clashes over threshold m/s^2.
+        It runs at the accelerometer's output data rate, and stops while it's powered down.
+        '''
+        code = threshold_code(threshold)
+        if abs(code * TAP_THRESHOLD_STEP - threshold) > TAP_THRESHOLD_STEP:
+            print(f'Clash threshold {threshold} is out of range, using {code * TAP_THRESHOLD_STEP:.1f}')
+        self.threshold = code * TAP_THRESHOLD_STEP
+        write_register = self.sampler.write_register
+        write_register(TAP_CFG0, INT_CLR_ON_READ | TAP_X_EN | TAP_Y_EN | TAP_Z_EN | LIR)
+        write_register(TAP_CFG1, code)
+        write_register(TAP_CFG2, INTERRUPTS_ENABLE | code)
+        write_register(TAP_THS_6D, code)
+        write_register(INT_DUR2, TAP_DURATION)
+        # Single taps only
+        write_register(WAKE_UP_THS, 0x00)
+        write_register(MD1_CFG, INT1_SINGLE_TAP)
+        self.clear()
+
+    def clear(self):
+        '''
+        Drops a clash latched before now, e.g. from the button press that ignites the blade.
+        '''
+        self.sampler.read_register(TAP_SRC, self.status)
+        self.last_clash = self.device.ticks_ms()
+
+    def poll(self):
+        '''
+        Returns True if there was a clash since the last poll.
+        '''
+        pin = self.pin
+        if pin is not None and not pin.value:
+            return False
+        status = self.status
+        self.sampler.read_register(TAP_SRC, status)
+        self.reads += 1
+        if not status[0] & SINGLE_TAP:
+            return False
+        now = self.device.ticks_ms()
+        if ticks_diff(now, self.last_clash) < self.lockout_ms:
+            self.bounces += 1
+            return False
+        self.last_clash = now
+        self.clashes += 1
+        return True
@@ -0,0 +1,255 @@
+'''
+Soundfont index.
+
+Proffie fonts can have dozens of variants of a sound: clsh1.wav to clsh16.wav
+in the font folder, or any .wav files in a clsh folder. The index lists the
+variants of every sound with their size and WAV format, so picking a variant
+at ignition or clash time doesn't have to list folders on the SD card,
+which is slow over SPI.
+
+A font is scanned once and its index is saved under sd_root/.fontindex.
+The saved index is used for as long as the modification times of the font folder
+and its sound folders stay the same. FAT doesn't always update a folder's
+time when the files in it change, so deleting the index file forces a rescan.
+An index written by tools/fontpack.py has no signature yet: it's taken as it
+is the first time and saved again with the folder times on the card.
+'''
+import json
+import os
+import random
+
+from pythosaber.hal import SAMPLE_RATE, CHANNEL_COUNT, BITS_PER_SAMPLE
+
+INDEX_VERSION = 1
+INDEX_FOLDER = "/.fontindex"
+
+# Fields of a variant in the index
+VARIANT_FILE = 0
+VARIANT_SIZE = 1
+VARIANT_SAMPLE_RATE = 2
+VARIANT_CHANNELS = 3
+VARIANT_BITS = 4
+VARIANT_DATA_SIZE = 5
+
+# os.stat() fields
+STAT_MODE = 0
+STAT_SIZE = 6
+STAT_MTIME = 8
+MODE_DIR = 0x4000
+
+WAVE_FORMAT_PCM = 1
+
+
+def split_name(file):
+    '''
+    Splits a Proffie sound file name like clsh05.wav into its sound and variant number,
+    ("clsh", 5). Returns None for files that aren't .wav files.
+    '''
+    if not file.lower().endswith(".wav") or file.startswith("."):
+        return None
+    stem = file[:-4].lower()
+    end = len(stem)
+    while end and stem[end - 1].isdigit():
+        end -= 1
+    number = int(stem[end:]) if end < len(stem) else 0
+    return stem[:end], number
+
+def read_wav_header(path):
+    '''
+    Reads the format of a .wav file.
+    Returns (sample rate, channels, bits per sample, data size in bytes),
+    or None if the file isn't a PCM .wav file.
+    '''
+    with open(path, "rb") as f:
+        return read_wav_format(f)
+
+def read_wav_format(f):
+    '''
+    read_wav_header() of an open file, which is left at the start of the samples.
+    '''
+    header = bytearray(8)
+    f.readinto(header)
+    if header[0:4] != b"RIFF":
+        return None
+    f.readinto(memoryview(header)[0:4])
+    if header[0:4] != b"WAVE":
+        return None
+    fmt = None
+
+    # Walk the chunks until the data chunk
+    while f.readinto(header) == 8:
+        chunk_size = header[4] | (header[5] << 8) | (header[6] << 16) | (header[7] << 24)
+        if header[0:4] == b"fmt ":
+            fmt = bytearray(16)
+            f.readinto(fmt)
+            f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+        elif header[0:4] == b"data":
+            if fmt is None or (fmt[0] | (fmt[1] << 8)) != WAVE_FORMAT_PCM:
+                return None
+            channels = fmt[2] | (fmt[3] << 8)
+            sample_rate = fmt[4] | (fmt[5] << 8) | (fmt[6] << 16) | (fmt[7] << 24)
+            bits = fmt[14] | (fmt[15] << 8)
+            return sample_rate, channels, bits, chunk_size
+        else:
+            f.seek(chunk_size + (chunk_size & 1), 1)
+    return None
+
+def is_dir(path):
+    try:
+        return os.stat(path)[STAT_MODE] & MODE_DIR != 0
+    except OSError:
+        return False
+
+def mtime(path):
+    try:
+        return os.stat(path)[STAT_MTIME]
+    except OSError:
+        return -1
+
+
+class FontIndex:
+    '''
+    The variants of each sound of one font, as lists of
+    [file relative to the font folder, size, sample rate, channels, bits, data size].
+    '''
+    def __init__(self, path, sounds=None, folders=(), signature=None):
+        self.path = path
+        self.sounds = sounds or {}
+        self.folders = list(folders)
+        self.signature = signature
+
+    def variants(self, sound):
+        return self.sounds.get(sound, ())
+
+    def count(self, sound):
+        return len(self.sounds.get(sound, ()))
+
+    def pick(self, sound, number=None):
+        '''
+        Path of a variant of the sound, the given one or a random one.
+        Numbers past the last variant wrap around, which keeps paired sounds
+        like swingh and swingl together when they have as many variants.
+        Returns None if the font has no such sound.
+        '''
+        variants = self.sounds.get(sound)
+        if not variants:
+            return None
+        if number is None:
+            number = random.randrange(len(variants))
+        return self.path + "/" + variants[number % len(variants)][VARIANT_FILE]
+
+    def current_signature(self):
+        '''
+        The modification times of the font folder and its sound folders.
+        Only needs os.stat(), not os.listdir().
+        '''
+        signature = [mtime(self.path)]
+        for folder in self.folders:
+            signature.append(mtime(self.path + "/" + folder))
+        return signature
+
+    def scan(self):
+        '''
+        Lists the variants of every sound in the font folder and its sound folders.
+        Files in a folder belong to the sound the folder is named after.
+        Files that aren't 22 kHz 16-bit mono PCM are skipped, the mixers can't play them.
+        '''
+        found = {}
+        self.folders = []
+        try:
+            files = sorted(os.listdir(self.path))
+        except OSError as e:
+            print(f'Scanning soundfont {self.path} failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            files = []
+
+        for file in files:
+            if file.startswith("."):
+                continue
+            path = self.path + "/" + file
+            if is_dir(path):
+                self.folders.append(file)
+                for inner in sorted(os.listdir(path)):
+                    name = split_name(inner)
+                    if name is not None:
+                        self.add(found, file.lower(), name[1], file + "/" + inner)
+            else:
+                name = split_name(file)
+                if name is not None and name[0]:
+                    self.add(found, name[0], name[1], file)
+
+        # Variants in number order
+        for sound, variants in found.items():
+            variants.sort()
+            found[sound] = [variant[1] for variant in variants]
+        self.sounds = found
+        self.signature = self.current_signature()
+
+    def add(self, found, sound, number, file):
+        path = self.path + "/" + file
+        try:
+            header = read_wav_header(path)
+            size = os.stat(path)[STAT_SIZE]
+        except OSError:
+            header = None
+        if header is None:
+            print(f'{file}: Not a PCM .wav file. Skipping.')
+            return
+        sample_rate, channels, bits, data_size = header
+        if sample_rate != SAMPLE_RATE or channels != CHANNEL_COUNT or bits != BITS_PER_SAMPLE:
+            print(f'{file}: {sample_rate} Hz {bits}-bit {channels} channel(s), '
+                  f'needs {SAMPLE_RATE} Hz {BITS_PER_SAMPLE}-bit mono. Skipping.')
+            return
+        variant = [file, size, sample_rate, channels, bits, data_size]
+        found.setdefault(sound, []).append(((number, file), variant))
+
+    def save(self, index_file):
+        data = {
+            "version": INDEX_VERSION,
+            "path": self.path,
+            "signature": self.signature,
+            "folders": self.folders,
+            "sounds": self.sounds,
+            }
+        with open(index_file, "w") as f:
+            json.dump(data, f)
+
+
+def index_file(device, font_path):
+    return device.sd_root + INDEX_FOLDER + "/" + font_path.rstrip("/").split("/")[-1] + ".json"
+
+def save_index(device, index, path):
+    try:
+        if not is_dir(device.sd_root + INDEX_FOLDER):
+            os.mkdir(device.sd_root + INDEX_FOLDER)
+        index.save(path)
+    except OSError as e:
+        print('Saving soundfont index failed')
+        print('Exception {} {}\n'.format(type(e).__name__, e))
+
+def load_index(device, font_path):
+    '''
+    The index of the font at font_path, from the saved index if it's
+    still up to date, otherwise scanned and saved.
+    '''
+    path = index_file(device, font_path)
+    try:
+        with open(path, "r") as f:
+            data = json.loads(f.read())
+        if data["version"] == INDEX_VERSION and data["path"] == font_path:
+            index = FontIndex(font_path, data["sounds"], data["folders"], data["signature"])
+            if index.signature is None:
+                # Packed on a computer, the folder times are the card's from now on
+                index.signature = index.current_signature()
+                save_index(device, index, path)
+                return index
+            if index.current_signature() == index.signature:
+                return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print(f'Indexing soundfont {font_path}...')
+    index = FontIndex(font_path)
+    index.scan()
+    save_index(device, index, path)
+    return index
@@ -0,0 +1,468 @@
+'''
+Device layer.
+
+Everything the saber talks to in the outside world (LEDs, buttons,
+SD card, audio, motion sensor and the clock) is collected into one Device object.
+The rest of the program only ever talks to the Device, so the same state machine
+runs on the RP2040 with the real CircuitPython drivers, or on a computer
+with the stand-ins from pythosaber.host.
+'''
+import gc
+import time
+
+BACKEND_CIRCUITPYTHON = "circuitpython"
+BACKEND_HOST = "host"
+
+# Audio format of every soundfont file and mixer
+SAMPLE_RATE = 22050
+CHANNEL_COUNT = 1
+BITS_PER_SAMPLE = 16
+SAMPLES_SIGNED = True
+MIXER_BUFFER_SIZE = 2048
+
+# Voices of the main mixer for one-shot effects, after the hum and the swing mixer
+EFFECT_VOICE_COUNT = 3
+
+BLADE_PIXELS = 54
+
+# SPI clock of the SD card, the sdcardio default. Cards take up to 25 MHz in SPI mode
+SD_BAUDRATE = 8000000
+
+# Buttons are scanned in the background every this many seconds, and debounced over a scan
+KEY_SCAN_INTERVAL = 0.02
+
+# Board pin wired to INT1 of the motion sensor, e.g. "A1", or None if it isn't wired
+IMU_INT_PIN = None
+
+# Millisecond ticks wrap around like supervisor.ticks_ms()
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+
+def ticks_add(ticks, delta):
+    '''
+    Adds a number of milliseconds to a ticks value, wrapping around.
+    '''
+    return (ticks + delta) % TICKS_PERIOD
+
+def ticks_diff(ticks1, ticks2):
+    '''
+    Returns the signed number of milliseconds from ticks2 to ticks1,
+    correct across the wrap around as long as they are less than ~3 days apart.
+    '''
+    diff = (ticks1 - ticks2) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+class Device:
+    '''
+    Base class for the hardware backends.
+    A backend fills in the hardware handles and implements the factories below.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+        self.sd_root = "/sd"
+
+        self.board_led = None
+        self.blade_led = None
+        self.blade_pixels = BLADE_PIXELS
+        self.blade_order = "GRB"
+
+        self.i2s = None
+        self.main_mixer = None
+        self.swing_mixer = None
+        self.effect_voices = 0
+        self.mixer_buffer_size = 0
+        self.sd_baudrate = SD_BAUDRATE
+
+        self.motion = None
+        # Goes high when the motion sensor flags a clash, None if not wired
+        self.imu_int = None
+
+        # Background scanned buttons, the main, aux and board buttons in that order, like keypad.Keys
+        self.keys = None
+
+        # Non-volatile memory for state that survives a reset, like microcontroller.nvm
+        self.nvm = None
+
+        # (name, ms) per step of bringing the hardware up, see pythosaber.startup
+        self.boot_steps = []
+
+    def new_mixer(self, voice_count, buffer_size=MIXER_BUFFER_SIZE):
+        '''
+        Creates a mixer in the soundfont audio format.
+        '''
+        raise NotImplementedError
+
+    def init_mixers(self, effect_voices=EFFECT_VOICE_COUNT, buffer_size=MIXER_BUFFER_SIZE):
+        '''
+        Creates the main mixer, with the hum, the swing mixer and effect_voices voices
+        for one-shot effects, and the swing mixer. Replaces the mixers made before,
+        unless they're of the same size already.
+        '''
+        if self.main_mixer is not None:
+            if effect_voices == self.effect_voices and buffer_size == self.mixer_buffer_size:
+                return
+            self.i2s.stop()
+            self.main_mixer.deinit()
+            self.swing_mixer.deinit()
+        self.main_mixer = self.new_mixer(2 + effect_voices, buffer_size)
+        self.swing_mixer = self.new_mixer(2, buffer_size)
+        self.effect_voices = effect_voices
+        self.mixer_buffer_size = buffer_size
+
+    def open_wave(self, path, buffer=None):
+        '''
+        Opens a .wav file for streaming playback.
+        buffer is used for reading the file instead of allocating one.
+        '''
+        raise NotImplementedError
+
+    def new_raw_sample(self, samples):
+        '''
+        Makes a sample that plays from RAM, from an array of 16-bit samples
+        in the soundfont audio format, like audiocore.RawSample.
+        '''
+        raise NotImplementedError
+
+    def open_read(self, path):
+        '''
+        Opens a file on the SD card for reading in binary.
+        '''
+        return open(path, "rb")
+
+    def set_sd_baudrate(self, baudrate):
+        '''
+        Changes the SPI clock of the SD card.
+        '''
+        self.sd_baudrate = baudrate
+
+    def new_keys(self):
+        '''
+        Creates the background scanned buttons, like keypad.Keys.
+        '''
+        raise NotImplementedError
+
+    def remake_keys(self):
+        '''
+        Lets go of the keys, which may already have been let go of,
+        and makes them again, e.g. after a light sleep that failed part way.
+        '''
+        if self.keys is not None:
+            self.keys.deinit()
+        self.keys = self.new_keys()
+
+    def new_key_event(self):
+        '''
+        Creates an event to read keys.events into, like keypad.Event.
+        '''
+        raise NotImplementedError
+
+    def show_blade(self, buffer):
+        '''
+        Writes a frame of pixel bytes in blade_order to the blade, 3 bytes per pixel.
+        '''
+        raise NotImplementedError
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def ticks_ms(self):
+        '''
+        Millisecond counter that wraps at TICKS_PERIOD.
+        Unlike monotonic() it doesn't lose precision as the uptime grows.
+        '''
+        return int(self.monotonic() * 1000) & TICKS_MAX
+
+    def ticks_us(self):
+        '''
+        Microsecond counter for timing short things, doesn't wrap.
+        '''
+        return int(self.monotonic() * 1000000)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def light_sleep(self, seconds):
+        '''
+        Sleeps the board in its lowest power state that keeps the RAM, until a
+        button is pressed or the seconds are up, and makes keys again after it.
+        Returns the key number of the button that woke it up, or None.
+        '''
+        raise NotImplementedError
+
+    async def sleep_async(self, seconds):
+        '''
+        Sleeps the calling asyncio task, letting the others run.
+        '''
+        import asyncio
+        await asyncio.sleep(seconds)
+
+    def mem_alloc(self):
+        '''
+        Bytes of heap in use, including garbage that hasn't been collected yet.
+        '''
+        return gc.mem_alloc()
+
+    def mem_free(self):
+        return gc.mem_free()
+
+    def collect(self):
+        gc.collect()
+
+    def deinit(self):
+        pass
+
+
+class CircuitPythonDevice(Device):
+    '''
+    The real thing: QT Py RP2040, Audio BFF, LSM6DSOX and the Neopixel blade.
+    Driver modules are imported here so that importing this module on a computer works.
+    '''
+    def __init__(self, blade_pixels=BLADE_PIXELS):
+        super().__init__(BACKEND_CIRCUITPYTHON)
+        import board
+        import busio, digitalio
+        import sdcardio, storage
+        import audiobusio
+        import neopixel
+        import microcontroller
+        import neopixel_write
+        import supervisor
+        from adafruit_lsm6ds import Rate, AccelRange, GyroRange
+        from adafruit_lsm6ds.lsm6dsox import LSM6DSOX
+
+        self.spi = None
+        self.i2c = None
+        self.sdcard = None
+        self._sd_cs = board.A0
+        self._key_pins = (board.SDA, board.SCL, board.BUTTON)
+        self._ticks_ms = supervisor.ticks_ms
+        self.nvm = microcontroller.nvm
+        self._neopixel_write = neopixel_write.neopixel_write
+        start = self._ticks_ms()
+
+        # Board Interface
+        self.board_led = neopixel.NeoPixel(
+            board.NEOPIXEL,
+            1,
+            pixel_order=neopixel.GRB,
+            auto_write=False
+            )
+
+        # SD Card
+        print('SD Card mounting...')
+        try:
+            self.spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+            self.sdcard = sdcardio.SDCard(self.spi, self._sd_cs, baudrate=SD_BAUDRATE)
+            vfs = storage.VfsFat(self.sdcard)
+            storage.mount(vfs, self.sd_root)
+        except Exception as e:
+            print('SD Card mounting failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+        finally:
+            print('SD Card mounted as: /sd.')
+        start = self.boot_step("sd", start)
+
+        # Sound
+        print('Initalizing Sound...')
+        try:
+            # The mixers are made at boot, sized for the profiles in config.json
+            self.i2s = audiobusio.I2SOut(board.D3, board.D2, board.D1)
+        except Exception as e:
+            print('Sound initialization failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+        finally:
+            print('Sound initalized')
+        start = self.boot_step("sound", start)
+
+        # Motion
+        print('Initializing Motion...')
+        try:
+            self.i2c = busio.I2C(board.SCL1, board.SDA1)
+            self.motion = LSM6DSOX(self.i2c)
+            self.motion.accelerometer_range = AccelRange.RANGE_16G
+            self.motion.accelerometer_data_rate = Rate.RATE_26_HZ
+            self.motion.gyro_range = GyroRange.RANGE_2000_DPS
+            self.motion.gyro_data_rate = Rate.RATE_26_HZ
+            if IMU_INT_PIN is not None:
+                self.imu_int = digitalio.DigitalInOut(getattr(board, IMU_INT_PIN))
+                self.imu_int.switch_to_input()
+        except Exception as e:
+            print('Motion initialization failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+        finally:
+            print('Motion initialized')
+        start = self.boot_step("motion", start)
+
+        # Neopixels
+        print('Initializing Neopixel blade...')
+        try:
+            self.blade_pixels = blade_pixels
+            self.blade_led = neopixel.NeoPixel(
+                board.RX,
+                blade_pixels,
+                pixel_order=neopixel.GRB,
+                auto_write=False
+                )
+        except Exception as e:
+            print('Neopixel blade initialization failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+        finally:
+            print('Neopixel blade initialized')
+        start = self.boot_step("blade", start)
+
+        # Interface
+        print('Initializing Interface...')
+        '''
+        Buttons are connected to GND
+        This means that the digital signal they output
+        when not pressed is 1 and when pressed is 0
+        Not Pressed = True
+        Pressed = False
+        keypad scans them in the background and queues an event for every change
+        '''
+        try:
+            self.keys = self.new_keys()
+        except Exception as e:
+            print('Interface initialization failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+        finally:
+            print('Interface initialized')
+        self.boot_step("interface", start)
+
+    def boot_step(self, name, start):
+        '''
+        Records how long a step of bringing the hardware up took since start.
+        Returns the time it ended, where the next step starts.
+        '''
+        now = self._ticks_ms()
+        self.boot_steps.append((name, ticks_diff(now, start)))
+        return now
+
+    def new_mixer(self, voice_count, buffer_size=MIXER_BUFFER_SIZE):
+        import audiomixer
+        return audiomixer.Mixer(
+            voice_count=voice_count,
+            buffer_size=buffer_size,
+            sample_rate=SAMPLE_RATE,
+            channel_count=CHANNEL_COUNT,
+            bits_per_sample=BITS_PER_SAMPLE,
+            samples_signed=SAMPLES_SIGNED
+            )
+
+    def open_wave(self, path, buffer=None):
+        import audiocore
+        return audiocore.WaveFile(open(path, "rb"), buffer)
+
+    def new_raw_sample(self, samples):
+        import audiocore
+        return audiocore.RawSample(samples, channel_count=CHANNEL_COUNT, sample_rate=SAMPLE_RATE)
+
+    def set_sd_baudrate(self, baudrate):
+        '''
+        Mounts the SD card again at another SPI clock. Nothing may be open on it.
+        '''
+        if baudrate == self.sd_baudrate or self.sdcard is None:
+            return
+        import sdcardio, storage
+        try:
+            storage.umount(self.sd_root)
+            self.sdcard.deinit()
+            self.sdcard = sdcardio.SDCard(self.spi, self._sd_cs, baudrate=baudrate)
+            storage.mount(storage.VfsFat(self.sdcard), self.sd_root)
+            self.sd_baudrate = baudrate
+        except Exception as e:
+            print('SD Card baudrate change failed, mounting at the old baudrate')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            self.remount_sd()
+
+    def remount_sd(self):
+        '''
+        Mounts the SD card again at sd_baudrate after a failed change.
+        Raises if that fails too, the saber can't run without its card.
+        '''
+        import sdcardio, storage
+        try:
+            storage.umount(self.sd_root)
+        except OSError:
+            # Not mounted any more
+            pass
+        try:
+            self.sdcard.deinit()
+        except Exception:
+            # Already let go of before the failed change
+            pass
+        self.sdcard = sdcardio.SDCard(self.spi, self._sd_cs, baudrate=self.sd_baudrate)
+        storage.mount(storage.VfsFat(self.sdcard), self.sd_root)
+
+    def new_keys(self):
+        import keypad
+        return keypad.Keys(
+            self._key_pins,
+            value_when_pressed=False,
+            pull=True,
+            interval=KEY_SCAN_INTERVAL
+            )
+
+    def new_key_event(self):
+        import keypad
+        return keypad.Event()
+
+    def light_sleep(self, seconds):
+        '''
+        Light sleeps on pin alarms for the buttons and a time alarm.
+        The pins can't be alarms while keypad scans them, so the keys are let go
+        of for the sleep and made again after it, which queues a press for a
+        button that's still held at the first scan.
+        '''
+        import alarm
+        self.keys.deinit()
+        try:
+            alarms = [alarm.pin.PinAlarm(pin, value=False, pull=True) for pin in self._key_pins]
+            alarms.append(alarm.time.TimeAlarm(monotonic_time=time.monotonic() + seconds))
+            woke = alarm.light_sleep_until_alarms(*alarms)
+        finally:
+            self.keys = self.new_keys()
+        pin = getattr(woke, "pin", None)
+        for key, key_pin in enumerate(self._key_pins):
+            if pin is key_pin:
+                return key
+        return None
+
+    def show_blade(self, buffer):
+        # Straight to the pin the neopixel object drives, skipping its own buffer
+        self._neopixel_write(self.blade_led.pin, buffer)
+
+    def ticks_ms(self):
+        return self._ticks_ms()
+
+    def ticks_us(self):
+        return time.monotonic_ns() // 1000
+
+    def deinit(self):
+        for bus in (self.i2s, self.i2c, self.spi):
+            if bus is not None:
+                bus.deinit()
+
+
+def create(backend=None, **kwargs):
+    '''
+    Creates the Device for the given backend.
+    Without a backend name the CircuitPython backend is used
+    when the board module is available, otherwise the host backend.
+    '''
+    if backend is None:
+        try:
+            import board
+            backend = BACKEND_CIRCUITPYTHON
+        except ImportError:
+            backend = BACKEND_HOST
+
+    if backend == BACKEND_CIRCUITPYTHON:
+        return CircuitPythonDevice(**kwargs)
+    if backend == BACKEND_HOST:
+        from pythosaber.host import HostDevice
+        return HostDevice(**kwargs)
+    raise ValueError('Unknown backend: {}'.format(backend))
@@ -0,0 +1,762 @@
+'''
+Host backend.
+
+Stand-ins for the CircuitPython hardware so the saber program can run
+under regular Python on a computer. The stand-ins record what the program
+did to them (level writes, shows, reads) instead of making light and sound.
+Motion and buttons are scripted as functions of time.
+'''
+import asyncio
+import os
+import sys
+import time
+import wave
+
+from pythosaber.hal import Device, BACKEND_HOST, BLADE_PIXELS, MIXER_BUFFER_SIZE, \
+    KEY_SCAN_INTERVAL, TICKS_MAX, SD_BAUDRATE, SAMPLE_RATE, CHANNEL_COUNT, BITS_PER_SAMPLE
+from pythosaber import motion as lsm6dsox
+from pythosaber import clash as taps
+from pythosaber.soundfont import SOUNDS
+
+# Heap size of CircuitPython on the RP2040 and the size of a MicroPython heap block
+HEAP_SIZE = 192 * 1024
+HEAP_BLOCK_SIZE = 16
+# Size of microcontroller.nvm on the RP2040, which reads as erased flash until written
+NVM_SIZE = 4096
+# Length of every sound, as the fake wave files have no content
+WAVE_SECONDS = 1.0
+
+# SD card over SPI: the card reads in 512 byte blocks and each read call costs a
+# command and a FAT lookup on top of clocking the block out. The bus can't go
+# faster than the card takes in SPI mode.
+SD_BLOCK_SIZE = 512
+SD_READ_SECONDS = 0.0003
+SD_BLOCK_SECONDS = 0.0001
+SD_MAX_BAUDRATE = 25000000
+
+
+# Lengths in seconds of the sounds of write_font(), the others are FONT_SECONDS long
+FONT_SOUND_SECONDS = {"clash": 0.4, "ignite": 1.0, "extinguish": 0.8}
+FONT_SECONDS = 2.0
+
+
+def write_font(path, seconds=FONT_SECONDS, sound_seconds=FONT_SOUND_SECONDS):
+    '''
+    Writes a soundfont of silent sounds in the soundfont format to path on the computer,
+    with the default file of each sound.
+    '''
+    for name, _, default in SOUNDS:
+        frames = int(SAMPLE_RATE * sound_seconds.get(name, seconds))
+        file = path + default
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with wave.open(file, "wb") as w:
+            w.setnchannels(CHANNEL_COUNT)
+            w.setsampwidth(BITS_PER_SAMPLE // 8)
+            w.setframerate(SAMPLE_RATE)
+            w.writeframes(bytes(frames * CHANNEL_COUNT * BITS_PER_SAMPLE // 8))
+
+def sd_read_seconds(baudrate, blocks):
+    '''
+    How long a read of a number of blocks takes the SD card.
+    '''
+    baudrate = min(baudrate, SD_MAX_BAUDRATE)
+    return SD_READ_SECONDS + blocks * (SD_BLOCK_SECONDS + SD_BLOCK_SIZE * 8 / baudrate)
+
+
+class SimClock:
+    '''
+    Clock for the host backend.
+    With realtime=True the clock follows the real time spent working,
+    but sleeps are skipped and only added to the clock. This keeps
+    benchmarks honest about work while not waiting for the sleeps.
+    With realtime=False only sleeps and advance() move the clock,
+    which makes a run fully repeatable.
+    '''
+    def __init__(self, realtime=True):
+        self.realtime = realtime
+        self.offset = 0.0
+        self.slept = 0.0
+        self._start = time.perf_counter()
+
+    def monotonic(self):
+        if self.realtime:
+            return time.perf_counter() - self._start + self.offset
+        return self.offset
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.offset += seconds
+            self.slept += seconds
+
+    def advance(self, seconds):
+        self.offset += seconds
+
+
+class FakeVoice:
+    '''
+    Mixer voice that counts level writes.
+    level_writes counts every write, level_changes only writes that changed the level.
+    With a clock, a sound played without looping ends after its duration.
+    '''
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.sample = None
+        self.loop = False
+        self.started = 0.0
+        self._playing = False
+        self.level_writes = 0
+        self.level_changes = 0
+        self._level = 1.0
+
+    @property
+    def playing(self):
+        if self._playing and not self.loop and self.clock is not None:
+            duration = getattr(self.sample, "duration", None)
+            if duration is not None and self.clock.monotonic() - self.started >= duration:
+                self._playing = False
+        return self._playing
+
+    @property
+    def level(self):
+        return self._level
+
+    @level.setter
+    def level(self, value):
+        self.level_writes += 1
+        if value != self._level:
+            self.level_changes += 1
+        self._level = value
+
+    def play(self, sample, loop=False):
+        # Rewinding a sample may take time, e.g. a WaveFile reading its file from the start
+        if hasattr(sample, "reset"):
+            sample.reset()
+        self.sample = sample
+        self.loop = loop
+        self._playing = True
+        if self.clock is not None:
+            self.started = self.clock.monotonic()
+
+    def stop(self):
+        self.sample = None
+        self._playing = False
+
+
+class FakeMixer:
+    def __init__(self, voice_count=2, buffer_size=MIXER_BUFFER_SIZE, clock=None):
+        self.voice_count = voice_count
+        self.buffer_size = buffer_size
+        self.voice = [FakeVoice(clock) for _ in range(voice_count)]
+        self.deinited = False
+
+    @property
+    def playing(self):
+        for voice in self.voice:
+            if voice.playing:
+                return True
+        return False
+
+    def deinit(self):
+        self.deinited = True
+
+
+class FakeI2SOut:
+    def __init__(self):
+        self.sample = None
+        self.playing = False
+        self.plays = 0
+
+    def play(self, sample, loop=False):
+        self.sample = sample
+        self.playing = True
+        self.plays += 1
+
+    def stop(self):
+        self.sample = None
+        self.playing = False
+
+    def deinit(self):
+        self.stop()
+
+
+class FakeWaveFile:
+    '''
+    Stands in for audiocore.WaveFile. The file does not need to exist.
+    With a device, starting it takes the time the SD card needs to seek
+    back to the start and fill the first half of the buffer.
+    '''
+    def __init__(self, path, buffer=None, duration=WAVE_SECONDS, device=None):
+        self.path = path
+        self.buffer = buffer
+        self.duration = duration
+        self.device = device
+        self.deinited = False
+
+    def reset(self):
+        device = self.device
+        if device is None:
+            return
+        half = len(self.buffer) // 2 if self.buffer is not None else SD_BLOCK_SIZE
+        blocks = max(1, (half + SD_BLOCK_SIZE - 1) // SD_BLOCK_SIZE)
+        device.clock.advance(SD_READ_SECONDS + sd_read_seconds(device.sd_baudrate, blocks))
+
+    def deinit(self):
+        self.deinited = True
+
+
+class FakeRawSample:
+    '''
+    Stands in for audiocore.RawSample, playing from RAM.
+    '''
+    def __init__(self, samples):
+        self.samples = samples
+        self.duration = len(samples) / CHANNEL_COUNT / SAMPLE_RATE
+        self.deinited = False
+
+    def deinit(self):
+        self.deinited = True
+
+
+class ModelledSDFile:
+    '''
+    A file on the computer read as if it were on the saber's SD card: each read moves
+    the device clock on by the time the card would take, from the SPI clock, the
+    blocks read and a cost per read. The block last read is cached like
+    CircuitPython's FAT driver does, so reads smaller than a block are cheaper.
+    '''
+    def __init__(self, path, device):
+        self.file = open(path, "rb")
+        self.device = device
+        self.cached_block = -1
+        self.reads = 0
+        self.blocks = 0
+
+    def read_seconds(self, start, count):
+        '''
+        How long the card takes to read count bytes from start, and reads the blocks.
+        '''
+        first = start // SD_BLOCK_SIZE
+        last = (start + count - 1) // SD_BLOCK_SIZE
+        if first == self.cached_block:
+            first += 1
+        blocks = max(0, last - first + 1)
+        self.blocks += blocks
+        if count > 0:
+            self.cached_block = last
+        return sd_read_seconds(self.device.sd_baudrate, blocks)
+
+    def readinto(self, buffer):
+        start = self.file.tell()
+        count = self.file.readinto(buffer)
+        self.reads += 1
+        self.device.clock.advance(self.read_seconds(start, count))
+        return count
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakePixels:
+    '''
+    Stands in for neopixel.NeoPixel with auto_write=False.
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.brightness = 1.0
+        self.shows = 0
+        self._pixels = [(0, 0, 0)] * n
+        self.frame = list(self._pixels)
+        self.raw = bytearray(3 * n)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        return self._pixels[index]
+
+    def __setitem__(self, index, color):
+        self._pixels[index] = color
+
+    def fill(self, color):
+        for i in range(self.n):
+            self._pixels[i] = color
+
+    def show(self):
+        self.shows += 1
+        self.frame[:] = self._pixels
+
+    def write(self, buffer):
+        '''
+        A frame of raw pixel bytes, like neopixel_write.
+        '''
+        self.shows += 1
+        self.raw[:] = buffer
+
+    def deinit(self):
+        pass
+
+
+class ScriptedIMU:
+    '''
+    Stands in for the LSM6DSOX driver.
+    gyro and accel are functions of the clock time returning an (x, y, z) tuple
+    in rad/s and m/s^2. Without a script the sensor reads as lying still.
+    Register access through i2c_device is emulated for the registers
+    pythosaber.motion uses, including the FIFO, and single tap detection
+    for pythosaber.clash.
+    '''
+    def __init__(self, clock, gyro=None, accel=None):
+        self.clock = clock
+        self.gyro_script = gyro
+        self.accel_script = accel
+        self.reads = 0
+        self.accelerometer_range = None
+        self.accelerometer_data_rate = None
+        self.gyro_range = None
+        self.gyro_data_rate = None
+        self.registers = bytearray(0x80)
+        self.fifo = []
+        self.fifo_time = 0.0
+        self.tap_time = 0.0
+        self.tap_previous = None
+        self.tap_shock = 0
+        self.i2c_device = FakeI2CDevice(self)
+
+    def read_gyro(self, t):
+        if self.gyro_script is None:
+            return (0.0, 0.0, 0.0)
+        return self.gyro_script(t)
+
+    def read_accel(self, t):
+        if self.accel_script is None:
+            return (0.0, 0.0, 9.80665)
+        return self.accel_script(t)
+
+    @property
+    def gyro(self):
+        self.reads += 1
+        return self.read_gyro(self.clock.monotonic())
+
+    @property
+    def acceleration(self):
+        self.reads += 1
+        return self.read_accel(self.clock.monotonic())
+
+    def fifo_rate(self):
+        code = self.registers[lsm6dsox.FIFO_CTRL3] & 0x0F
+        for odr, odr_code in lsm6dsox.ODR_CODES:
+            if odr_code == code:
+                return odr
+        return 0
+
+    def fill_fifo(self):
+        '''
+        Adds the samples the sensor would have batched since the last call.
+        '''
+        now = self.clock.monotonic()
+        rate = self.fifo_rate()
+        mode = self.registers[lsm6dsox.FIFO_CTRL4] & 0x07
+        if mode != lsm6dsox.FIFO_MODE_CONTINUOUS or not rate:
+            return
+        period = 1 / rate
+        while self.fifo_time + period <= now:
+            self.fifo_time += period
+            self.fifo.append((lsm6dsox.TAG_GYRO, encode(self.read_gyro(self.fifo_time), lsm6dsox.GYRO_SCALE)))
+            self.fifo.append((lsm6dsox.TAG_ACCEL, encode(self.read_accel(self.fifo_time), lsm6dsox.ACCEL_SCALE)))
+        del self.fifo[:-lsm6dsox.FIFO_DIFF_MASK]
+
+    def accel_rate(self):
+        code = self.registers[lsm6dsox.CTRL1_XL] >> 4
+        for odr, odr_code in lsm6dsox.ODR_CODES:
+            if odr_code == code:
+                return odr
+        return 0
+
+    def detect_taps(self):
+        '''
+        Runs the tap engine over the accelerometer samples since the last call:
+        a tap is a change between two samples over the threshold on an enabled axis,
+        after which the shock window of 4 samples is ignored. Taps are latched in TAP_SRC.
+        '''
+        now = self.clock.monotonic()
+        rate = self.accel_rate()
+        registers = self.registers
+        if not rate or not registers[taps.TAP_CFG2] & taps.INTERRUPTS_ENABLE:
+            self.tap_time = now
+            self.tap_previous = None
+            return
+        period = 1 / rate
+        enabled = (registers[taps.TAP_CFG0] & taps.TAP_X_EN,
+                   registers[taps.TAP_CFG0] & taps.TAP_Y_EN,
+                   registers[taps.TAP_CFG0] & taps.TAP_Z_EN)
+        thresholds = (registers[taps.TAP_CFG1] & taps.TAP_THRESHOLD_MAX,
+                      registers[taps.TAP_CFG2] & taps.TAP_THRESHOLD_MAX,
+                      registers[taps.TAP_THS_6D] & taps.TAP_THRESHOLD_MAX)
+        full_scale = lsm6dsox.ACCEL_FULL_SCALE
+        while self.tap_time + period <= now:
+            self.tap_time += period
+            sample = [max(-full_scale, min(full_scale, value)) for value in self.read_accel(self.tap_time)]
+            previous = self.tap_previous
+            self.tap_previous = sample
+            if previous is None:
+                continue
+            if self.tap_shock:
+                self.tap_shock -= 1
+                continue
+            for axis in range(3):
+                if enabled[axis] and abs(sample[axis] - previous[axis]) > thresholds[axis] * taps.TAP_THRESHOLD_STEP:
+                    registers[taps.TAP_SRC] = taps.TAP_IA | taps.SINGLE_TAP | (0x04 >> axis)
+                    self.tap_shock = 4
+                    break
+
+    def read_register(self, register, buffer, end):
+        self.reads += 1
+        now = self.clock.monotonic()
+        if register == lsm6dsox.OUTX_L_G:
+            buffer[0:6] = encode(self.read_gyro(now), lsm6dsox.GYRO_SCALE)
+            buffer[6:12] = encode(self.read_accel(now), lsm6dsox.ACCEL_SCALE)
+        elif register == lsm6dsox.FIFO_STATUS1:
+            self.fill_fifo()
+            words = len(self.fifo)
+            buffer[0] = words & 0xFF
+            buffer[1] = words >> 8
+        elif register == taps.TAP_SRC:
+            self.detect_taps()
+            buffer[0] = self.registers[taps.TAP_SRC]
+            if self.registers[taps.TAP_CFG0] & taps.INT_CLR_ON_READ:
+                self.registers[taps.TAP_SRC] = 0
+        elif register == lsm6dsox.FIFO_DATA_OUT_TAG:
+            for offset in range(0, end, lsm6dsox.FIFO_WORD_SIZE):
+                tag, data = self.fifo.pop(0)
+                buffer[offset] = tag << 3
+                buffer[offset + 1:offset + 7] = data
+        else:
+            buffer[0:end] = self.registers[register:register + end]
+
+    def write_register(self, register, value):
+        self.registers[register] = value
+        if register == lsm6dsox.FIFO_CTRL4:
+            self.fifo.clear()
+        if register in (lsm6dsox.FIFO_CTRL3, lsm6dsox.FIFO_CTRL4):
+            self.fifo_time = self.clock.monotonic()
+        if register in (lsm6dsox.CTRL1_XL, taps.TAP_CFG2):
+            self.tap_time = self.clock.monotonic()
+            self.tap_previous = None
+
+    @property
+    def int1(self):
+        '''
+        Level of the INT1 pin, high while a tap routed to it is latched.
+        '''
+        self.detect_taps()
+        return bool(self.registers[taps.TAP_SRC] & taps.TAP_IA
+                    and self.registers[taps.MD1_CFG] & taps.INT1_SINGLE_TAP)
+
+
+def encode(values, scale):
+    '''
+    Three values as the sensor's little endian 16-bit output registers.
+    '''
+    data = bytearray(6)
+    for axis, value in enumerate(values):
+        raw = max(-0x8000, min(0x7FFF, round(value / scale)))
+        data[axis * 2] = raw & 0xFF
+        data[axis * 2 + 1] = (raw >> 8) & 0xFF
+    return data
+
+
+class FakeI2CDevice:
+    '''
+    Stands in for adafruit_bus_device.I2CDevice in front of the ScriptedIMU.
+    '''
+    def __init__(self, imu):
+        self.imu = imu
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def write(self, buffer, start=0, end=None):
+        buffer = buffer[start:end]
+        for offset in range(1, len(buffer)):
+            self.imu.write_register(buffer[0] + offset - 1, buffer[offset])
+
+    def write_then_readinto(self, out_buffer, in_buffer, *, out_start=0, out_end=None,
+                            in_start=0, in_end=None):
+        if in_end is None:
+            in_end = len(in_buffer)
+        view = memoryview(in_buffer)[in_start:in_end]
+        self.imu.read_register(out_buffer[out_start], view, in_end - in_start)
+
+
+class FileNVM:
+    '''
+    Stands in for microcontroller.nvm, backed by a file so that
+    the contents survive between runs like they survive a reset.
+    Counts the writes, each of which is a flash sector write on the RP2040.
+    '''
+    def __init__(self, path, size=NVM_SIZE):
+        self.path = path
+        self.writes = 0
+        self.data = bytearray(b'\xff' * size)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                contents = f.read(size)
+            self.data[:len(contents)] = contents
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+        self.writes += 1
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+
+class ScriptedButton:
+    '''
+    Stands in for a pulled-up button. presses is a list of (start, end) times
+    during which the button is held down, i.e. reads False.
+    '''
+    def __init__(self, clock, presses=()):
+        self.clock = clock
+        self.presses = list(presses)
+
+    @property
+    def value(self):
+        return self.value_at(self.clock.monotonic())
+
+    def value_at(self, t):
+        for start, end in self.presses:
+            if start <= t < end:
+                return False
+        return True
+
+
+class FakeKeyEvent:
+    '''
+    Stands in for keypad.Event.
+    '''
+    def __init__(self, key_number=0, pressed=True, timestamp=0):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.timestamp = timestamp
+
+    @property
+    def released(self):
+        return not self.pressed
+
+
+class FakeEventQueue:
+    def __init__(self, keys):
+        self.keys = keys
+        self.queue = []
+        self.overflowed = False
+
+    def get_into(self, event):
+        self.keys.scan()
+        if not self.queue:
+            return False
+        key_number, pressed, timestamp = self.queue.pop(0)
+        event.key_number = key_number
+        event.pressed = pressed
+        event.timestamp = timestamp
+        return True
+
+    def clear(self):
+        self.queue.clear()
+
+    def __len__(self):
+        self.keys.scan()
+        return len(self.queue)
+
+
+class FakeKeys:
+    '''
+    Stands in for keypad.Keys in front of ScriptedButtons. The buttons are
+    sampled every interval of clock time, like keypad's background scan,
+    when the events are read. The scan times are counted from the start
+    rather than added up, so the timestamps are whole milliseconds apart.
+    '''
+    def __init__(self, clock, buttons, interval=KEY_SCAN_INTERVAL):
+        self.clock = clock
+        self.buttons = buttons
+        self.interval = interval
+        self.start = clock.monotonic()
+        self.scan_time = self.start
+        self.state = [False] * len(buttons)
+        self.scans = 0
+        self.events = FakeEventQueue(self)
+
+    @property
+    def key_count(self):
+        return len(self.buttons)
+
+    def scan(self):
+        now = self.clock.monotonic()
+        while self.start + (self.scans + 1) * self.interval <= now:
+            self.scans += 1
+            self.scan_time = self.start + self.scans * self.interval
+            for key_number, button in enumerate(self.buttons):
+                pressed = not button.value_at(self.scan_time)
+                if pressed != self.state[key_number]:
+                    self.state[key_number] = pressed
+                    timestamp = round(self.scan_time * 1000) & TICKS_MAX
+                    self.events.queue.append((key_number, pressed, timestamp))
+
+    def deinit(self):
+        pass
+
+
+class IMUIntPin:
+    '''
+    Stands in for a DigitalInOut wired to INT1 of the ScriptedIMU.
+    '''
+    def __init__(self, imu):
+        self.imu = imu
+        self.reads = 0
+
+    @property
+    def value(self):
+        self.reads += 1
+        return self.imu.int1
+
+
+class HostDevice(Device):
+    '''
+    Device made of the stand-ins above.
+    sd_root points at a directory on the computer that holds config.json.
+    The NVM is kept in nvm_path, by default nvm.bin in sd_root.
+    imu_int wires INT1 of the motion sensor to a pin.
+    Files opened with open_read() are read at the speed of an SD card at sd_baudrate.
+    light_sleep() wakes up at the scripted presses and logs each sleep in light_sleeps.
+    '''
+    def __init__(self, sd_root=".", blade_pixels=BLADE_PIXELS, gyro=None, accel=None,
+                 presses_main=(), presses_aux=(), realtime=True, nvm_path=None, imu_int=False,
+                 sd_baudrate=SD_BAUDRATE):
+        super().__init__(BACKEND_HOST)
+        self.sd_root = sd_root
+        self.sd_baudrate = sd_baudrate
+        self.clock = SimClock(realtime)
+        self.wakeups = []
+        # (start, seconds, key that woke it, audio playing, motion sensor rate) per light sleep
+        self.light_sleeps = []
+        self.heap_baseline = sys.getallocatedblocks()
+
+        self.board_led = FakePixels(1)
+        self.board_button = ScriptedButton(self.clock)
+        self.blade_pixels = blade_pixels
+        self.blade_led = FakePixels(blade_pixels)
+
+        self.i2s = FakeI2SOut()
+
+        self.motion = ScriptedIMU(self.clock, gyro, accel)
+        if imu_int:
+            self.imu_int = IMUIntPin(self.motion)
+
+        self.button_main = ScriptedButton(self.clock, presses_main)
+        self.button_aux = ScriptedButton(self.clock, presses_aux)
+        self.keys = self.new_keys()
+
+        self.nvm = FileNVM(nvm_path or os.path.join(sd_root, "nvm.bin"))
+
+    def new_mixer(self, voice_count, buffer_size=MIXER_BUFFER_SIZE):
+        return FakeMixer(voice_count, buffer_size, self.clock)
+
+    def open_wave(self, path, buffer=None):
+        return FakeWaveFile(path, buffer, device=self)
+
+    def new_raw_sample(self, samples):
+        return FakeRawSample(samples)
+
+    def open_read(self, path):
+        return ModelledSDFile(path, self)
+
+    def new_keys(self):
+        return FakeKeys(self.clock, (self.button_main, self.button_aux, self.board_button))
+
+    def new_key_event(self):
+        return FakeKeyEvent()
+
+    def show_blade(self, buffer):
+        self.blade_led.write(buffer)
+
+    def monotonic(self):
+        return self.clock.monotonic()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def light_sleep(self, seconds):
+        '''
+        Simulates the pin and time alarms: moves the clock on to the next scripted
+        press, or a held button's key at once, or by the seconds if no press comes
+        first. The keys are made again, like on the saber.
+        '''
+        clock = self.clock
+        start = clock.monotonic()
+        buttons = self.keys.buttons
+        wake = start + seconds
+        woke = None
+        for key, button in enumerate(buttons):
+            if not button.value_at(start):
+                wake = start
+                woke = key
+                break
+            for press_start, _ in button.presses:
+                if start <= press_start < wake:
+                    wake = press_start
+                    woke = key
+        clock.sleep(wake - start)
+        self.keys = self.new_keys()
+        self.light_sleeps.append((start, wake - start, woke, self.i2s.playing, self.motion.accel_rate()))
+        return woke
+
+    async def sleep_async(self, seconds):
+        '''
+        asyncio.sleep() on the device clock. The sleeping tasks yield to each
+        other until the one that wakes up first moves the clock to its wake-up
+        time, so the task runtime runs in device time like the loop does.
+        '''
+        clock = self.clock
+        wake = clock.monotonic() + seconds
+        self.wakeups.append(wake)
+        try:
+            # Let the tasks that are ready run up to their next sleep first
+            await asyncio.sleep(0)
+            while clock.monotonic() < wake:
+                if wake <= min(self.wakeups):
+                    clock.sleep(wake - clock.monotonic())
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            self.wakeups.remove(wake)
+
+    def mem_alloc(self):
+        '''
+        Estimated from the blocks CPython has allocated since the device was created.
+        CPython frees memory as soon as it's no longer referenced, so unlike on
+        the saber this only grows with memory that is kept, not with garbage.
+        '''
+        return max(0, sys.getallocatedblocks() - self.heap_baseline) * HEAP_BLOCK_SIZE
+
+    def mem_free(self):
+        return max(0, HEAP_SIZE - self.mem_alloc())
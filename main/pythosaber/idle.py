@@ -0,0 +1,172 @@
+'''
+Idle light sleep.
+
+Once the saber has sat in STANDBY with no button touched for the idle
+timeout, the loop stops ticking and the board goes into light sleep until
+a button is pressed, or the wake interval is up. Before it sleeps the
+selection is saved, the motion sensor is powered down and the audio is
+stopped. The crystal keeps the color it was last drawn in.
+
+A timer wake-up runs one tick, for the housekeeping, and the saber goes back
+to sleep. A button wake-up counts as a press: keypad holds the button pins,
+so the device makes its keys again after the sleep (see Device.light_sleep()),
+and the sleep lasts until the new keys have picked up the held button, so
+the first tick acts on the press.
+
+A sleep that fails, e.g. on a board without alarm support, is tried again
+after a back-off that doubles with each failure in a row, from RETRY_MS up
+to RETRY_MS_MAX, rather than given up on or tried every tick.
+
+The wake latency is the time from waking up to the press being acted on.
+It's counted along with the time spent asleep, and printed with the other
+statistics by the board button.
+
+"idle_timeout" in config.json is the timeout in seconds, 0 never sleeps,
+and "idle_wake_interval" the longest sleep in seconds.
+'''
+from pythosaber.hal import KEY_SCAN_INTERVAL, ticks_add, ticks_diff
+
+# Defaults in seconds, overridden by config.json
+IDLE_TIMEOUT = 30
+WAKE_INTERVAL = 60
+
+# How long to wait for the keys to pick up the press after a button wake-up, and how often to look
+WAKE_SCAN_MS = int(3 * KEY_SCAN_INTERVAL * 1000)
+WAKE_POLL_MS = 5
+
+# How long to stay awake after a sleep failed, doubled for each failure in a row
+RETRY_MS = 10000
+RETRY_MS_MAX = 640000
+
+KEY_NAMES = ("main", "aux", "board")
+
+
+class IdleSleep:
+    def __init__(self, device, timeout=IDLE_TIMEOUT, wake_interval=WAKE_INTERVAL):
+        self.device = device
+        self.timeout_ms = 0
+        self.wake_interval = 0
+        self.configure(timeout, wake_interval)
+
+        now = device.ticks_ms()
+        self.last_activity = now
+        self.awake_since = now
+        # When a button woke the saber up, until the press is acted on
+        self.woke_at = None
+        self.sleeping = False
+        # When to try again after a failed sleep, None if the last one didn't fail
+        self.retry_at = None
+        self.retry_ms = RETRY_MS
+
+        self.failures = 0
+
+        self.sleeps = 0
+        self.button_wakes = 0
+        self.asleep_ms = 0
+        self.awake_ms = 0
+        self.latency_ms_last = 0
+        self.latency_ms_max = 0
+        self.latency_ms_total = 0
+        self.latencies = 0
+
+    def configure(self, timeout, wake_interval):
+        '''
+        Sets the idle timeout and the longest sleep in seconds. A timeout of 0 never sleeps.
+        '''
+        self.timeout_ms = int(timeout * 1000)
+        self.wake_interval = max(1, wake_interval)
+
+    def activity(self):
+        '''
+        Restarts the idle timeout, on a button gesture or a state change.
+        The first one after a button wake-up is its press.
+        '''
+        now = self.device.ticks_ms()
+        self.last_activity = now
+        self.sleeping = False
+        if self.woke_at is not None:
+            latency = ticks_diff(now, self.woke_at)
+            self.woke_at = None
+            self.latency_ms_last = latency
+            self.latency_ms_total += latency
+            self.latencies += 1
+            if latency > self.latency_ms_max:
+                self.latency_ms_max = latency
+
+    def due(self):
+        '''
+        Whether the idle timeout has passed.
+        '''
+        if not self.timeout_ms:
+            return False
+        now = self.device.ticks_ms()
+        if self.retry_at is not None and ticks_diff(now, self.retry_at) < 0:
+            return False
+        return ticks_diff(now, self.last_activity) >= self.timeout_ms
+
+    def failed(self):
+        '''
+        Puts the next sleep off after this one failed, for twice as long as after the last failure.
+        '''
+        self.failures += 1
+        self.sleeping = False
+        now = self.device.ticks_ms()
+        self.retry_at = ticks_add(now, self.retry_ms)
+        print(f'Trying to sleep again in {self.retry_ms // 1000} s')
+        self.retry_ms = min(2 * self.retry_ms, RETRY_MS_MAX)
+
+    def sleep(self):
+        '''
+        Light sleeps until a button is pressed or the wake interval is up.
+        Returns the key number of the button that woke the saber up, or None.
+        '''
+        device = self.device
+        if not self.sleeping:
+            print('Idle, sleeping')
+            self.sleeping = True
+        start = device.ticks_ms()
+        self.awake_ms += ticks_diff(start, self.awake_since)
+        # A sleep that fails counts as time awake
+        self.awake_since = start
+        key = device.light_sleep(self.wake_interval)
+        now = device.ticks_ms()
+        self.retry_at = None
+        self.retry_ms = RETRY_MS
+        self.asleep_ms += ticks_diff(now, start)
+        self.sleeps += 1
+
+        if key is not None:
+            self.button_wakes += 1
+            self.woke_at = now
+            # The wake-up is activity, whether or not the keys still see the press
+            self.last_activity = now
+            # The keys are new, give them the time to scan the button that's held
+            events = device.keys.events
+            waited = 0
+            while not len(events) and waited < WAKE_SCAN_MS:
+                device.sleep(WAKE_POLL_MS / 1000)
+                waited += WAKE_POLL_MS
+            print(f'Woken by {KEY_NAMES[key]} after {ticks_diff(now, start) / 1000:.1f} s')
+        self.awake_since = device.ticks_ms()
+        return key
+
+    def asleep_fraction(self):
+        '''
+        Share of the time since boot spent asleep.
+        '''
+        awake = self.awake_ms + ticks_diff(self.device.ticks_ms(), self.awake_since)
+        total = self.asleep_ms + awake
+        return self.asleep_ms / total if total > 0 else 0.0
+
+    def dump(self):
+        '''
+        Prints the idle statistics over serial.
+        '''
+        if not self.timeout_ms:
+            print('Idle sleep: off')
+            return
+        latencies = max(1, self.latencies)
+        print(f'Idle sleep: {self.sleeps} sleeps, {self.button_wakes} button wake-ups, '
+              f'{self.failures} failed, {100 * self.asleep_fraction():.1f}% of the time asleep')
+        print(f'Wake latency: last {self.latency_ms_last} ms, '
+              f'avg {self.latency_ms_total / latencies:.1f} ms, max {self.latency_ms_max} ms')
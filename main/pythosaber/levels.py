@@ -0,0 +1,153 @@
+'''
+Mixer level envelopes.
+
+Every mixer voice's level is owned by an envelope: the program sets
+targets, optionally with a ramp time, and the envelopes write the levels
+once per tick in update(). A level is only written when it moved by more
+than a threshold since the last write, or when it reached its target.
+
+The level is a value times a gain, each ramping on its own: SmoothSwing
+sets the hum and swing values while the ignition and retraction fade the
+gain in and out over their duration, however often the loop runs.
+Ramps are timed with ticks_ms(), so a fade takes as long at 10 ticks per
+second as at 100.
+'''
+from pythosaber.hal import ticks_diff
+
+# Smallest change of a level worth writing, about the step of an 8-bit level
+LEVEL_THRESHOLD = 1 / 256
+
+
+class Ramp:
+    '''
+    A value moving in a straight line to a target over a number of milliseconds.
+    '''
+    def __init__(self, value=0.0):
+        self.value = value
+        self.start_value = value
+        self.target = value
+        self.start = 0
+        self.ms = 0
+
+    def to(self, target, ms, now):
+        '''
+        Heads for target from the current value. A target it's already heading
+        for doesn't restart the ramp.
+        '''
+        if target == self.target and (ms > 0 or self.value == target):
+            return
+        self.at(now)
+        self.start_value = self.value
+        self.target = target
+        self.start = now
+        self.ms = ms
+        if ms <= 0:
+            self.value = target
+
+    def jump(self, value):
+        self.value = value
+        self.start_value = value
+        self.target = value
+        self.ms = 0
+
+    def at(self, now):
+        '''
+        The value at the time now.
+        '''
+        if self.value != self.target:
+            progress = ticks_diff(now, self.start) / self.ms if self.ms > 0 else 1.0
+            if progress >= 1.0:
+                self.value = self.target
+            else:
+                self.value = self.start_value + (self.target - self.start_value) * progress
+        return self.value
+
+
+class LevelEnvelope:
+    '''
+    The level of one mixer voice, and the count of writes made and skipped.
+    '''
+    def __init__(self, voice, threshold=LEVEL_THRESHOLD):
+        self.voice = voice
+        self.threshold = threshold
+        self.value = Ramp(voice.level)
+        self.gain = Ramp(1.0)
+        self.written = voice.level
+        self.writes = 0
+        self.skips = 0
+
+    def update(self, now):
+        '''
+        Writes the level if it changed enough, or reached its final value.
+        Returns True if it was written.
+        '''
+        level = self.value.at(now) * self.gain.at(now)
+        written = self.written
+        if level == written:
+            return False
+        if abs(level - written) < self.threshold and level != self.value.target * self.gain.target:
+            self.skips += 1
+            return False
+        self.voice.level = level
+        self.written = level
+        self.writes += 1
+        return True
+
+
+class MixerLevels:
+    '''
+    The envelopes of the saber's mixer voices: the hum, the swing mixer and
+    the effect voices on the main mixer, swingh and swingl on the swing mixer.
+    '''
+    def __init__(self, device, threshold=LEVEL_THRESHOLD):
+        self.device = device
+        main_mixer = device.main_mixer
+        swing_mixer = device.swing_mixer
+        self.hum = LevelEnvelope(main_mixer.voice[0], threshold)
+        self.swing = LevelEnvelope(main_mixer.voice[1], threshold)
+        self.swingh = LevelEnvelope(swing_mixer.voice[0], threshold)
+        self.swingl = LevelEnvelope(swing_mixer.voice[1], threshold)
+        effects = []
+        for i in range(2, len(main_mixer.voice)):
+            effects.append(LevelEnvelope(main_mixer.voice[i], threshold))
+        self.effects = tuple(effects)
+        self.envelopes = (self.hum, self.swing, self.swingh, self.swingl) + self.effects
+
+    def set(self, envelope, target, ramp_ms=0):
+        '''
+        Moves the value of an envelope to target, over ramp_ms milliseconds.
+        '''
+        envelope.value.to(target, ramp_ms, self.device.ticks_ms())
+
+    def fade_in(self, envelope, ramp_ms):
+        '''
+        Fades the gain of an envelope in from silence.
+        '''
+        envelope.gain.jump(0.0)
+        envelope.gain.to(1.0, ramp_ms, self.device.ticks_ms())
+
+    def fade_out(self, envelope, ramp_ms):
+        '''
+        Fades the gain of an envelope out from where it is.
+        '''
+        envelope.gain.to(0.0, ramp_ms, self.device.ticks_ms())
+
+    def update(self):
+        '''
+        Writes the levels that changed, at most once per voice. Called once per tick.
+        '''
+        now = self.device.ticks_ms()
+        for envelope in self.envelopes:
+            envelope.update(now)
+
+    def writes(self):
+        total = 0
+        for envelope in self.envelopes:
+            total += envelope.writes
+        return total
+
+    def skips(self):
+        total = 0
+        for envelope in self.envelopes:
+            total += envelope.skips
+        return total
@@ -0,0 +1,767 @@
+'''
+The lightsaber state machine.
+
+Holds the active profile, the loaded soundfont and the SmoothSwing state,
+and drives the Device given to it. code.py creates one Lightsaber on the
+saber; the host benchmark creates one on top of the host backend.
+'''
+import json
+
+from pythosaber.animation import BladeAnimator, RETRACTION_MS
+from pythosaber.buttons import ButtonGestures, KEY_MAIN, KEY_AUX, KEY_BOARD, \
+    PRESS, CLICK, DOUBLE_CLICK, LONG_PRESS
+from pythosaber.clash import ClashDetector
+from pythosaber.hal import ticks_add, ticks_diff, SD_BAUDRATE
+from pythosaber.idle import IdleSleep, IDLE_TIMEOUT, WAKE_INTERVAL
+from pythosaber.levels import MixerLevels
+from pythosaber.memory import MemoryManager
+from pythosaber.motion import MotionSampler
+from pythosaber.scheduler import Scheduler
+from pythosaber.profiles import compile_profiles, mixer_size
+from pythosaber.renderer import GAMMA, BRIGHTNESS
+from pythosaber.samplecache import SampleCache, SAMPLE_CACHE_BYTES
+from pythosaber.probe import Probe, STAGE_INPUT, STAGE_POWER, STAGE_IMU, STAGE_DSP, \
+    STAGE_MIXER, STAGE_LED, STAGE_GC, STAGE_SLEEP
+from pythosaber.smoothswing import SmoothSwing
+from pythosaber.soundfont import FontManager, WAVE_BUFFER_SIZE
+from pythosaber.startup import BootTimer
+from pythosaber.state import SavedState
+from pythosaber.voices import VoicePool
+
+MAX_HUM_VOLUME = 0.9
+EXTINGUISH_VOLUME = 0.2
+CLASH_VOLUME = 1.0
+
+# How long the hum and swing take to settle back once a swing ends, in milliseconds
+SWING_RELEASE_MS = 150
+
+# How long the retraction sound plays on after the blade is out, in milliseconds
+RETRACTION_TAIL_MS = 1000
+
+# Default control loop rates in Hz, overridden by config.json
+ACTIVE_RATE = 100
+STANDBY_RATE = 10
+
+# Default motion sensor output data rates in Hz, 0 powers the sensor down
+IMU_ACTIVE_RATE = 208
+IMU_STANDBY_RATE = 0
+
+# Default blade animation rate in Hz with the task runtime, overridden by config.json
+LED_RATE = 60
+
+
+class Lightsaber:
+    def __init__(self, device, probe=None, boot_timer=None):
+        self.device = device
+        self.probe = probe or Probe()
+        self.boot_timer = boot_timer or BootTimer(device.monotonic)
+        self.current_state = "BOOTING"
+
+        self.config_file = device.sd_root + "/config.json"
+        self.sounds_path = device.sd_root + "/sounds/"
+
+        # Profiles compiled from config.json and the selection saved in NVM
+        self.profiles = ()
+        self.saved_state = SavedState(device)
+
+        # Set initial profile variables
+        self.profile = None
+        self.active_profile = "boot"
+        self.current_selection = 0
+        self.color = (0, 0, 0)
+        self.font_path = self.sounds_path
+        self.swing_threshold = 0
+        self.clash_threshold = 0
+        self.lowpass_alpha = 0
+        self.swing_sharpness = 0
+        self.transition_region_1 = 0
+        self.transition_region_2 = 0
+        self.transition_point_1 = 0
+        self.transition_point_2 = 0
+        self.flicker = 0.0
+        self.effect_voices = 0
+
+        # Set initial soundfont variables
+        self.fonts = FontManager(device)
+        self.font_loading = False
+        self.font_pending = False
+        self.defer_font_loads = False
+        self.sample_cache = None
+        self.font = None
+        self.hum = None
+        self.swingh = None
+        self.swingl = None
+        self.clash = None
+        self.ignite = None
+        self.extinguish = None
+
+        # The mixers are made at boot, once the profiles are known
+        self.hum_volume = 0.0
+        self.swing_volume = 0.0
+        self.levels = None
+        self.voices = None
+
+        self.animator = BladeAnimator(device)
+        self.board_color = None
+        self.retract_until = 0
+        self.buttons = ButtonGestures(device)
+
+        self.smoothswing = SmoothSwing(MAX_HUM_VOLUME)
+        self.motion = MotionSampler(device)
+        self.clash_detector = ClashDetector(device, self.motion)
+        self.trace = None
+        # Made when it's first switched on, with the settings from config.json
+        self.telemetry = None
+        self.telemetry_sink = None
+        self.telemetry_frame_ticks = 0
+
+        # Initialize timekeeping
+        self.active_rate = ACTIVE_RATE
+        self.standby_rate = STANDBY_RATE
+        self.scheduler = Scheduler(device, self.standby_rate)
+        self.imu_active_rate = IMU_ACTIVE_RATE
+        self.imu_standby_rate = IMU_STANDBY_RATE
+        self.memory = MemoryManager(device)
+        self.idle = IdleSleep(device)
+
+        # Run as asyncio tasks rather than one loop, and the blade task's rate
+        self.use_tasks = False
+        self.led_rate = LED_RATE
+        self.runtime = None
+
+    # Profile functions
+    def print_profile(self):
+        '''
+        Prints currently active profile.
+        '''
+        color = self.color
+        print(f'''Profile: {self.active_profile}
+          Font Path: {self.font_path}
+          Blade Color: R:{color[0]}, G:{color[1]}, B:{color[2]}
+          Swing Threshold: {self.swing_threshold}
+          Clash Threshold: {self.clash_threshold}
+          Filter Alpha: {self.lowpass_alpha}
+          Swing Sharpness: {self.swing_sharpness}
+          Transition Region 1:{self.transition_region_1} radians
+          Transition Region 2:{self.transition_region_2} radians
+          Transition Point 1:{self.transition_point_1} radians
+          Transition Point 2:{self.transition_point_2} radians
+          Flicker: {self.flicker}
+          Effect Voices: {self.effect_voices}
+          Telemetry: {self.profile.telemetry}
+          ''')
+
+    def list_profiles(self):
+        '''
+        Prints a list of all available profiles in the config.json file.
+        For debugging.
+        '''
+        profile_names = [profile.name for profile in self.profiles]
+        print(f'Available Profiles: {profile_names}')
+
+    def load_config(self):
+        '''
+        Reads config.json and compiles its profiles.
+        Done once at boot, switching profiles doesn't touch the file.
+        '''
+        with open(self.config_file, "r") as f:
+            config = json.loads(f.read())
+        self.profiles = compile_profiles(config, self.sounds_path)
+        print(f'Profiles: {len(self.profiles)}')
+        return config
+
+    def load_profile(self, profile=None):
+        '''
+        Profile loader.
+        Selects specific profile if it's supplied as an argument.
+        Cycles through list of profiles from the config file if specific name is not supplied.
+        Wraps around when list ends.
+        Saves current selection to NVM, so that on board reset, the selection persists.
+        '''
+        # Unload current sound
+        self.device.i2s.stop()
+
+        profiles = self.profiles
+
+        # If specific profile name is given
+        if profile is not None:
+            try:
+                self.current_selection = profile
+                self.profile = profiles[self.current_selection]
+            except IndexError:
+                print('Invalid index. Jumping to top.')
+                self.current_selection = 0
+                self.profile = profiles[self.current_selection]
+
+        # If argument not given - iterate through profiles
+        else:
+            try:
+                self.current_selection += 1
+                self.profile = profiles[self.current_selection]
+            except IndexError:
+                # If end of profile keys, loop back around
+                print('End of profile list. Jumping to top.')
+                self.current_selection = 0  # Reset to first profile
+                self.profile = profiles[self.current_selection]
+
+        # The settings were validated and converted when the profile was compiled
+        settings = self.profile
+        self.active_profile = settings.name
+        self.color = settings.color
+        self.font_path = settings.font_path
+        self.swing_threshold = settings.swing_threshold
+        self.clash_threshold = settings.clash_threshold
+        self.lowpass_alpha = settings.lowpass_alpha
+        self.swing_sharpness = settings.swing_sharpness
+        self.transition_region_1 = settings.transition_region_1
+        self.transition_region_2 = settings.transition_region_2
+        self.transition_point_1 = settings.transition_point_1
+        self.transition_point_2 = settings.transition_point_2
+        self.flicker = settings.flicker
+        self.animator.renderer.set_flicker(self.flicker)
+        self.effect_voices = settings.effect_voices
+        self.voices.set_limit(self.effect_voices)
+        if settings.telemetry:
+            self.start_telemetry()
+        elif self.telemetry is not None:
+            self.telemetry.stop()
+        self.clash_detector.configure(self.clash_threshold)
+        self.smoothswing.configure(
+            self.swing_threshold,
+            self.lowpass_alpha,
+            self.swing_sharpness,
+            self.transition_region_1,
+            self.transition_region_2,
+            self.transition_point_1,
+            self.transition_point_2
+            )
+
+        # Save the new selection, once it has settled
+        self.saved_state.set(self.current_selection)
+
+    # Sound functions
+    def init_audio(self):
+        '''
+        Makes the mixers, with as many effect voices and as large a buffer as
+        the profiles ask for, and the level envelopes and voice pool on them.
+        '''
+        effect_voices, buffer_size = mixer_size(self.profiles)
+        self.device.init_mixers(effect_voices, buffer_size)
+        self.levels = MixerLevels(self.device)
+        self.voices = VoicePool(self.device, self.levels)
+
+    def run_sd_bench(self):
+        '''
+        Measures how well the SD card streams the profile's soundfont, see pythosaber.sdbench.
+        '''
+        from pythosaber.sdbench import SDBenchmark
+        try:
+            bench = SDBenchmark(self.device, self.font_path)
+            bench.run()
+            bench.report()
+        except OSError as e:
+            print('SD benchmark failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+
+    def load_soundfont(self):
+        '''
+        Loads the currently selected profiles' soundfont.
+        The new font is opened next to the current one and swapped in,
+        so the mixers keep running and the current font stays if it fails.
+        '''
+        for _ in self.load_soundfont_steps():
+            pass
+
+    def load_soundfont_steps(self):
+        '''
+        load_soundfont() a sound at a time, yielding in between, for the task runtime.
+        '''
+        fonts = self.fonts
+        self.font_loading = True
+        for _ in fonts.load_steps(self.font_path):
+            yield
+        if not fonts.loaded:
+            self.font_loading = False
+            print('Keeping previous soundfont')
+            return
+        print(f'Soundfont loaded in {fonts.load_ms_last} ms')
+        for _ in self.sample_cache.load_steps(fonts.active):
+            yield
+        self.font_loading = False
+        self.use_font(fonts.active)
+
+        # Play soundfont sound to indicate loading complete
+        self.device.i2s.play(self.font, loop=False)
+
+    def use_font(self, font):
+        '''
+        Plays the sounds of the given font slot from now on,
+        the one-shots from the sample cache where they're cached.
+        '''
+        # Load main sounds
+        cache = self.sample_cache
+        self.font = font.font
+        self.hum = font.hum
+        self.clash = cache.get("clash", font.clash)
+        self.ignite = cache.get("ignite", font.ignite)
+        self.extinguish = cache.get("extinguish", font.extinguish)
+
+        self.swingh = font.swingh
+        self.swingl = font.swingl
+
+    # Interface functions
+    def handle_buttons(self):
+        '''
+        Acts on the button gestures since the last tick:
+            main press            ignites or retracts the blade
+            main press, aux held  switches the telemetry on or off instead
+            aux click             next profile, in STANDBY
+            aux double click      previous profile, in STANDBY
+            aux held down         steps through the profiles, in STANDBY
+            board button press    dumps the loop timing and memory statistics over serial
+        '''
+        buttons = self.buttons
+        buttons.update()
+        while buttons.get():
+            self.idle.activity()
+            key = buttons.key
+            gesture = buttons.gesture
+            if key == KEY_MAIN:
+                if gesture == PRESS and buttons.down[KEY_AUX]:
+                    # Not a profile change when aux comes up again
+                    buttons.consume(KEY_AUX)
+                    if self.telemetry is not None and self.telemetry.running:
+                        self.telemetry.stop()
+                    else:
+                        self.start_telemetry()
+                    continue
+                # The sounds to ignite with are only there once the font is loaded
+                if gesture == PRESS and self.current_state != "RETRACTING" and not self.font_loading:
+                    self.probe.mark(STAGE_INPUT)
+                    self.cycle_power()
+                    self.probe.mark(STAGE_POWER)
+            elif key == KEY_AUX:
+                if self.current_state != "STANDBY":
+                    continue
+                if gesture == CLICK or gesture == LONG_PRESS:
+                    self.select_profile(None)
+                elif gesture == DOUBLE_CLICK:
+                    self.select_profile((self.current_selection - 1) % len(self.profiles))
+            elif key == KEY_BOARD and gesture == PRESS:
+                if self.runtime is not None:
+                    self.runtime.dump()
+                else:
+                    self.scheduler.dump()
+                self.memory.dump()
+                self.voices.dump()
+                self.sample_cache.dump()
+                self.idle.dump()
+                if self.telemetry is not None:
+                    self.telemetry.dump()
+
+    def start_telemetry(self):
+        '''
+        Starts the runtime telemetry, see pythosaber.telemetry.
+        The module is only imported once it's first used.
+        '''
+        if self.telemetry is None:
+            from pythosaber.telemetry import Telemetry
+            self.telemetry = Telemetry(self, self.telemetry_sink, self.telemetry_frame_ticks)
+        self.telemetry.start()
+
+    def select_profile(self, selection):
+        '''
+        Switches to the profile at the index, or the next one if it's None.
+        With defer_font_loads set the soundfont is left for the task runtime to load.
+        '''
+        self.probe.mark(STAGE_INPUT)
+        self.load_profile(selection)
+        if self.defer_font_loads:
+            self.font_pending = True
+        else:
+            self.load_soundfont()
+        self.print_profile()
+        self.probe.mark(STAGE_POWER)
+
+    # Lightsaber functions
+    def print_state(self):
+        print(f"State: {self.current_state}")
+
+    def cycle_power(self):
+        '''
+        Starts the ignition or the retraction. The animation and the sound fades
+        run tick by tick in tick(), so swinging and the button keep working.
+        '''
+        device = self.device
+        main_mixer = device.main_mixer
+        swing_mixer = device.swing_mixer
+
+        # If not ignited then ignite
+        if self.current_state == "STANDBY":
+            # Don't leave a selection unsaved for the time the blade is on
+            self.saved_state.flush()
+
+            # Wake the motion sensor up, it's ready by the time the blade is
+            self.motion.set_rate(self.imu_active_rate)
+            self.clash_detector.clear()
+
+            # Animate the blade in
+            animator = self.animator
+            animator.set_color(self.color)
+            animator.ignite()
+
+            # Set initial levels, the hum and swing fade in with the ignition
+            levels = self.levels
+            self.hum_volume = MAX_HUM_VOLUME
+            self.swing_volume = 0.0
+            levels.set(levels.hum, MAX_HUM_VOLUME)
+            levels.fade_in(levels.hum, animator.extent_ms)
+            levels.set(levels.swing, 0.0)
+            levels.fade_in(levels.swing, animator.extent_ms)
+            levels.set(levels.swingh, 0.0)
+            levels.set(levels.swingl, 0.0)
+
+            # Play ignition sound & mixers
+            main_mixer.voice[0].play(self.hum, loop=True)
+            self.voices.play(self.ignite, 1.0)
+
+            # Start the audio once the levels are set
+            levels.update()
+            device.i2s.play(main_mixer)
+
+            # Play the swing mixer in the background, the ignition is already sounding
+            # if its sounds have to be opened first
+            if self.open_swing():
+                main_mixer.voice[1].play(swing_mixer, loop=True)
+                swing_mixer.voice[0].play(self.swingh, loop=True)
+                swing_mixer.voice[1].play(self.swingl, loop=True)
+            self.smoothswing.reset()
+
+            if self.trace is not None:
+                self.trace.start(self.motion)
+
+            # Set the state
+            self.current_state = "ACTIVE"
+            self.scheduler.set_rate(self.active_rate)
+            self.print_state()
+
+        # If ignited then extinguish
+        elif self.current_state == "ACTIVE":
+            # Stop swing mixer
+            main_mixer.voice[1].stop()
+
+            # Animate the blade out and let the sound play out after it
+            animator = self.animator
+            animator.retract()
+            self.retract_until = ticks_add(device.ticks_ms(), RETRACTION_MS + RETRACTION_TAIL_MS)
+
+            # Play extinguishing sound, it fades in as the hum fades out with the blade
+            levels = self.levels
+            levels.fade_out(levels.hum, animator.extent_ms)
+            voices = self.voices
+            voices.play(self.extinguish, EXTINGUISH_VOLUME)
+            levels.set(voices.envelope, MAX_HUM_VOLUME, animator.extent_ms)
+            levels.update()
+
+            if self.trace is not None:
+                self.trace.stop()
+
+            # Set the state
+            self.current_state = "RETRACTING"
+            self.print_state()
+
+    def open_swing(self):
+        '''
+        Opens the swing sounds of the active font, which are left closed
+        until its first ignition. Returns False if they can't be opened.
+        '''
+        if self.swingh is not None:
+            return True
+        fonts = self.fonts
+        if not fonts.open_deferred():
+            return False
+        self.swingh = fonts.active.swingh
+        self.swingl = fonts.active.swingl
+        return True
+
+    def do_clash(self):
+        '''
+        Plays the clash sound and flashes the blade. Not while the blade is still igniting.
+        '''
+        if self.animator.moving():
+            return
+        self.voices.play(self.clash, CLASH_VOLUME)
+        self.animator.flash()
+
+    def finish_retraction(self):
+        '''
+        Stops the sound once the retraction has played out and enters STANDBY.
+        '''
+        device = self.device
+
+        # Stop the sound
+        device.i2s.stop()
+
+        # Other variants of the ignition, retraction and clash sounds for next time
+        self.fonts.shuffle(("ignite", "extinguish", "clash"))
+        self.sample_cache.load(self.fonts.active)
+        self.use_font(self.fonts.active)
+
+        self.motion.set_rate(self.imu_standby_rate)
+
+        # A click of aux from while the blade was on isn't a profile change
+        self.buttons.clear()
+
+        # Set the state
+        self.current_state = "STANDBY"
+        self.scheduler.set_rate(self.standby_rate)
+        self.idle.activity()
+        self.print_state()
+
+    def idle_due(self):
+        '''
+        Whether the saber has sat in STANDBY for the idle timeout, with no soundfont loading.
+        '''
+        return (self.current_state == "STANDBY" and not self.font_loading
+                and not self.font_pending and self.idle.due())
+
+    def go_idle(self):
+        '''
+        Light sleeps until a button is pressed or the wake interval is up, see pythosaber.idle.
+        Saves the selection, closes the previous soundfont and powers the motion sensor
+        and the audio down first, and back up after it. If the sleep fails the saber
+        stays awake as it was and tries again after a back-off.
+        '''
+        device = self.device
+        self.saved_state.flush()
+        self.fonts.release()
+        if self.telemetry is not None and self.telemetry.running:
+            self.telemetry.flush()
+        motion = self.motion
+        if motion.rate:
+            motion.set_rate(0)
+        # In STANDBY only the soundfont's own sound plays
+        playing = device.i2s.playing
+        device.i2s.stop()
+        try:
+            key = self.idle.sleep()
+        except Exception as e:
+            print('Light sleep failed, staying awake')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            self.idle.failed()
+            key = None
+            # The keys may have been let go of for the sleep and not made again
+            try:
+                device.remake_keys()
+            except Exception as e:
+                print('Making the buttons again failed')
+                print('Exception {} {}\n'.format(type(e).__name__, e))
+            if playing:
+                device.i2s.play(self.font, loop=False)
+        # The device made new keys for the sleep
+        self.buttons.keys = device.keys
+        if self.imu_standby_rate:
+            motion.set_rate(self.imu_standby_rate)
+        self.scheduler.start()
+        return key
+
+    def boot(self):
+        '''
+        Loads the saved profile and its soundfont and enters STANDBY,
+        timing each phase with the boot timer.
+        '''
+        timer = self.boot_timer
+        device = self.device
+        config = self.load_config()
+        device.set_sd_baudrate(config.get("sd_baudrate", SD_BAUDRATE))
+        self.fonts.set_buffer_size(config.get("wave_buffer_size", WAVE_BUFFER_SIZE))
+        # save_state in config.json is the selection until one has been saved to NVM
+        saved_selection = self.saved_state.load()
+        if saved_selection is None:
+            saved_selection = config["save_state"]
+        self.current_selection = saved_selection
+        self.active_rate = config.get("active_rate", ACTIVE_RATE)
+        self.standby_rate = config.get("standby_rate", STANDBY_RATE)
+        self.animator.renderer.set_brightness(
+            config.get("blade_gamma", GAMMA),
+            config.get("blade_brightness", BRIGHTNESS))
+        self.imu_active_rate = config.get("imu_active_rate", IMU_ACTIVE_RATE)
+        self.imu_standby_rate = config.get("imu_standby_rate", IMU_STANDBY_RATE)
+        self.use_tasks = config.get("tasks", False)
+        self.led_rate = config.get("led_rate", LED_RATE)
+        self.telemetry_sink = config.get("telemetry_sink")
+        self.telemetry_frame_ticks = config.get("telemetry_frame_ticks")
+        self.idle.configure(config.get("idle_timeout", IDLE_TIMEOUT),
+                            config.get("idle_wake_interval", WAKE_INTERVAL))
+        if config.get("imu_trace", False):
+            from pythosaber.trace import TraceRecorder
+            self.trace = TraceRecorder(device)
+            if not self.trace.find_next_number():
+                self.trace = None
+        timer.phase("config")
+
+        self.sample_cache = SampleCache(device, config.get("sample_cache_bytes", SAMPLE_CACHE_BYTES))
+        self.init_audio()
+        timer.phase("audio")
+
+        if config.get("imu_fifo", True):
+            self.motion.start_fifo()
+        self.motion.set_rate(self.imu_standby_rate)
+        self.scheduler.set_rate(self.standby_rate)
+        timer.phase("motion")
+
+        self.load_profile(self.current_selection)
+        self.print_profile()
+        timer.phase("profile")
+        if config.get("sd_bench", False):
+            self.run_sd_bench()
+            timer.phase("sd bench")
+        self.load_soundfont()
+        timer.phase("soundfont")
+
+        self.current_state = "STANDBY"
+        self.idle.activity()
+        self.print_state()
+        timer.report()
+
+    def tick(self):
+        '''
+        One pass of the main loop, all the subsystems one after the other.
+        '''
+        probe = self.probe
+        probe.begin()
+
+        self.update_input()
+        probe.mark(STAGE_INPUT)
+        self.update_motion()
+        self.update_blade()
+        probe.mark(STAGE_LED)
+        self.update_levels()
+        self.update_audio()
+        probe.mark(STAGE_POWER)
+
+        # Collect garbage only when enough has piled up, preferably while idle
+        self.memory.collect_if_needed(
+            idle=self.current_state != "ACTIVE",
+            slack_ms=self.scheduler.remaining_ms())
+        probe.mark(STAGE_GC)
+        if self.idle_due():
+            self.go_idle()
+        else:
+            self.scheduler.wait()
+        probe.mark(STAGE_SLEEP)
+        probe.end()
+
+    def update_input(self):
+        '''
+        Acts on the buttons. In every state, so presses don't queue up.
+        '''
+        self.handle_buttons()
+
+    def update_motion(self):
+        '''
+        While the blade is on: reads the motion sensor, checks for a clash
+        and runs SmoothSwing, setting the hum and swing levels to follow it.
+        '''
+        if self.current_state != "ACTIVE":
+            return
+        probe = self.probe
+
+        # Process motion data, gyro and accelerometer in one read
+        motion = self.motion
+        count = motion.read()
+        if self.trace is not None:
+            self.trace.record(motion)
+
+        # The motion sensor latched any clash since the last tick
+        if self.clash_detector.poll():
+            self.do_clash()
+        probe.mark(STAGE_IMU)
+
+        # Every sample over its own time delta
+        if count:
+            swing = self.smoothswing
+            swinging = swing.update_batch(motion.gyro_y, motion.gyro_z, motion.dt, count)
+            probe.mark(STAGE_DSP)
+            levels = self.levels
+            self.hum_volume = swing.hum_volume
+            self.swing_volume = swing.swing_volume
+
+            # If swinging detected, modulate the hum and swing sounds
+            if swinging:
+                if swing.crossfaded:
+                    levels.set(levels.swingh, swing.swingh_volume)
+                    levels.set(levels.swingl, swing.swingl_volume)
+                levels.set(levels.hum, self.hum_volume)
+                levels.set(levels.swing, self.swing_volume)
+
+            # If not swinging, settle back to the plain hum
+            else:
+                levels.set(levels.hum, self.hum_volume, SWING_RELEASE_MS)
+                levels.set(levels.swing, self.swing_volume, SWING_RELEASE_MS)
+            probe.mark(STAGE_MIXER)
+
+    def update_blade(self):
+        '''
+        Draws the blade: the profile color on the board LED and the crystal in STANDBY,
+        the ignition and retraction otherwise.
+        '''
+        device = self.device
+        state = self.current_state
+
+        # Saber is not ignitied
+        if state == "STANDBY":
+            # Show current profiles' color on board and crystal, when it changed
+            color = self.color
+            if color != self.board_color:
+                device.board_led.fill(color)
+                device.board_led.show()
+                self.board_color = color
+            self.animator.renderer.draw(1, color[0], color[1], color[2], flicker=False)
+
+        # Saber is ignitied or retracting
+        elif state == "ACTIVE" or state == "RETRACTING":
+            self.animator.update()
+
+    def update_levels(self):
+        '''
+        Writes the mixer levels that changed since the last tick, once per voice.
+        The fades of the ignition and retraction run on here, timed by the clock.
+        '''
+        self.levels.update()
+        self.probe.mark(STAGE_MIXER)
+
+    def update_audio(self):
+        '''
+        Sound and storage housekeeping: ends the retraction once its sound has
+        played out, and in STANDBY writes the selected profile once it's no longer
+        changing and closes the previous soundfont after a switch.
+        '''
+        state = self.current_state
+        if state == "STANDBY":
+            self.saved_state.poll()
+            self.fonts.release()
+        elif state == "RETRACTING":
+            if not self.animator.moving() and ticks_diff(self.device.ticks_ms(), self.retract_until) >= 0:
+                self.finish_retraction()
+
+    def run(self, until=None):
+        '''
+        The main loop. Runs forever, unless a device time to stop at is given.
+        '''
+        device = self.device
+        self.scheduler.start()
+        while True:
+            self.tick()
+            if until is not None and device.monotonic() >= until:
+                break
+
+    def run_tasks(self, until=None):
+        '''
+        Runs the subsystems as asyncio tasks, each at its own rate, see pythosaber.runtime.
+        Runs forever, unless a device time to stop at is given.
+        '''
+        from pythosaber.runtime import TaskRuntime
+        self.runtime = TaskRuntime(self)
+        self.runtime.run(until)
+        return self.runtime
@@ -0,0 +1,96 @@
+'''
+Garbage collection policy.
+
+A full gc.collect() on the RP2040 takes milliseconds, so instead of collecting
+on every tick the memory manager only collects once enough has been allocated
+since the previous collection, and prefers to do it when there's time to spare:
+in STANDBY, or when the scheduler has enough slack left in the current tick.
+A collection is only forced during swinging when the heap is running low.
+'''
+from pythosaber.hal import ticks_diff
+
+# Bytes allocated since the last collection before collecting in an idle window
+IDLE_THRESHOLD = 4 * 1024
+# Bytes allocated since the last collection before collecting no matter what
+THRESHOLD = 32 * 1024
+# Collect immediately when less than this is free
+RESERVE = 16 * 1024
+# Initial guess for how long a collection takes, in milliseconds
+COLLECT_ESTIMATE_MS = 5
+
+
+class MemoryManager:
+    def __init__(self, device, threshold=THRESHOLD, idle_threshold=IDLE_THRESHOLD, reserve=RESERVE):
+        self.device = device
+        self.threshold = threshold
+        self.idle_threshold = idle_threshold
+        self.reserve = reserve
+
+        self.alloc_after_collect = device.mem_alloc()
+
+        self.collections = 0
+        self.forced = 0
+        self.duration_last = COLLECT_ESTIMATE_MS
+        self.duration_max = 0
+        self.duration_total = 0
+        self.alloc_high_water = self.alloc_after_collect
+        self.free_low_water = device.mem_free()
+
+    def allocated(self):
+        '''
+        Bytes allocated since the last collection.
+        '''
+        return self.device.mem_alloc() - self.alloc_after_collect
+
+    def collect(self):
+        '''
+        Collects now and times it.
+        '''
+        device = self.device
+        start = device.ticks_ms()
+        device.collect()
+        duration = ticks_diff(device.ticks_ms(), start)
+
+        self.alloc_after_collect = device.mem_alloc()
+        self.collections += 1
+        self.duration_last = duration
+        self.duration_total += duration
+        if duration > self.duration_max:
+            self.duration_max = duration
+
+    def collect_if_needed(self, idle=False, slack_ms=0):
+        '''
+        Called once per tick after the tick's work.
+        idle tells that nothing time critical is going on,
+        slack_ms is how much of the current tick's budget is left.
+        Returns True if a collection was done.
+        '''
+        device = self.device
+        alloc = device.mem_alloc()
+        free = device.mem_free()
+        if alloc > self.alloc_high_water:
+            self.alloc_high_water = alloc
+        if free < self.free_low_water:
+            self.free_low_water = free
+
+        allocated = alloc - self.alloc_after_collect
+        if free < self.reserve:
+            self.forced += 1
+        elif allocated >= self.threshold:
+            pass
+        elif allocated >= self.idle_threshold and (idle or slack_ms > self.duration_last):
+            pass
+        else:
+            return False
+        self.collect()
+        return True
+
+    def dump(self):
+        '''
+        Prints the collection statistics over serial.
+        '''
+        collections = max(1, self.collections)
+        print(f'GC: {self.collections} collections ({self.forced} forced), '
+              f'avg {self.duration_total / collections:.1f} ms, max {self.duration_max} ms')
+        print(f'Heap: {self.device.mem_free()} bytes free, high water {self.alloc_high_water} bytes allocated, '
+              f'low water {self.free_low_water} bytes free')
@@ -0,0 +1,266 @@
+'''
+Motion sampling.
+
+Reads the LSM6DSOX registers directly instead of going through the driver's
+gyro and acceleration properties. Those read all three axes in a separate
+I2C transaction per property and return a new tuple every time,
+so reading two gyro axes and the accelerometer costs three transactions.
+
+The sampler reads gyro and accelerometer in a single burst per tick,
+or optionally drains the sensor's hardware FIFO, so that every sample
+the sensor produced since the last tick is processed. Samples go into
+preallocated arrays, one per channel, along with a timestamp and the
+time since the previous sample, so reading doesn't allocate on the saber.
+The host benchmark can't check that (see tools/bench.py): the tick counts
+are ints that CPython allocates, and so does the host's stand-in sensor.
+
+The output data rate can be changed on the fly, e.g. a fast rate while
+the blade is on and powered down in STANDBY to save current.
+
+The accelerometer runs at +-16 g, as a clash goes well past 2 g.
+'''
+from array import array
+import math
+
+from pythosaber.hal import ticks_add, ticks_diff
+
+# LSM6DSOX registers
+FIFO_CTRL3 = 0x09
+FIFO_CTRL4 = 0x0A
+CTRL1_XL = 0x10
+CTRL2_G = 0x11
+OUTX_L_G = 0x22
+FIFO_STATUS1 = 0x3A
+FIFO_DATA_OUT_TAG = 0x78
+
+# Full scale bits of CTRL1_XL and CTRL2_G: +-16 g and +-2000 dps
+FS_XL_16G = 0x04
+FS_G_2000DPS = 0x0C
+
+FIFO_MODE_BYPASS = 0x00
+FIFO_MODE_CONTINUOUS = 0x06
+FIFO_DIFF_MASK = 0x03FF
+FIFO_OVERRUN = 0x4000
+
+# FIFO words are a tag byte followed by the three axes
+FIFO_WORD_SIZE = 7
+TAG_GYRO = 0x01
+TAG_ACCEL = 0x02
+
+# Output data rates in Hz and their codes in CTRL1_XL, CTRL2_G and FIFO_CTRL3
+ODR_CODES = ((12.5, 1), (26, 2), (52, 3), (104, 4), (208, 5), (416, 6), (833, 7))
+
+# Sensitivities at +-2000 dps and +-16 g in rad/s and m/s^2 per LSB
+GYRO_SCALE = 0.070 * math.pi / 180
+ACCEL_SCALE = 0.000488 * 9.80665
+ACCEL_FULL_SCALE = 16 * 9.80665
+
+RATE = 26
+SAMPLE_CAPACITY = 32
+
+
+def find_odr(rate):
+    '''
+    The slowest output data rate that is at least the given rate in Hz,
+    as an (odr, code) entry of ODR_CODES. A rate of 0 is power-down.
+    '''
+    if not rate:
+        return (0, 0)
+    for entry in ODR_CODES:
+        if entry[0] >= rate:
+            return entry
+    return ODR_CODES[-1]
+
+def int16(buffer, offset):
+    '''
+    Little endian signed 16-bit value from a buffer, without struct.unpack's tuple.
+    '''
+    value = buffer[offset] | (buffer[offset + 1] << 8)
+    if value & 0x8000:
+        value -= 0x10000
+    return value
+
+
+class MotionSampler:
+    def __init__(self, device, rate=RATE, use_fifo=False, capacity=SAMPLE_CAPACITY):
+        self.device = device
+        self.i2c_device = device.motion.i2c_device
+        self.rate, self.odr_code = find_odr(rate)
+        self.sample_period = 1 / self.rate
+        self.use_fifo = use_fifo
+        self.capacity = capacity
+
+        # Samples of the last read
+        self.count = 0
+        self.elapsed = 0.0
+        self.timestamp = array('l', [0] * capacity)
+        self.dt = array('f', [0.0] * capacity)
+        self.gyro_x = array('f', [0.0] * capacity)
+        self.gyro_y = array('f', [0.0] * capacity)
+        self.gyro_z = array('f', [0.0] * capacity)
+        self.accel_x = array('f', [0.0] * capacity)
+        self.accel_y = array('f', [0.0] * capacity)
+        self.accel_z = array('f', [0.0] * capacity)
+
+        # Latest accelerometer reading, for gyro samples that arrive without one
+        self.last_accel_x = 0.0
+        self.last_accel_y = 0.0
+        self.last_accel_z = 0.0
+
+        # I2C buffers
+        self.register = bytearray(1)
+        self.command = bytearray(2)
+        self.output = bytearray(12)
+        self.status = bytearray(2)
+        self.fifo = bytearray(FIFO_WORD_SIZE * capacity)
+
+        # Counters
+        self.transactions = 0
+        self.samples = 0
+        self.overruns = 0
+
+        self.last_read = device.ticks_ms()
+        if use_fifo:
+            self.start_fifo()
+
+    def read_register(self, register, buffer, end=None):
+        self.register[0] = register
+        with self.i2c_device as i2c:
+            i2c.write_then_readinto(self.register, buffer, in_end=end)
+        self.transactions += 1
+
+    def write_register(self, register, value):
+        self.command[0] = register
+        self.command[1] = value
+        with self.i2c_device as i2c:
+            i2c.write(self.command)
+        self.transactions += 1
+
+    def set_rate(self, rate):
+        '''
+        Sets the output data rate of both sensors in Hz, 0 powers them down.
+        The sensor runs at the slowest rate it supports that is at least the given rate.
+        A running FIFO is restarted at the new rate, which empties it.
+        '''
+        self.rate, self.odr_code = find_odr(rate)
+        self.sample_period = 1 / self.rate if self.rate else 0.0
+        code = self.odr_code << 4
+        self.write_register(CTRL1_XL, code | FS_XL_16G)
+        self.write_register(CTRL2_G, code | FS_G_2000DPS)
+        if self.use_fifo:
+            self.start_fifo()
+        # Don't integrate the time the sensor spent at the old rate
+        self.last_read = self.device.ticks_ms()
+
+    def start_fifo(self):
+        '''
+        Batches gyro and accelerometer samples into the FIFO at the output data rate,
+        overwriting the oldest samples if they're not read in time.
+        '''
+        code = self.odr_code
+        self.write_register(FIFO_CTRL4, FIFO_MODE_BYPASS)
+        self.write_register(FIFO_CTRL3, (code << 4) | code)
+        self.write_register(FIFO_CTRL4, FIFO_MODE_CONTINUOUS)
+        self.use_fifo = True
+
+    def stop_fifo(self):
+        '''
+        Bypass mode, which also empties the FIFO.
+        '''
+        self.write_register(FIFO_CTRL4, FIFO_MODE_BYPASS)
+        self.use_fifo = False
+
+    def read(self):
+        '''
+        Reads the samples that arrived since the last read into the sample arrays.
+        Returns the number of samples, which is also kept in count.
+        elapsed is the time the samples cover, i.e. the sum of their dt.
+        '''
+        now = self.device.ticks_ms()
+        if not self.rate:
+            self.elapsed = 0.0
+            count = 0
+        elif self.use_fifo:
+            count = self.read_fifo(now)
+        else:
+            count = self.read_output(now)
+        self.last_read = now
+        self.count = count
+        self.samples += count
+        return count
+
+    def read_output(self, now):
+        '''
+        Reads the newest gyro and accelerometer sample in one transaction.
+        '''
+        output = self.output
+        self.read_register(OUTX_L_G, output)
+        self.store_gyro(0, output, 0)
+        self.store_accel(0, output, 6)
+        self.timestamp[0] = now
+        elapsed = ticks_diff(now, self.last_read) / 1000
+        self.dt[0] = elapsed
+        self.elapsed = elapsed
+        return 1
+
+    def read_fifo(self, now):
+        '''
+        Drains the FIFO, at most capacity words at a time.
+        The rest stays in the FIFO for the next read.
+        A batch of capacity words never holds more gyro samples than fit, however
+        the FIFO interleaves them with the accelerometer, so every word read is used.
+        With both sensors at the same rate that's about capacity / 2 samples a read.
+        '''
+        status = self.status
+        self.read_register(FIFO_STATUS1, status)
+        status = status[0] | (status[1] << 8)
+        if status & FIFO_OVERRUN:
+            self.overruns += 1
+        words = status & FIFO_DIFF_MASK
+        max_words = len(self.fifo) // FIFO_WORD_SIZE
+        if words > max_words:
+            words = max_words
+        if words == 0:
+            self.elapsed = 0.0
+            return 0
+
+        # The FIFO address rolls back to the tag register after each word,
+        # so the whole batch can be read in one transaction
+        fifo = self.fifo
+        self.read_register(FIFO_DATA_OUT_TAG, fifo, words * FIFO_WORD_SIZE)
+
+        index = -1
+        for word in range(words):
+            offset = word * FIFO_WORD_SIZE
+            tag = fifo[offset] >> 3
+            if tag == TAG_GYRO:
+                index += 1
+                self.store_gyro(index, fifo, offset + 1)
+                self.accel_x[index] = self.last_accel_x
+                self.accel_y[index] = self.last_accel_y
+                self.accel_z[index] = self.last_accel_z
+            elif tag == TAG_ACCEL:
+                self.store_accel(index, fifo, offset + 1)
+        count = index + 1
+
+        # Samples are spaced by the output data rate, the newest one is from now
+        period = self.sample_period
+        for index in range(count):
+            self.timestamp[index] = ticks_add(now, -int((count - 1 - index) * period * 1000))
+            self.dt[index] = period
+        self.elapsed = count * period
+        return count
+
+    def store_gyro(self, index, buffer, offset):
+        self.gyro_x[index] = int16(buffer, offset) * GYRO_SCALE
+        self.gyro_y[index] = int16(buffer, offset + 2) * GYRO_SCALE
+        self.gyro_z[index] = int16(buffer, offset + 4) * GYRO_SCALE
+
+    def store_accel(self, index, buffer, offset):
+        self.last_accel_x = int16(buffer, offset) * ACCEL_SCALE
+        self.last_accel_y = int16(buffer, offset + 2) * ACCEL_SCALE
+        self.last_accel_z = int16(buffer, offset + 4) * ACCEL_SCALE
+        if index >= 0:
+            self.accel_x[index] = self.last_accel_x
+            self.accel_y[index] = self.last_accel_y
+            self.accel_z[index] = self.last_accel_z
@@ -0,0 +1,43 @@
+'''
+Stage markers for the main loop.
+
+The main loop calls probe.mark(stage) after each piece of work,
+so whoever is listening can attribute the time (or memory) spent
+since the previous mark to that stage. The default Probe does nothing,
+which keeps the cost on the saber to a single method call per stage.
+'''
+
+STAGE_INPUT = 0
+STAGE_POWER = 1
+STAGE_IMU = 2
+STAGE_DSP = 3
+STAGE_MIXER = 4
+STAGE_LED = 5
+STAGE_GC = 6
+STAGE_SLEEP = 7
+
+STAGE_NAMES = ("input", "power", "imu", "dsp", "mixer", "led", "gc", "sleep")
+STAGE_COUNT = len(STAGE_NAMES)
+
+
+class Probe:
+    '''
+    No-op probe.
+    '''
+    def begin(self):
+        '''
+        Called at the start of every main loop tick.
+        '''
+        pass
+
+    def mark(self, stage):
+        '''
+        Called when the work of the given stage is done.
+        '''
+        pass
+
+    def end(self):
+        '''
+        Called at the end of every main loop tick.
+        '''
+        pass
@@ -0,0 +1,118 @@
+'''
+Profile registry.
+
+config.json is parsed once at boot and every profile in it is compiled into
+an immutable Profile record, with its settings validated and converted up front.
+Switching profiles is then an index into the tuple of records,
+without reading the SD card or parsing JSON.
+'''
+from collections import namedtuple
+
+from pythosaber.hal import EFFECT_VOICE_COUNT, MIXER_BUFFER_SIZE
+
+Profile = namedtuple("Profile", (
+    "name",
+    "font_path",
+    "color",
+    "swing_threshold",
+    "clash_threshold",
+    "lowpass_alpha",
+    "swing_sharpness",
+    "transition_region_1",
+    "transition_region_2",
+    "transition_point_1",
+    "transition_point_2",
+    "flicker",
+    "effect_voices",
+    "mixer_buffer_size",
+    "telemetry",
+    ))
+
+DEFAULT_COLOR = (255, 255, 255)
+
+# config.json keys of the numeric settings, in the order of the Profile fields
+SETTING_KEYS = (
+    "swing_threshold",
+    "clash_threshold",
+    "filter_alpha",
+    "swing_sharpness",
+    "transition_region_1",
+    "transition_region_2",
+    "transition_point_1",
+    "transition_point_2",
+    )
+
+# Optional settings and their defaults, converted to the type of the default.
+# A switch has to be true or false in the JSON, bool("false") would be True
+OPTIONAL_SETTINGS = (
+    ("flicker", 0.0),
+    ("effect_voices", EFFECT_VOICE_COUNT),
+    ("mixer_buffer_size", MIXER_BUFFER_SIZE),
+    ("telemetry", False),
+    )
+
+
+def compile_profile(name, settings, sounds_path):
+    '''
+    Compiles the settings of one profile from config.json into a Profile.
+    Returns None if a setting is missing or isn't a number.
+    An invalid color or optional setting falls back on its default.
+    '''
+    color = settings.get("color", ())
+    try:
+        if len(color) != 3:
+            raise ValueError(color)
+        color = (int(color[0]), int(color[1]), int(color[2]))
+    except (TypeError, ValueError):
+        print(f'{name}: Invalid RGB values. Using default color.')
+        color = DEFAULT_COLOR
+
+    values = []
+    for key in SETTING_KEYS:
+        try:
+            values.append(float(settings[key]))
+        except KeyError:
+            print(f'{name}: Missing {key}. Skipping profile.')
+            return None
+        except (TypeError, ValueError):
+            print(f'{name}: Invalid {key}: {settings[key]}. Skipping profile.')
+            return None
+    for key, default in OPTIONAL_SETTINGS:
+        value = settings.get(key, default)
+        try:
+            if isinstance(default, bool):
+                if not isinstance(value, bool):
+                    raise ValueError(value)
+                values.append(value)
+            else:
+                values.append(type(default)(value))
+        except (TypeError, ValueError):
+            print(f'{name}: Invalid {key}: {settings[key]}. Using {default}.')
+            values.append(default)
+
+    return Profile(name, sounds_path + name, color, *values)
+
+def compile_profiles(config, sounds_path):
+    '''
+    Compiles all profiles of the parsed config.json into a tuple of Profiles,
+    in the order they're listed in.
+    '''
+    profiles = []
+    for name, settings in config["profiles"].items():
+        profile = compile_profile(name, settings, sounds_path)
+        if profile is not None:
+            profiles.append(profile)
+    if not profiles:
+        print('No valid profiles in config.json.')
+    return tuple(profiles)
+
+def mixer_size(profiles):
+    '''
+    The effect voices and mixer buffer size that fit every profile, the most any of them asks for.
+    '''
+    effect_voices = 1
+    buffer_size = 0
+    for profile in profiles:
+        effect_voices = max(effect_voices, profile.effect_voices)
+        buffer_size = max(buffer_size, profile.mixer_buffer_size)
+    return effect_voices, buffer_size or MIXER_BUFFER_SIZE
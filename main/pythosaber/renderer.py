@@ -0,0 +1,155 @@
+'''
+Blade renderer.
+
+Draws the blade straight into a preallocated buffer of pixel bytes in the
+strip's color order, which is written out with one call, instead of
+assigning a color tuple to every pixel of the neopixel object.
+
+Gamma and brightness are applied with a lookup table computed once,
+and per-pixel flicker comes from a table of brightness factors computed
+when the profile is loaded, with the gamma already applied. A frame with
+flicker is a few vector operations over the whole blade with ulab,
+or NumPy on a computer.
+
+The renderer remembers what it drew last and only writes the strip
+when the frame differs.
+'''
+import random
+
+try:
+    from ulab import numpy as np
+except ImportError:
+    import numpy as np
+
+FLOAT = getattr(np, "float", None) or np.float64
+
+# Defaults for the lookup table, overridden by config.json
+GAMMA = 1.0
+BRIGHTNESS = 1.0
+
+
+def gamma_table(gamma=GAMMA, brightness=BRIGHTNESS):
+    '''
+    Lookup table from a color channel value to the value to send to the strip.
+    '''
+    table = bytearray(256)
+    for i in range(256):
+        table[i] = int(255 * brightness * (i / 255) ** gamma + 0.5)
+    return table
+
+
+class BladeRenderer:
+    def __init__(self, device, gamma=GAMMA, brightness=BRIGHTNESS):
+        self.device = device
+        self.count = device.blade_pixels
+        self.gamma = gamma
+        self.table = gamma_table(gamma, brightness)
+
+        # Pixel bytes in the strip's order, and a view of each color channel of them
+        count = self.count
+        self.buffer = bytearray(3 * count)
+        frame = np.frombuffer(self.buffer, dtype=np.uint8)
+        order = device.blade_order
+        self.red = frame[order.index("R")::3]
+        self.green = frame[order.index("G")::3]
+        self.blue = frame[order.index("B")::3]
+
+        # Per-pixel brightness factors, twice the blade so any window of it fits
+        self.flicker = 0.0
+        self.noise = np.ones(2 * count, dtype=FLOAT)
+        self.work = np.zeros(count, dtype=FLOAT)
+
+        # What's in the buffer
+        self.lit = 0
+        self.r = 0
+        self.g = 0
+        self.b = 0
+        self.dirty = True
+
+        self.frames = 0
+        self.shows = 0
+
+    def set_brightness(self, gamma, brightness):
+        self.gamma = gamma
+        self.table = gamma_table(gamma, brightness)
+        self.set_flicker(self.flicker)
+        self.dirty = True
+
+    def set_flicker(self, flicker):
+        '''
+        Each pixel's brightness varies at random by up to this fraction.
+        The factors are computed here, with gamma applied, rather than every frame.
+        '''
+        self.flicker = flicker
+        gamma = self.gamma
+        noise = self.noise
+        for i in range(len(noise)):
+            noise[i] = (1.0 - flicker * random.random()) ** gamma
+        self.dirty = True
+
+    def draw(self, lit, r, g, b, flicker=True):
+        '''
+        Lights the first lit pixels in the color, given before gamma, and turns the rest off.
+        flicker=False draws them steady even if flicker is set.
+        Writes the strip only if the frame differs from the last one.
+        Returns True if it did.
+        '''
+        table = self.table
+        r = table[r]
+        g = table[g]
+        b = table[b]
+        self.frames += 1
+
+        if flicker and self.flicker and lit:
+            self.draw_flicker(lit, r, g, b)
+            # The lit pixels aren't the solid color, the next solid frame redraws them
+            dirty = True
+        elif self.dirty or lit != self.lit or r != self.r or g != self.g or b != self.b:
+            self.draw_solid(lit, r, g, b)
+            dirty = False
+        else:
+            return False
+
+        self.lit = lit
+        self.r = r
+        self.g = g
+        self.b = b
+        self.dirty = dirty
+        self.device.show_blade(self.buffer)
+        self.shows += 1
+        return True
+
+    def draw_solid(self, lit, r, g, b):
+        first = 0
+        if r == self.r and g == self.g and b == self.b and not self.dirty:
+            first = self.lit
+        if lit > first:
+            self.red[first:lit] = r
+            self.green[first:lit] = g
+            self.blue[first:lit] = b
+        if lit < self.count:
+            self.red[lit:] = 0
+            self.green[lit:] = 0
+            self.blue[lit:] = 0
+
+    def draw_flicker(self, lit, r, g, b):
+        '''
+        Every lit pixel gets its own brightness, from a random window of the noise table.
+        '''
+        count = self.count
+        offset = random.randrange(count)
+        noise = self.noise[offset:offset + count]
+        work = self.work
+        work[:] = noise
+        work *= r
+        self.red[:] = work
+        work[:] = noise
+        work *= g
+        self.green[:] = work
+        work[:] = noise
+        work *= b
+        self.blue[:] = work
+        if lit < count:
+            self.red[lit:] = 0
+            self.green[lit:] = 0
+            self.blue[lit:] = 0
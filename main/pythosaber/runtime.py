@@ -0,0 +1,136 @@
+'''
+Task runtime.
+
+Runs the saber's subsystems as asyncio tasks instead of one after the
+other in a single loop, each at the rate it needs:
+
+    motion  motion sensor, clash, SmoothSwing and the mixer levels, at the
+            loop rate of the state (active_rate while the blade is on,
+            standby_rate otherwise)
+    blade   blade animation, at led_rate
+            while the blade is on and standby_rate otherwise
+    input   buttons, at INPUT_RATE. keypad queues the presses in between,
+            so the rate only bounds how late one is acted on. Once the
+            idle timeout is up in STANDBY, it light sleeps the whole
+            saber, see pythosaber.idle
+    audio   retraction end, saving the selection, soundfont loading and
+            garbage collection, at AUDIO_RATE
+
+Each task keeps its own deadline with a Scheduler, and its statistics.
+The tasks share the Lightsaber object, which holds all of the state, and
+nothing else. Loading a soundfont after a profile switch is left to the
+audio task, which yields after every sound it opens, so the blade and the
+buttons keep going meanwhile.
+
+On the saber this needs the asyncio and adafruit_ticks libraries in /lib.
+Under CPython the host backend sleeps the tasks on its simulated clock.
+'''
+import asyncio
+
+from pythosaber.scheduler import Scheduler
+
+INPUT_RATE = 50
+AUDIO_RATE = 20
+
+
+class TaskRuntime:
+    def __init__(self, saber, input_rate=INPUT_RATE, audio_rate=AUDIO_RATE):
+        self.saber = saber
+        device = saber.device
+        self.device = device
+
+        # The saber switches its own scheduler between the active and standby rates
+        self.motion = saber.scheduler
+        self.motion.name = "Motion task"
+        self.blade = Scheduler(device, saber.standby_rate, name="Blade task")
+        self.input = Scheduler(device, input_rate, name="Input task")
+        self.audio = Scheduler(device, audio_rate, name="Audio task")
+        self.font_loads = 0
+        self.font_steps = 0
+
+    async def every_tick(self, scheduler, step):
+        '''
+        Calls step once per tick of the scheduler, forever.
+        '''
+        device = self.device
+        scheduler.start()
+        while True:
+            step()
+            await device.sleep_async(scheduler.end_tick())
+            scheduler.next_tick()
+
+    def step_motion(self):
+        saber = self.saber
+        saber.update_motion()
+        saber.update_levels()
+
+    def step_blade(self):
+        saber = self.saber
+        rate = saber.standby_rate if saber.current_state == "STANDBY" else saber.led_rate
+        if rate != self.blade.rate:
+            self.blade.set_rate(rate)
+        saber.update_blade()
+
+    def step_input(self):
+        saber = self.saber
+        saber.update_input()
+        if saber.idle_due():
+            saber.go_idle()
+            # Every task starts its ticks over from the wake-up rather than overrunning
+            for scheduler in (self.motion, self.blade, self.input, self.audio):
+                scheduler.start()
+
+    async def audio_task(self):
+        saber = self.saber
+        device = self.device
+        scheduler = self.audio
+        scheduler.start()
+        while True:
+            saber.update_audio()
+
+            # Open the new soundfont a sound at a time, with the other tasks running in between
+            if saber.font_pending:
+                saber.font_pending = False
+                self.font_loads += 1
+                for _ in saber.load_soundfont_steps():
+                    self.font_steps += 1
+                    await asyncio.sleep(0)
+
+            saber.memory.collect_if_needed(
+                idle=saber.current_state != "ACTIVE",
+                slack_ms=scheduler.remaining_ms())
+            await device.sleep_async(scheduler.end_tick())
+            scheduler.next_tick()
+
+    async def main(self, until=None):
+        '''
+        Starts the tasks. Runs forever, unless a device time to stop at is given.
+        '''
+        saber = self.saber
+        saber.defer_font_loads = True
+        tasks = [
+            asyncio.create_task(self.every_tick(self.motion, self.step_motion)),
+            asyncio.create_task(self.every_tick(self.blade, self.step_blade)),
+            asyncio.create_task(self.every_tick(self.input, self.step_input)),
+            asyncio.create_task(self.audio_task()),
+            ]
+        try:
+            if until is None:
+                await asyncio.gather(*tasks)
+            else:
+                await self.device.sleep_async(until - self.device.monotonic())
+        finally:
+            for task in tasks:
+                task.cancel()
+            saber.defer_font_loads = False
+
+    def run(self, until=None):
+        asyncio.run(self.main(until))
+
+    def dump(self):
+        '''
+        Prints the statistics of every task over serial.
+        '''
+        for scheduler in (self.motion, self.blade, self.input, self.audio):
+            scheduler.dump()
+        print(f'Font loads: {self.font_loads} in {self.font_steps} steps')
@@ -0,0 +1,123 @@
+'''
+Sample cache.
+
+A sound streamed from the SD card has to seek back to its start and fill
+its buffer from the card before it plays, in competition with the hum and
+swing streams. A clash wants to be heard the moment it happens, so the
+short one-shot sounds of the active font are kept in RAM instead, and
+played as RawSamples that start at once and don't read the card at all.
+
+The cache is a single buffer of budget bytes, allocated at boot, so loading
+fonts never fragments the heap. When the active font changes or its
+variants are shuffled, the cache is filled again: the sounds of
+CACHE_SOUNDS in order of priority, each if it still fits in what's left
+of the budget. A sound that doesn't fit is skipped for the next, smaller
+ones, and plays streamed from the card as before. A sound in a different
+format than the mixers also streams.
+
+CircuitPython can't hand a voice over from a RawSample to a WaveFile
+half way, so sounds are cached whole or not at all.
+'''
+from pythosaber.fontindex import read_wav_format
+from pythosaber.hal import SAMPLE_RATE, CHANNEL_COUNT, BITS_PER_SAMPLE, ticks_diff
+
+# Default size of the cache in bytes, overridden by "sample_cache_bytes" in config.json
+SAMPLE_CACHE_BYTES = 32768
+
+# Sounds kept in RAM, the most latency critical first
+CACHE_SOUNDS = ("clash", "ignite", "extinguish")
+
+
+class SampleCache:
+    def __init__(self, device, budget=SAMPLE_CACHE_BYTES):
+        self.device = device
+        # 16-bit samples, allocated once as bytes and seen as samples through
+        # a memoryview, which copies nothing
+        self.budget = budget - budget % 2
+        self.arena = memoryview(bytearray(self.budget)).cast('h')
+        self.used = 0
+
+        # The cached sounds of the font, by name, and those that stream
+        self.samples = {}
+        self.streamed = []
+
+        self.loads = 0
+        self.load_ms_last = 0
+
+    def clear(self):
+        '''
+        Drops the cached sounds. None of them may be playing.
+        '''
+        for sample in self.samples.values():
+            sample.deinit()
+        self.samples = {}
+        self.streamed = []
+        self.used = 0
+
+    def get(self, name, streamed):
+        '''
+        The cached sample of the named sound, or the streamed one if it isn't cached.
+        '''
+        return self.samples.get(name, streamed)
+
+    def load(self, font):
+        '''
+        Fills the cache from the sounds of a font slot.
+        '''
+        for _ in self.load_steps(font):
+            pass
+
+    def load_steps(self, font):
+        '''
+        load() a sound at a time, yielding in between, for the task runtime.
+        '''
+        device = self.device
+        start = device.ticks_ms()
+        self.clear()
+        for name in CACHE_SOUNDS:
+            path = font.path_of(name)
+            if path is None:
+                continue
+            try:
+                sample = self.load_sound(path)
+            except OSError as e:
+                print(f'Caching {path} failed')
+                print('Exception {} {}\n'.format(type(e).__name__, e))
+                sample = None
+            if sample is None:
+                self.streamed.append(name)
+            else:
+                self.samples[name] = sample
+            yield
+        self.loads += 1
+        self.load_ms_last = ticks_diff(device.ticks_ms(), start)
+
+    def load_sound(self, path):
+        '''
+        Reads the samples of a .wav file into the rest of the arena.
+        Returns a RawSample of them, or None if it doesn't fit or can't be played from RAM.
+        '''
+        with self.device.open_read(path) as f:
+            wav_format = read_wav_format(f)
+            if wav_format is None:
+                return None
+            sample_rate, channels, bits, size = wav_format
+            if sample_rate != SAMPLE_RATE or channels != CHANNEL_COUNT or bits != BITS_PER_SAMPLE:
+                return None
+            size -= size & 1
+            if not size or self.used + size > self.budget:
+                return None
+            first = self.used // 2
+            samples = self.arena[first:first + size // 2]
+            f.readinto(samples)
+        self.used += size
+        return self.device.new_raw_sample(samples)
+
+    def dump(self):
+        '''
+        Prints what's cached over serial.
+        '''
+        print(f'Sample cache: {self.used} of {self.budget} bytes, '
+              f'cached {", ".join(self.samples) or "nothing"}, '
+              f'streamed {", ".join(self.streamed) or "nothing"}, '
+              f'filled in {self.load_ms_last} ms')
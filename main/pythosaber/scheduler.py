@@ -0,0 +1,143 @@
+'''
+Fixed-rate control loop scheduler.
+
+Instead of sleeping a fixed amount after every tick, the scheduler keeps
+a deadline for the end of each tick and only sleeps for what's left of the budget.
+The tick rate then stays at the target no matter how much work the tick did,
+until the work no longer fits, which is counted as an overrun.
+
+Timing is done in integer milliseconds from device.ticks_ms(),
+and the statistics go into preallocated arrays, so waiting doesn't allocate.
+'''
+from array import array
+
+from pythosaber.hal import ticks_add, ticks_diff
+
+HISTORY_LENGTH = 64
+LOG_MAX = 0xFFFF
+
+
+class Scheduler:
+    def __init__(self, device, rate, history=HISTORY_LENGTH, name="Loop"):
+        self.device = device
+        self.name = name
+        self.rate = rate
+        self.period_ms = 0
+        self.set_rate(rate)
+
+        # Ring buffer of the most recent ticks
+        self.history = history
+        self.work_log = array('H', [0] * history)
+        self.period_log = array('H', [0] * history)
+        self.log_index = 0
+
+        self.tick_start = 0
+        self.deadline = 0
+        self.work = 0
+        self.time_delta = 0.0
+        self.reset_stats()
+
+    def set_rate(self, rate):
+        '''
+        Sets the target tick rate in Hz. Takes effect from the next deadline.
+        '''
+        self.rate = rate
+        self.period_ms = max(1, int(1000 / rate + 0.5))
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.work_min = LOG_MAX
+        self.work_max = 0
+        self.work_total = 0
+        self.jitter_max = 0
+        self.jitter_total = 0
+
+    def start(self):
+        '''
+        Starts the first tick.
+        '''
+        self.tick_start = self.device.ticks_ms()
+        self.deadline = ticks_add(self.tick_start, self.period_ms)
+
+    def remaining_ms(self):
+        '''
+        Milliseconds left in the current tick's budget.
+        '''
+        return ticks_diff(self.deadline, self.device.ticks_ms())
+
+    def wait(self):
+        '''
+        Ends the current tick: sleeps for whatever is left of its budget
+        and starts the next one.
+        Returns the time between the starts of the two ticks in seconds,
+        which is also kept in time_delta.
+        '''
+        seconds = self.end_tick()
+        if seconds:
+            self.device.sleep(seconds)
+        return self.next_tick()
+
+    def end_tick(self):
+        '''
+        Ends the current tick's work and moves the deadline on.
+        Returns how long to sleep for in seconds, 0 after an overrun.
+        wait() is end_tick(), the sleep and next_tick(), split for
+        the task runtime, which sleeps with asyncio instead.
+        '''
+        now = self.device.ticks_ms()
+        self.work = ticks_diff(now, self.tick_start)
+        remaining = ticks_diff(self.deadline, now)
+        if remaining > 0:
+            self.deadline = ticks_add(self.deadline, self.period_ms)
+            return remaining / 1000
+        # Don't try to catch up with a burst of short ticks, start over from now
+        self.overruns += 1
+        self.deadline = ticks_add(now, self.period_ms)
+        return 0
+
+    def next_tick(self):
+        '''
+        Starts the next tick after the sleep.
+        '''
+        now = self.device.ticks_ms()
+        period = ticks_diff(now, self.tick_start)
+        self.tick_start = now
+        self.record(self.work, period)
+        self.time_delta = period / 1000
+        return self.time_delta
+
+    def record(self, work, period):
+        work = min(work, LOG_MAX)
+        period = min(period, LOG_MAX)
+        jitter = abs(period - self.period_ms)
+
+        self.ticks += 1
+        self.work_total += work
+        if work < self.work_min:
+            self.work_min = work
+        if work > self.work_max:
+            self.work_max = work
+        self.jitter_total += jitter
+        if jitter > self.jitter_max:
+            self.jitter_max = jitter
+
+        self.work_log[self.log_index] = work
+        self.period_log[self.log_index] = period
+        self.log_index = (self.log_index + 1) % self.history
+
+    def dump(self):
+        '''
+        Prints the statistics and the recent ticks over serial.
+        '''
+        ticks = max(1, self.ticks)
+        print(f'{self.name}: {self.rate} Hz target ({self.period_ms} ms), {self.ticks} ticks, {self.overruns} overruns')
+        print(f'Tick work: min {min(self.work_min, self.work_max)} ms, '
+              f'avg {self.work_total / ticks:.2f} ms, max {self.work_max} ms')
+        print(f'Jitter: avg {self.jitter_total / ticks:.2f} ms, max {self.jitter_max} ms')
+        recent = []
+        for i in range(min(self.ticks, self.history)):
+            index = (self.log_index - 1 - i) % self.history
+            recent.append(f'{self.work_log[index]}/{self.period_log[index]}')
+        print('Recent ticks, newest first (work ms/period ms):')
+        print(' '.join(recent))
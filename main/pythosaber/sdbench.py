@@ -0,0 +1,178 @@
+'''
+SD card streaming benchmark.
+
+Every voice playing a sound streams it from the SD card: its WaveFile reads
+the next half of its buffer while the mixer plays the other half. With the
+hum, swingh, swingl and the effect voices playing at once, the card has to
+keep up with all of them over SPI, in between the main loop's own work.
+
+The benchmark opens the sounds of a font as that many streams and measures,
+for each WaveFile buffer size:
+
+    throughput  reading the streams in turn as fast as the card goes
+    load        reading them at the pace they play at, the share of
+                the time spent reading
+    underruns   half buffers that weren't read by the time the other
+                half had played out
+
+and recommends the smallest buffer that keeps the load under SD_LOAD_LIMIT
+without underruns, leaving the rest of the time to the main loop. Smaller
+buffers mean more reads, each paying for an SD command, larger ones take
+more RAM: every sound of both soundfont slots has one.
+
+It runs at boot with "sd_bench" in config.json and takes a few seconds,
+the results are printed over serial. tools/sdbench.py runs it on the host
+backend, which models the card's timing.
+'''
+from pythosaber.fontindex import load_index
+from pythosaber.hal import SAMPLE_RATE, CHANNEL_COUNT, BITS_PER_SAMPLE, ticks_diff
+from pythosaber.soundfont import SOUNDS
+
+BYTES_PER_SECOND = SAMPLE_RATE * CHANNEL_COUNT * BITS_PER_SAMPLE // 8
+
+# WaveFile buffer sizes to try, in bytes
+BUFFER_SIZES = (256, 512, 1024, 2048, 4096)
+
+# Most of the time the reads may take
+SD_LOAD_LIMIT = 0.5
+
+# Seconds of device time measured per buffer size
+BENCH_SECONDS = 1.0
+
+# Sounds opened as streams, the looping ones first, repeated for more streams
+STREAM_SOUNDS = ("hum", "swingh", "swingl", "clash", "ignite", "extinguish")
+
+# Where the samples of a plain .wav file start, streams loop back to it at the end
+WAV_DATA_OFFSET = 44
+
+
+def stream_count(device):
+    '''
+    The streams of a blade with every voice busy: hum, swingh, swingl and the effect voices.
+    '''
+    return 3 + device.effect_voices
+
+def stream_paths(device, font_path):
+    '''
+    The files of the font's sounds in STREAM_SOUNDS.
+    '''
+    index = load_index(device, font_path)
+    paths = []
+    for name, sound, default in SOUNDS:
+        if name in STREAM_SOUNDS:
+            path = index.pick(sound, 0)
+            paths.append(path if path is not None else font_path + default)
+    return paths
+
+
+class SDBenchmark:
+    def __init__(self, device, font_path):
+        self.device = device
+        self.paths = stream_paths(device, font_path)
+        self.files = []
+        self.streams = 0
+
+        # Per buffer size: (buffer size, bytes/s, load, underruns)
+        self.results = []
+        self.recommended = 0
+
+    def open(self, streams):
+        self.close()
+        for i in range(streams):
+            f = self.device.open_read(self.paths[i % len(self.paths)])
+            f.seek(WAV_DATA_OFFSET)
+            self.files.append(f)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+    def read_half(self, f, half):
+        '''
+        Reads the next half buffer of a stream, looping at the end of the file.
+        '''
+        count = f.readinto(half)
+        if count < len(half):
+            f.seek(WAV_DATA_OFFSET)
+            f.readinto(memoryview(half)[count:])
+
+    def measure_throughput(self, half, seconds):
+        '''
+        Bytes per second read from the open streams in turn, as fast as they go.
+        '''
+        device = self.device
+        start = device.ticks_ms()
+        total = 0
+        elapsed = 0
+        while elapsed < seconds * 1000:
+            for f in self.files:
+                self.read_half(f, half)
+                total += len(half)
+            elapsed = ticks_diff(device.ticks_ms(), start)
+        return total * 1000 / max(1, elapsed)
+
+    def measure_paced(self, half, seconds):
+        '''
+        Reads the open streams at the rate they play at.
+        Returns the share of the time spent reading and the number of underruns.
+        '''
+        device = self.device
+        period_ms = len(half) * 1000 / BYTES_PER_SECOND
+        periods = max(1, int(seconds * 1000 / period_ms))
+        start = device.ticks_ms()
+        busy = 0
+        underruns = 0
+        for k in range(periods):
+            # The next half of every stream is due when the current one has played
+            due = (k + 1) * period_ms
+            read_start = device.ticks_ms()
+            for f in self.files:
+                self.read_half(f, half)
+                if ticks_diff(device.ticks_ms(), start) > due:
+                    underruns += 1
+            now = device.ticks_ms()
+            busy += ticks_diff(now, read_start)
+            remaining = due - ticks_diff(now, start)
+            if remaining > 0:
+                device.sleep(remaining / 1000)
+        return busy / (periods * period_ms), underruns
+
+    def run(self, streams=None, buffer_sizes=BUFFER_SIZES, seconds=BENCH_SECONDS):
+        '''
+        Measures every buffer size with the given number of streams, by default
+        one per voice, and picks the recommended buffer size, 0 if none keeps up.
+        '''
+        if streams is None:
+            streams = stream_count(self.device)
+        self.streams = streams
+        self.results = []
+        self.recommended = 0
+        try:
+            self.open(streams)
+            for buffer_size in buffer_sizes:
+                half = bytearray(buffer_size // 2)
+                throughput = self.measure_throughput(half, seconds / 4)
+                load, underruns = self.measure_paced(half, seconds)
+                self.results.append((buffer_size, throughput, load, underruns))
+                if not self.recommended and load <= SD_LOAD_LIMIT and not underruns:
+                    self.recommended = buffer_size
+        finally:
+            self.close()
+        return self.recommended
+
+    def report(self):
+        '''
+        Prints the results over serial.
+        '''
+        device = self.device
+        print(f'SD streaming at {device.sd_baudrate / 1000000:.1f} MHz, {self.streams} '
+              f'streams of {BYTES_PER_SECOND} bytes/s')
+        print(f'{"buffer":>8}{"KB/s":>9}{"load":>7}{"underruns":>11}{"RAM":>8}')
+        for buffer_size, throughput, load, underruns in self.results:
+            ram = 2 * len(SOUNDS) * buffer_size
+            print(f'{buffer_size:>8}{throughput / 1024:>9.0f}{load:>7.0%}{underruns:>11}{ram:>8}')
+        if self.recommended:
+            print(f'Recommended: "wave_buffer_size": {self.recommended}')
+        else:
+            print('No buffer size keeps up, raise "sd_baudrate" or lower "effect_voices"')
@@ -0,0 +1,286 @@
+'''
+Smoothswing v2 functions.
+
+An interpretation of the SmoothSwing v2 algorithm by Thexter.
+The gyroscope magnitude is filtered, accumulated into a swing angle,
+and the swing angle drives a crossfade between the swingh and swingl sounds,
+while the swing strength modulates the hum and swing mixer volumes.
+
+The functions are the reference for each step. The SmoothSwing class
+runs them tick by tick without allocating anything on the heap:
+no tuples, lists or arrays are created, only floats, which
+CircuitPython stores without allocating. For the same reason the hot path
+clamps with clamp() rather than min() and max(), which pack their arguments
+into a tuple on CPython, where the host benchmark checks for allocations.
+
+The swing strength curve and the crossfade volumes only depend on the
+profile, so they are baked into lookup tables when the profile is configured,
+and each reading interpolates between two entries instead of raising to
+a float power and dividing. The crossfade volumes are straight lines between
+their corners, so interpolating them is exact; the few table cells with a corner
+in them are computed directly. tools/swingcheck.py checks the tables against the functions.
+'''
+from array import array
+import math
+
+MAX_VOLUME = 0.9
+MIN_HUM_VOLUME = 0.25
+
+# Entries of the response tables, over 0 to PI rad/s and 0 to 2*PI rad
+STRENGTH_TABLE_SIZE = 256
+CROSSFADE_TABLE_SIZE = 256
+
+
+def clamp(value, low, high):
+    '''
+    Limits value to the range from low to high.
+    '''
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
+
+def calculate_gyro_rms(gyro_y, gyro_z):
+    '''
+    Takes the raw gyroscope readings (omitting the x-axis, which is "down the barrel"),
+    then calculates an estimate of the root mean square i.e the total magnitude
+    of the angular velocity of all axes.
+    It's not a true RMS calculation, but a good enough approximation.
+    It's the standard deviation of the two readings, which for two values is
+    half of the distance between them, so no array is needed to calculate it.
+    '''
+    return abs(gyro_y - gyro_z) * 0.5
+
+def lowpass_filter(data, previous_data, alpha):
+    '''
+    Simple lowpass filter to smooth out data from sensor readings.
+    The alpha value controls the smoothing factor. It should be a number between 0 and 1.
+    Lower values smooth more, a value of 1 effectively turns the filter off.
+    '''
+    if previous_data is None:
+        previous_data = data
+    filtered_data = alpha * data + (1 - alpha) * previous_data
+    return filtered_data
+
+def accumulate_swing_angle(gyro_filtered, time_delta, accumulated_swing):
+    '''
+    When the gyroscope reading crosses the set threshold, this function is called.
+    It starts tracking the accumulated swing angle each time delta tick,
+    and wraps around at 360 degrees (2*PI).
+    '''
+    accumulated_delta = gyro_filtered * time_delta
+    accumulated_swing += accumulated_delta
+    accumulated_swing %= (2 * math.pi)
+    return accumulated_swing
+
+def calculate_swing_strength(gyro_filtered, swing_sharpness):
+    '''
+    Calculates the swing_strength variable, which is used
+    to modulate the volumes of the main sound mixer object.
+    '''
+    swing_strength = gyro_filtered / math.pi
+    if swing_strength > 1.0:
+        swing_strength = 1.0
+    swing_strength = swing_strength ** swing_sharpness
+    return swing_strength
+
+def crossfade_progress(accumulated_swing, transition_region, transition_point):
+    '''
+    Where we are in a crossfade, from 0 to 1.
+    '''
+    return clamp((accumulated_swing - transition_point) / transition_region, 0.0, 1.0)
+
+def do_crossfade(accumulated_swing, transition_region, transition_point, max_volume):
+    '''
+    Performs a linear crossfade between two sounds,
+    based on the set transition region, which sets the duration of the crossfade,
+    and the accumulated swing, which controls where we are in the crossfade.
+    It also accounts for the set transition point, i.e where within the accumulated swing the crossfade starts.
+    '''
+    progress = crossfade_progress(accumulated_swing, transition_region, transition_point)
+    fade_out = max(0.0, (max_volume - progress))
+    fade_in = min(max_volume, progress)
+    return fade_out, fade_in
+
+
+class SmoothSwing:
+    '''
+    Gyroscope -> filter -> accumulate -> strength -> crossfade, one reading at a time.
+    The results are kept in attributes for the caller to write to the mixers,
+    instead of being returned as tuples.
+    With use_tables=False the strength and crossfade are computed directly.
+    '''
+    def __init__(self, max_volume=MAX_VOLUME, use_tables=True):
+        self.max_volume = max_volume
+        self.use_tables = use_tables
+        self.strength_table = array('f', [0.0] * (STRENGTH_TABLE_SIZE + 1))
+        self.strength_scale = STRENGTH_TABLE_SIZE / math.pi
+        self.swingh_table = array('f', [0.0] * (CROSSFADE_TABLE_SIZE + 1))
+        self.swingl_table = array('f', [0.0] * (CROSSFADE_TABLE_SIZE + 1))
+        self.crossfade_exact = bytearray(CROSSFADE_TABLE_SIZE)
+        self.crossfade_scale = CROSSFADE_TABLE_SIZE / (2 * math.pi)
+        self.configure(0.0, 1.0, 1.0, 1.0, 1.0, 0.0, 0.0)
+        self.previous_gyro_filtered = None
+        self.reset()
+
+    def configure(self, swing_threshold, lowpass_alpha, swing_sharpness,
+                  transition_region_1, transition_region_2, transition_point_1, transition_point_2):
+        self.swing_threshold = swing_threshold
+        self.lowpass_alpha = lowpass_alpha
+        self.swing_sharpness = swing_sharpness
+        self.transition_region_1 = transition_region_1
+        self.transition_region_2 = transition_region_2
+        self.transition_point_1 = transition_point_1
+        self.transition_point_2 = transition_point_2
+        self.build_tables()
+
+    def build_tables(self):
+        '''
+        Bakes the swing strength curve and the crossfade volumes of the current settings.
+        '''
+        table = self.strength_table
+        for i in range(STRENGTH_TABLE_SIZE + 1):
+            table[i] = calculate_swing_strength(i / self.strength_scale, self.swing_sharpness)
+
+        swingh_table = self.swingh_table
+        swingl_table = self.swingl_table
+        scale = self.crossfade_scale
+        self.swingh_volume = 0.0
+        self.swingl_volume = 0.0
+        for i in range(CROSSFADE_TABLE_SIZE + 1):
+            self.crossfade_direct(i / scale)
+            swingh_table[i] = self.swingh_volume
+            swingl_table[i] = self.swingl_volume
+
+        # Cells with a corner of the volume curves in them can't be interpolated
+        exact = self.crossfade_exact
+        for i in range(CROSSFADE_TABLE_SIZE):
+            exact[i] = 0
+        max_volume = self.max_volume
+        for point, region in ((self.transition_point_1, self.transition_region_1),
+                              (self.transition_point_2, self.transition_region_2)):
+            for corner in (point, point + region * max_volume, point + region):
+                i = int(corner * scale)
+                if 0 <= i < CROSSFADE_TABLE_SIZE:
+                    exact[i] = 1
+        self.reset()
+
+    def reset(self):
+        '''
+        Back to not swinging.
+        '''
+        self.swinging = False
+        self.crossfaded = False
+        self.accumulated_swing = 0.0
+        self.swing_strength = 0.0
+        self.hum_volume = self.max_volume
+        self.swing_volume = 0.0
+        self.swingh_volume = 0.0
+        self.swingl_volume = 0.0
+
+    def update(self, gyro_y, gyro_z, time_delta):
+        '''
+        Runs one gyroscope reading through the pipeline.
+        Returns True while swinging. crossfaded tells whether the swingh
+        and swingl volumes were changed by this reading.
+        '''
+        gyro_rms = calculate_gyro_rms(gyro_y, gyro_z)
+        gyro_filtered = lowpass_filter(gyro_rms, self.previous_gyro_filtered, self.lowpass_alpha)
+        self.previous_gyro_filtered = gyro_filtered
+
+        # If not swinging reset everything
+        if gyro_filtered <= self.swing_threshold:
+            self.reset()
+            return False
+
+        # Accumulate swing and calculate it's strength
+        accumulated_swing = accumulate_swing_angle(gyro_filtered, time_delta, self.accumulated_swing)
+        self.accumulated_swing = accumulated_swing
+        if self.use_tables:
+            swing_strength = self.strength_lookup(gyro_filtered)
+        else:
+            swing_strength = calculate_swing_strength(gyro_filtered, self.swing_sharpness)
+        self.swing_strength = swing_strength
+        self.swinging = True
+        if self.use_tables:
+            self.crossfaded = self.crossfade_lookup(accumulated_swing)
+        else:
+            self.crossfaded = self.crossfade_direct(accumulated_swing)
+
+        # Main mixer volumes
+        max_volume = self.max_volume
+        self.hum_volume = clamp(max_volume - swing_strength, MIN_HUM_VOLUME, 1.0)
+        self.swing_volume = clamp(swing_strength, 0.0, 1.0)
+        return True
+
+    def strength_lookup(self, gyro_filtered):
+        '''
+        calculate_swing_strength() from the table.
+        '''
+        position = gyro_filtered * self.strength_scale
+        if position >= STRENGTH_TABLE_SIZE:
+            return self.strength_table[STRENGTH_TABLE_SIZE]
+        i = int(position)
+        table = self.strength_table
+        low = table[i]
+        return low + (table[i + 1] - low) * (position - i)
+
+    def crossfade_direct(self, accumulated_swing):
+        '''
+        Sets the swingh and swingl volumes for the swing angle.
+        Returns whether they were changed, below both transition points they're left as they are.
+        '''
+        crossfaded = False
+        max_volume = self.max_volume
+        # Fade one way
+        if accumulated_swing > self.transition_point_1:
+            progress = crossfade_progress(accumulated_swing, self.transition_region_1, self.transition_point_1)
+            self.swingh_volume = clamp(max_volume - progress, 0.0, max_volume)
+            self.swingl_volume = clamp(progress, 0.0, max_volume)
+            crossfaded = True
+        # Fade back to wrap around
+        if accumulated_swing > self.transition_point_2:
+            progress = crossfade_progress(accumulated_swing, self.transition_region_2, self.transition_point_2)
+            self.swingl_volume = clamp(max_volume - progress, 0.0, max_volume)
+            self.swingh_volume = clamp(progress, 0.0, max_volume)
+            crossfaded = True
+        return crossfaded
+
+    def crossfade_lookup(self, accumulated_swing):
+        '''
+        crossfade_direct() from the tables.
+        '''
+        if accumulated_swing <= self.transition_point_1 and accumulated_swing <= self.transition_point_2:
+            return False
+        position = accumulated_swing * self.crossfade_scale
+        i = int(position)
+        if i >= CROSSFADE_TABLE_SIZE or self.crossfade_exact[i]:
+            return self.crossfade_direct(accumulated_swing)
+        fraction = position - i
+        table = self.swingh_table
+        low = table[i]
+        self.swingh_volume = low + (table[i + 1] - low) * fraction
+        table = self.swingl_table
+        low = table[i]
+        self.swingl_volume = low + (table[i + 1] - low) * fraction
+        return True
+
+    def update_batch(self, gyro_y, gyro_z, dt, count):
+        '''
+        Runs the first count readings of the arrays through the pipeline,
+        each over its own dt, so the swing angle is integrated sample by sample.
+        Returns whether the last reading was swinging. crossfaded tells
+        whether any of the readings changed the swingh and swingl volumes.
+        '''
+        swinging = False
+        crossfaded = False
+        # A while loop, as range() allocates on CPython
+        i = 0
+        while i < count:
+            swinging = self.update(gyro_y[i], gyro_z[i], dt[i])
+            if self.crossfaded:
+                crossfaded = True
+            i += 1
+        self.crossfaded = crossfaded
+        return swinging
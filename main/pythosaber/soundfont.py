@@ -0,0 +1,294 @@
+'''
+Soundfont slots.
+
+The sounds of a soundfont are opened into one of two slots. The mixers play
+from the active slot, and the next font is opened into the standby slot.
+Once it's open the slots are swapped with nothing playing, and the old font's
+files are closed on a later tick.
+
+The mixers stay alive through a switch, and each slot reuses its own
+WaveFile buffers. A switch doesn't tear down the audio pipeline, and
+the heap never holds more than two fonts' worth of buffers.
+
+Which variant of each sound is opened is picked from the font's index,
+see pythosaber.fontindex.
+
+The swing sounds only play while the blade is on, so they're left closed
+when a font is opened and opened at its first ignition, after the ignition
+sound has started. Loading a font for STANDBY opens two files fewer.
+'''
+import random
+
+from pythosaber.fontindex import load_index
+from pythosaber.hal import ticks_diff
+
+# Bytes of WaveFile buffer per sound, split in two halves that are filled in turn
+WAVE_BUFFER_SIZE = 1024
+
+# Attribute, Proffie sound name and the file used when the index has no variants of it
+SOUNDS = (
+    ("font", "font", "/font.wav"),
+    ("hum", "hum", "/hum.wav"),
+    ("clash", "clsh", "/clsh/clsh1.wav"),
+    ("ignite", "out", "/out/out1.wav"),
+    ("extinguish", "in", "/in/in1.wav"),
+    ("swingh", "swingh", "/swingh/swingh1.wav"),
+    ("swingl", "swingl", "/swingl/swingl1.wav"),
+    )
+
+# Sounds whose variants go together, swingh3.wav with swingl3.wav
+PAIRED_SOUNDS = ("swingh", "swingl")
+
+# Sounds opened on first use rather than with the font
+DEFERRED_SOUNDS = ("swingh", "swingl")
+
+
+class FontSlot:
+    '''
+    The open sounds of one soundfont.
+    '''
+    def __init__(self, buffer_size=WAVE_BUFFER_SIZE):
+        self.path = None
+        self.index = None
+        self.buffers = [bytearray(buffer_size) for _ in SOUNDS]
+        self.paths = [None] * len(SOUNDS)
+        # The variant of the paired sounds, picked when the font is opened
+        self.pair = 0
+        self.font = None
+        self.hum = None
+        self.clash = None
+        self.ignite = None
+        self.extinguish = None
+        self.swingh = None
+        self.swingl = None
+
+    def open(self, device, path):
+        '''
+        Opens the sounds of the font in the folder at path, closing whatever the slot held.
+        A random variant of each sound is picked, swingh and swingl as a pair.
+        Returns False and leaves the slot empty if a sound can't be opened.
+        '''
+        for _ in self.open_steps(device, path):
+            pass
+        return self.path is not None
+
+    def open_steps(self, device, path):
+        '''
+        open() one step at a time: yields after the index is loaded and after
+        each sound, so the task runtime can run the other tasks in between.
+        The slot's path is set once all the sounds but the deferred ones are open.
+        '''
+        self.release()
+        index = load_index(device, path)
+        self.index = index
+        self.pair = random.randrange(index.count("swingh")) if index.count("swingh") else 0
+        yield
+        for i in range(len(SOUNDS)):
+            if SOUNDS[i][0] in DEFERRED_SOUNDS:
+                continue
+            try:
+                self.open_sound(device, i)
+            except Exception as e:
+                print(f'Loading soundfont {path} failed')
+                print('Exception {} {}\n'.format(type(e).__name__, e))
+                self.release()
+                return
+            yield
+        self.path = path
+
+    def open_sound(self, device, i, number=None):
+        '''
+        Opens a variant of the i-th sound of SOUNDS into its buffer,
+        the given one, the slot's pair for the paired sounds, or a random one.
+        '''
+        name, sound, default = SOUNDS[i]
+        if number is None and sound in PAIRED_SOUNDS:
+            number = self.pair
+        file = self.index.pick(sound, number)
+        if file is None:
+            file = self.index.path + default
+        setattr(self, name, device.open_wave(file, self.buffers[i]))
+        self.paths[i] = file
+
+    def open_deferred(self, device):
+        '''
+        Opens the sounds of DEFERRED_SOUNDS that aren't open yet.
+        Returns False if one can't be opened.
+        '''
+        for i in range(len(SOUNDS)):
+            name = SOUNDS[i][0]
+            if name in DEFERRED_SOUNDS and getattr(self, name) is None:
+                try:
+                    self.open_sound(device, i)
+                except Exception as e:
+                    print(f'Loading {name} of soundfont {self.path} failed')
+                    print('Exception {} {}\n'.format(type(e).__name__, e))
+                    return False
+        return True
+
+    def path_of(self, name):
+        '''
+        The file the named sound was opened from.
+        '''
+        for i in range(len(SOUNDS)):
+            if SOUNDS[i][0] == name:
+                return self.paths[i]
+        return None
+
+    def shuffle(self, device, names):
+        '''
+        Reopens the named sounds with another random variant, for sounds
+        with more than one. None of them may be playing.
+        A variant that can't be opened, e.g. deleted since the font was indexed,
+        leaves the sound as it was.
+        '''
+        for i in range(len(SOUNDS)):
+            name, sound, _ = SOUNDS[i]
+            if name in names and self.index.count(sound) > 1:
+                previous = self.paths[i]
+                if previous is None:
+                    continue
+                getattr(self, name).deinit()
+                try:
+                    self.open_sound(device, i)
+                except Exception as e:
+                    print(f'Loading a variant of {name} of soundfont {self.path} failed')
+                    print('Exception {} {}\n'.format(type(e).__name__, e))
+                    self.reopen(device, i, previous)
+
+    def reopen(self, device, i, path):
+        '''
+        Opens the i-th sound of SOUNDS from path again, after another variant failed.
+        Leaves the sound closed if that fails too.
+        '''
+        name = SOUNDS[i][0]
+        try:
+            setattr(self, name, device.open_wave(path, self.buffers[i]))
+            self.paths[i] = path
+        except Exception as e:
+            print(f'Reopening {path} failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            setattr(self, name, None)
+            self.paths[i] = None
+
+    def release(self):
+        '''
+        Closes the sounds.
+        '''
+        for i in range(len(SOUNDS)):
+            name = SOUNDS[i][0]
+            sound = getattr(self, name)
+            if sound is not None:
+                sound.deinit()
+                setattr(self, name, None)
+            self.paths[i] = None
+        self.path = None
+
+
+class FontManager:
+    def __init__(self, device, buffer_size=WAVE_BUFFER_SIZE):
+        self.device = device
+        self.active = FontSlot(buffer_size)
+        self.standby = FontSlot(buffer_size)
+
+        # The standby slot holds the previous font until it's released
+        self.retired = False
+
+        self.swaps = 0
+        self.loaded = False
+        self.load_ms_last = 0
+        self.load_ms_max = 0
+
+    def set_buffer_size(self, buffer_size):
+        '''
+        Sizes the WaveFile buffers of both slots. Only before the first font is loaded.
+        '''
+        if buffer_size == len(self.active.buffers[0]):
+            return
+        self.active = FontSlot(buffer_size)
+        self.standby = FontSlot(buffer_size)
+
+    def prepare(self, path):
+        '''
+        Opens the font at path into the standby slot.
+        '''
+        self.retired = False
+        return self.standby.open(self.device, path)
+
+    def swap(self):
+        '''
+        Makes the standby slot the active one. Audio and every mixer voice
+        are stopped first, as they may be playing from the active slot.
+        The previous font stays open until release().
+        '''
+        self.stop()
+        self.active, self.standby = self.standby, self.active
+        self.retired = self.standby.path is not None
+        self.swaps += 1
+
+    def stop(self):
+        '''
+        Stops the audio and every mixer voice.
+        '''
+        device = self.device
+        device.i2s.stop()
+        for voice in device.main_mixer.voice:
+            voice.stop()
+        for voice in device.swing_mixer.voice:
+            voice.stop()
+
+    def open_deferred(self):
+        '''
+        Opens the deferred sounds of the active font, see FontSlot.open_deferred().
+        '''
+        return self.active.open_deferred(self.device)
+
+    def shuffle(self, names):
+        '''
+        Picks other variants of the named sounds of the active font.
+        Stops the audio, so only call it while nothing should be playing.
+        '''
+        self.stop()
+        self.active.shuffle(self.device, names)
+
+    def release(self):
+        '''
+        Closes the previous font. Called on a later tick than the swap.
+        Returns True if there was one to close.
+        '''
+        if not self.retired:
+            return False
+        self.standby.release()
+        self.retired = False
+        return True
+
+    def load(self, path):
+        '''
+        Prepares the font at path and swaps to it.
+        Returns False and keeps the active font if it can't be opened.
+        '''
+        for _ in self.load_steps(path):
+            pass
+        return self.loaded
+
+    def load_steps(self, path):
+        '''
+        load() one step at a time, see FontSlot.open_steps().
+        The time it took counts from the first step to the swap.
+        loaded tells whether it succeeded.
+        '''
+        device = self.device
+        start = device.ticks_ms()
+        self.loaded = False
+        self.retired = False
+        for _ in self.standby.open_steps(device, path):
+            yield
+        if self.standby.path is None:
+            return
+        self.swap()
+        self.loaded = True
+
+        duration = ticks_diff(device.ticks_ms(), start)
+        self.load_ms_last = duration
+        if duration > self.load_ms_max:
+            self.load_ms_max = duration
@@ -0,0 +1,48 @@
+'''
+Boot phase timing.
+
+code.py and Lightsaber.boot() mark the end of each phase of the boot:
+importing the modules, bringing up the hardware, reading the config,
+making the mixers, loading the profile and its soundfont. Once the saber
+is ready to ignite the time of every phase is printed over serial, with
+the hardware's own steps under it if the backend timed them, so a slow
+SD card or a large config shows up where it costs.
+
+Only what STANDBY needs is done at boot. The swing sounds are opened at
+the first ignition of each font, the task runtime, SD benchmark, motion
+trace and telemetry modules are only imported when they're switched on.
+'''
+import time
+
+
+class BootTimer:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.last = self.start
+        # (name, ms) per phase, in order
+        self.phases = []
+        # (name, ms) per step of the hardware phase, from the backend
+        self.hardware = ()
+
+    def phase(self, name):
+        '''
+        Ends the named phase, which started where the previous one ended.
+        '''
+        now = self.clock()
+        self.phases.append((name, (now - self.last) * 1000))
+        self.last = now
+
+    def total_ms(self):
+        return (self.last - self.start) * 1000
+
+    def report(self):
+        '''
+        Prints the phases over serial.
+        '''
+        print(f'Ready in {self.total_ms():.0f} ms:')
+        for name, ms in self.phases:
+            print(f'  {name:<12}{ms:>6.0f} ms')
+            if name == "hardware":
+                for step, step_ms in self.hardware:
+                    print(f'    {step:<10}{step_ms:>6.0f} ms')
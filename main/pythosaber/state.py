@@ -0,0 +1,110 @@
+'''
+Saved state.
+
+The selected profile survives a reset in a small fixed-size record in the
+device's non-volatile memory, instead of in config.json. Rewriting config.json
+for every profile change meant a full SD write of a file that grows with the
+number of profiles, and a cut in power during the write could corrupt it.
+
+The record is only written when the selection actually changed, and
+not until it has stayed the same for a moment, so cycling quickly
+through the profiles writes once at the end rather than once per press.
+
+Record layout, little endian:
+    0  magic byte
+    1  record version
+    2  selection, 16 bits
+    4  checksum of bytes 0-3
+'''
+from pythosaber.hal import ticks_diff
+
+MAGIC = 0x53
+VERSION = 1
+RECORD_SIZE = 5
+
+# How long the selection has to stay unchanged before it's written, in milliseconds
+SAVE_DELAY_MS = 2000
+
+
+def checksum(record):
+    total = 0
+    for i in range(RECORD_SIZE - 1):
+        total = (total + record[i]) & 0xFF
+    return total ^ 0xFF
+
+
+class SavedState:
+    def __init__(self, device, offset=0, delay_ms=SAVE_DELAY_MS):
+        self.device = device
+        self.nvm = device.nvm
+        self.offset = offset
+        self.delay_ms = delay_ms
+
+        self.record = bytearray(RECORD_SIZE)
+        self.saved_selection = None
+        self.selection = None
+        self.pending = False
+        self.changed_at = 0
+        self.writes = 0
+
+    def load(self):
+        '''
+        Reads the saved selection. Returns None if nothing valid has been saved yet.
+        '''
+        if self.nvm is None:
+            print('No NVM. Selection will not be saved.')
+            return None
+        record = self.record
+        record[:] = self.nvm[self.offset:self.offset + RECORD_SIZE]
+        if record[0] != MAGIC or record[1] != VERSION or record[4] != checksum(record):
+            print('No saved selection.')
+            return None
+        selection = record[2] | (record[3] << 8)
+        self.saved_selection = selection
+        self.selection = selection
+        return selection
+
+    def set(self, selection):
+        '''
+        Sets the selection to save. The write is deferred until poll()
+        sees it unchanged for delay_ms, or flush() is called.
+        '''
+        self.selection = selection
+        self.pending = selection != self.saved_selection
+        self.changed_at = self.device.ticks_ms()
+
+    def poll(self):
+        '''
+        Writes a pending selection once it has settled.
+        Call it when there's time to spare, as a write to flash can take milliseconds.
+        Returns True if the selection was written.
+        '''
+        if not self.pending:
+            return False
+        if ticks_diff(self.device.ticks_ms(), self.changed_at) < self.delay_ms:
+            return False
+        return self.flush()
+
+    def flush(self):
+        '''
+        Writes a pending selection now.
+        '''
+        if not self.pending or self.nvm is None:
+            return False
+        record = self.record
+        selection = self.selection
+        record[0] = MAGIC
+        record[1] = VERSION
+        record[2] = selection & 0xFF
+        record[3] = (selection >> 8) & 0xFF
+        record[4] = checksum(record)
+        try:
+            self.nvm[self.offset:self.offset + RECORD_SIZE] = record
+        except Exception as e:
+            print('Saving selection failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            return False
+        self.saved_selection = selection
+        self.pending = False
+        self.writes += 1
+        return True
@@ -0,0 +1,379 @@
+'''
+Runtime telemetry.
+
+Printing over serial from the main loop takes longer than most of the work
+it would report on, so telemetry counts into preallocated buffers instead
+and writes the counts out in compact binary frames, a block at a time,
+when the tick has time to spare.
+
+While it runs, Telemetry stands in for the loop's probe (see pythosaber.probe)
+and passes every mark on to it. Each tick the time since the previous mark
+is added to the stage of the mark, and every frame_ticks ticks the counts are
+packed into a frame in a ring of ring_frames frames, along with the heap,
+the state, how many of the ticks were swinging and the mixer levels.
+
+The time is counted in ticks_ms(): on the saber ticks_us() makes a long
+integer every call. A stage that takes less than a millisecond counts as 0
+or 1 depending on where the millisecond edges fall, so a frame's sums are
+right on average rather than tick by tick.
+
+Once FLUSH_FRAMES frames are waiting they're written out after the garbage
+collection stage, if the rest of the tick is longer than the last write took,
+or in any case once the ring is full. The time the write took goes in the
+next frame instead of the sleep stage. Should the sink still fall behind,
+the oldest frames are overwritten and counted as dropped.
+
+Sinks, "telemetry_sink" in config.json:
+    sd      a file in sd_root/telemetry, one per start
+    serial  usb_cdc.data as is, when it's enabled in boot.py, otherwise
+            the console, as lines of SERIAL_PREFIX and the bytes in base64
+
+Layout, little endian, a header at every start and then the frames:
+    header, 10 bytes:
+        4  magic b"PSTL"
+        1  version
+        1  header size
+        2  frame size
+        1  stage count
+        1  ticks per frame
+    frame, 42 bytes:
+        4  timestamp in ms, unsigned, wraps like ticks_ms()
+        2  ticks in the frame
+        2  longest tick's work in ms, up to the end of the garbage collection
+        16 ms per stage, 2 bytes each, in the order of STAGE_NAMES
+        4  heap free in bytes
+        4  heap allocated in bytes
+        1  garbage collections
+        1  state, see STATE_CODES
+        1  ticks swinging
+        1  frames dropped before this one
+        4  hum, swing, swingh and swingl levels, 0 to 255
+        2  ms the previous write to the sink took
+
+Switched on or off by holding aux and pressing main, and as the profile's
+"telemetry" setting says whenever a profile is loaded.
+Only the main loop's ticks are counted, with the task runtime the tasks'
+own statistics tell where the time goes. tools/telemetry.py decodes the
+captures into tables and plots.
+'''
+import os
+import struct
+from array import array
+
+from pythosaber.hal import ticks_diff
+from pythosaber.probe import Probe, STAGE_COUNT, STAGE_GC
+
+MAGIC = b"PSTL"
+VERSION = 1
+HEADER_FORMAT = "<4sBBHBB"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FRAME_FORMAT = "<IHH" + "H" * STAGE_COUNT + "IIBBBB4BH"
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+
+# Default ticks per frame, overridden by "telemetry_frame_ticks" in config.json
+FRAME_TICKS = 10
+# Frames in the ring
+RING_FRAMES = 32
+# Frames per write, 12 frames make a 504 byte write, just under an SD block
+FLUSH_FRAMES = 12
+
+SINK_SD = "sd"
+SINK_SERIAL = "serial"
+
+TELEMETRY_FOLDER = "/telemetry"
+SERIAL_PREFIX = "#PSTL "
+
+STATE_CODES = {"STANDBY": 0, "ACTIVE": 1, "RETRACTING": 2}
+STATE_OTHER = 3
+STATE_NAMES = ("standby", "active", "retracting", "other")
+
+
+def to_byte(level):
+    byte = int(level * 255 + 0.5)
+    if byte > 255:
+        return 255
+    if byte < 0:
+        return 0
+    return byte
+
+
+class FileSink:
+    '''
+    Writes the telemetry to a new numbered file in a folder on the SD card.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        self.name = folder
+        self.file = None
+
+    def find_next_number(self):
+        '''
+        The number after the highest capture in the folder.
+        '''
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            os.mkdir(self.folder)
+            names = []
+        number = 0
+        for name in names:
+            if name.startswith("telem") and name.endswith(".bin"):
+                try:
+                    number = max(number, int(name[5:-4]) + 1)
+                except ValueError:
+                    pass
+        return number
+
+    def open(self, header):
+        self.name = f'{self.folder}/telem{self.find_next_number():03d}.bin'
+        self.file = open(self.name, "wb")
+        self.file.write(header)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SerialSink:
+    '''
+    Writes the telemetry over USB: to the data port if there is one,
+    otherwise base64 encoded between the prints on the console.
+    '''
+    def __init__(self):
+        self.port = None
+        self.name = "console"
+        try:
+            import usb_cdc
+            self.port = usb_cdc.data
+        except ImportError:
+            pass
+        if self.port is not None:
+            self.name = "usb_cdc.data"
+
+    def open(self, header):
+        self.write(header)
+
+    def write(self, data):
+        if self.port is not None:
+            self.port.write(data)
+        else:
+            import binascii
+            print(SERIAL_PREFIX + binascii.b2a_base64(data, newline=False).decode())
+
+    def close(self):
+        pass
+
+
+class Telemetry(Probe):
+    def __init__(self, saber, sink=None, frame_ticks=None, ring_frames=RING_FRAMES):
+        self.saber = saber
+        self.device = saber.device
+        self.sink_type = sink or SINK_SD
+        self.sink = None
+        self.frame_ticks = max(1, min(255, frame_ticks or FRAME_TICKS))
+        self.ring = bytearray(FRAME_SIZE * ring_frames)
+        self.ring_frames = ring_frames
+        self.head = 0
+        self.pending = 0
+
+        # The probe the marks are passed on to, the saber's own while running
+        self.inner = Probe()
+        self.running = False
+        self.in_tick = False
+
+        # Counts of the frame being filled
+        self.stage_ms = array('L', [0] * STAGE_COUNT)
+        self.ticks = 0
+        self.work_max = 0
+        self.swinging_ticks = 0
+        self.collections = 0
+        self.dropped = 0
+        self.flush_ms = 0
+        self.tick_start = 0
+        self.last = 0
+
+        self.frames = 0
+        self.writes = 0
+        self.dropped_total = 0
+
+    def start(self):
+        '''
+        Opens the sink and starts counting from the next tick.
+        '''
+        if self.running:
+            return
+        if self.sink is None:
+            if self.sink_type == SINK_SERIAL:
+                self.sink = SerialSink()
+            else:
+                self.sink = FileSink(self.device.sd_root + TELEMETRY_FOLDER)
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, HEADER_SIZE, FRAME_SIZE,
+                             STAGE_COUNT, self.frame_ticks)
+        try:
+            self.sink.open(header)
+        except OSError as e:
+            print(f'Opening telemetry {self.sink.name} failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            return
+        self.head = 0
+        self.pending = 0
+        self.reset_frame()
+        self.frames = 0
+        self.writes = 0
+        self.dropped_total = 0
+        self.flush_ms = 0
+
+        saber = self.saber
+        self.inner = saber.probe
+        saber.probe = self
+        self.running = True
+        print(f'Telemetry to {self.sink.name}')
+
+    def stop(self):
+        '''
+        Writes out what's counted so far and closes the sink.
+        '''
+        if not self.running:
+            return
+        if self.ticks:
+            self.pack_frame()
+        self.flush()
+        self.sink.close()
+        self.saber.probe = self.inner
+        self.running = False
+        self.in_tick = False
+        print(f'Telemetry: {self.frames} frames, {self.dropped_total} dropped')
+
+    def reset_frame(self):
+        stage_ms = self.stage_ms
+        i = 0
+        while i < STAGE_COUNT:
+            stage_ms[i] = 0
+            i += 1
+        self.ticks = 0
+        self.work_max = 0
+        self.swinging_ticks = 0
+        self.collections = self.saber.memory.collections
+        self.dropped = 0
+
+    # Probe methods
+    def begin(self):
+        self.inner.begin()
+        if not self.running:
+            return
+        now = self.device.ticks_ms()
+        self.tick_start = now
+        self.last = now
+        self.in_tick = True
+
+    def mark(self, stage):
+        self.inner.mark(stage)
+        # Marks outside the loop's ticks, e.g. from the tasks, aren't counted
+        if not self.in_tick:
+            return
+        now = self.device.ticks_ms()
+        self.stage_ms[stage] += ticks_diff(now, self.last)
+        self.last = now
+        if stage == STAGE_GC:
+            work = ticks_diff(now, self.tick_start)
+            if work > self.work_max:
+                self.work_max = work
+            if self.pending >= FLUSH_FRAMES and (
+                    self.pending == self.ring_frames
+                    or self.saber.scheduler.remaining_ms() > self.flush_ms):
+                self.flush()
+                self.last = self.device.ticks_ms()
+
+    def end(self):
+        self.inner.end()
+        if not self.in_tick:
+            return
+        self.in_tick = False
+        self.ticks += 1
+        saber = self.saber
+        if saber.current_state == "ACTIVE" and saber.smoothswing.swinging:
+            self.swinging_ticks += 1
+        if self.ticks >= self.frame_ticks:
+            self.pack_frame()
+
+    def pack_frame(self):
+        '''
+        Packs the counts into the next frame of the ring and starts a new one.
+        '''
+        if self.pending == self.ring_frames:
+            # The sink fell behind, the oldest frame goes
+            self.pending -= 1
+            self.dropped += 1
+            self.dropped_total += 1
+        saber = self.saber
+        device = self.device
+        levels = saber.levels
+        stage_ms = self.stage_ms
+        struct.pack_into(
+            FRAME_FORMAT, self.ring, self.head * FRAME_SIZE,
+            device.ticks_ms(),
+            self.ticks,
+            min(self.work_max, 0xFFFF),
+            min(stage_ms[0], 0xFFFF),
+            min(stage_ms[1], 0xFFFF),
+            min(stage_ms[2], 0xFFFF),
+            min(stage_ms[3], 0xFFFF),
+            min(stage_ms[4], 0xFFFF),
+            min(stage_ms[5], 0xFFFF),
+            min(stage_ms[6], 0xFFFF),
+            min(stage_ms[7], 0xFFFF),
+            device.mem_free(),
+            device.mem_alloc(),
+            min(saber.memory.collections - self.collections, 255),
+            STATE_CODES.get(saber.current_state, STATE_OTHER),
+            self.swinging_ticks,
+            min(self.dropped, 255),
+            to_byte(levels.hum.written),
+            to_byte(levels.swing.written),
+            to_byte(levels.swingh.written),
+            to_byte(levels.swingl.written),
+            min(self.flush_ms, 0xFFFF))
+        self.head += 1
+        if self.head == self.ring_frames:
+            self.head = 0
+        self.pending += 1
+        self.frames += 1
+        self.reset_frame()
+
+    def flush(self):
+        '''
+        Writes the waiting frames to the sink, the ring's end and then its start if they wrap.
+        '''
+        pending = self.pending
+        if not pending:
+            return
+        device = self.device
+        start = device.ticks_ms()
+        first = self.head - pending
+        ring = memoryview(self.ring)
+        try:
+            if first < 0:
+                self.sink.write(ring[(first + self.ring_frames) * FRAME_SIZE:])
+                first = 0
+            if self.head:
+                self.sink.write(ring[first * FRAME_SIZE:self.head * FRAME_SIZE])
+        except OSError as e:
+            print('Writing telemetry failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+        self.pending = 0
+        self.writes += 1
+        self.flush_ms = ticks_diff(device.ticks_ms(), start)
+
+    def dump(self):
+        '''
+        Prints the telemetry status over serial.
+        '''
+        if not self.running:
+            print('Telemetry: off')
+            return
+        print(f'Telemetry: to {self.sink.name}, {self.frames} frames, {self.writes} writes, '
+              f'{self.dropped_total} dropped, last write {self.flush_ms} ms')
@@ -0,0 +1,166 @@
+'''
+Motion trace recorder.
+
+With "imu_trace" on in config.json every IMU sample read while the blade is on
+is written to a binary file in sd_root/traces, one file per ignition.
+The traces can be replayed through SmoothSwing on a computer with
+tools/replay.py to tune the swing settings without waving the saber around.
+
+File layout, little endian:
+    header, 16 bytes:
+        4  magic b"PSTR"
+        1  version
+        1  header size
+        2  output data rate in Hz, 0 if the samples weren't from the FIFO
+        4  gyro scale, rad/s per LSB, float
+        4  accelerometer scale, m/s^2 per LSB, float
+    then one 20 byte record per sample:
+        4  timestamp in ms, unsigned, wraps like ticks_ms()
+        4  time since the previous sample in seconds, float
+        6  gyro x, y, z in LSB, signed
+        6  accelerometer x, y, z in LSB, signed
+Samples are collected in a buffer and written a block at a time.
+'''
+import os
+import struct
+
+from pythosaber.motion import GYRO_SCALE, ACCEL_SCALE
+
+MAGIC = b"PSTR"
+VERSION = 1
+HEADER_FORMAT = "<4sBBHff"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = "<Ifhhhhhh"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Records per write, 25 records make a 500 byte write, just under an SD block
+BLOCK_RECORDS = 25
+
+TRACE_FOLDER = "/traces"
+
+
+def to_lsb(value, scale):
+    raw = round(value / scale)
+    if raw > 0x7FFF:
+        return 0x7FFF
+    if raw < -0x8000:
+        return -0x8000
+    return raw
+
+
+class TraceRecorder:
+    def __init__(self, device, folder=None, block_records=BLOCK_RECORDS):
+        self.device = device
+        self.folder = folder or device.sd_root + TRACE_FOLDER
+        self.buffer = bytearray(RECORD_SIZE * block_records)
+        self.block_records = block_records
+        self.pending = 0
+        self.file = None
+        self.path = None
+        self.next_number = None
+        self.records = 0
+        self.writes = 0
+
+    def find_next_number(self):
+        '''
+        The number after the highest trace in the folder. Lists the folder,
+        so it's done once at boot rather than at ignition.
+        Returns False if there's no folder and it can't be made, e.g. on a full or read-only card.
+        '''
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            try:
+                os.mkdir(self.folder)
+            except OSError as e:
+                print(f'Making {self.folder} failed, not recording traces')
+                print('Exception {} {}\n'.format(type(e).__name__, e))
+                return False
+            names = []
+        number = 0
+        for name in names:
+            if name.startswith("trace") and name.endswith(".bin"):
+                try:
+                    number = max(number, int(name[5:-4]) + 1)
+                except ValueError:
+                    pass
+        self.next_number = number
+        return True
+
+    def start(self, sampler):
+        '''
+        Opens the next trace file for the samples of the given MotionSampler.
+        '''
+        self.stop()
+        if self.next_number is None and not self.find_next_number():
+            return
+        self.path = f'{self.folder}/trace{self.next_number:03d}.bin'
+        self.next_number += 1
+        rate = int(sampler.rate) if sampler.use_fifo else 0
+        try:
+            self.file = open(self.path, "wb")
+            self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, HEADER_SIZE, rate,
+                                        GYRO_SCALE, ACCEL_SCALE))
+        except OSError as e:
+            print(f'Opening trace {self.path} failed')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            self.file = None
+            return
+        self.records = 0
+        print(f'Recording trace {self.path}')
+
+    def record(self, sampler):
+        '''
+        Adds the samples of the sampler's last read.
+        '''
+        if self.file is None:
+            return
+        buffer = self.buffer
+        for i in range(sampler.count):
+            struct.pack_into(
+                RECORD_FORMAT, buffer, self.pending * RECORD_SIZE,
+                sampler.timestamp[i] & 0xFFFFFFFF,
+                sampler.dt[i],
+                to_lsb(sampler.gyro_x[i], GYRO_SCALE),
+                to_lsb(sampler.gyro_y[i], GYRO_SCALE),
+                to_lsb(sampler.gyro_z[i], GYRO_SCALE),
+                to_lsb(sampler.accel_x[i], ACCEL_SCALE),
+                to_lsb(sampler.accel_y[i], ACCEL_SCALE),
+                to_lsb(sampler.accel_z[i], ACCEL_SCALE))
+            self.pending += 1
+            self.records += 1
+            if self.pending == self.block_records:
+                self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered records. Stops recording if the card can't be written, e.g. when it's full.
+        '''
+        if self.file is None or not self.pending:
+            return
+        try:
+            self.file.write(memoryview(self.buffer)[0:self.pending * RECORD_SIZE])
+        except OSError as e:
+            print(f'Writing trace {self.path} failed, recording stopped')
+            print('Exception {} {}\n'.format(type(e).__name__, e))
+            try:
+                self.file.close()
+            except OSError:
+                # The card may be gone, there's nothing more to write
+                pass
+            self.file = None
+        self.pending = 0
+        self.writes += 1
+
+    def stop(self):
+        '''
+        Writes what's left and closes the file.
+        '''
+        if self.file is None:
+            return
+        self.flush()
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        print(f'Trace {self.path}: {self.records} samples')
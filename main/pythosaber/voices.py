@@ -0,0 +1,127 @@
+'''
+Voice pool.
+
+The main mixer has a voice for the hum, one for the swing mixer, and after
+them a pool of voices for one-shot effects: ignition, retraction, clashes.
+An effect plays on a free voice of the pool, so effects that follow each
+other quickly overlap instead of cutting each other off. With every voice
+busy the quietest one is stolen, the oldest of those if several are as
+quiet, rather than dropping the new effect.
+
+The pool has as many voices as the mixer was made with, the most any
+profile asks for, and the active profile's effect_voices limits how many
+of them are used. The mixers are never made again while the saber runs.
+
+The time play() takes to start an effect is measured: streaming one from
+the SD card has to rewind its file first, one cached in RAM (see
+pythosaber.samplecache) starts at once. Only the voice.play() call is
+timed, not the time from the trigger to the sound coming out, which adds
+the time the mixer takes to pick the voice up.
+'''
+from pythosaber.hal import ticks_diff
+
+
+class VoicePool:
+    def __init__(self, device, levels):
+        self.device = device
+        self.levels = levels
+        self.envelopes = levels.effects
+        count = len(self.envelopes)
+        self.started = [0] * count
+        self.limit = count
+
+        # The voice and level envelope of the last effect played
+        self.voice = None
+        self.envelope = None
+
+        self.plays = 0
+        self.steals = 0
+        self.peak = 0
+        self.latency_us_last = 0
+        self.latency_us_min = 0
+        self.latency_us_max = 0
+
+    def set_limit(self, count):
+        '''
+        Uses the first count voices of the pool, at least one, and stops the others.
+        '''
+        envelopes = self.envelopes
+        count = max(1, min(count, len(envelopes)))
+        for i in range(count, len(envelopes)):
+            envelopes[i].voice.stop()
+        self.limit = count
+
+    def in_use(self):
+        '''
+        Number of voices playing an effect.
+        '''
+        envelopes = self.envelopes
+        count = 0
+        i = 0
+        while i < self.limit:
+            if envelopes[i].voice.playing:
+                count += 1
+            i += 1
+        return count
+
+    def allocate(self):
+        '''
+        Returns the index of a free voice, or steals the quietest, oldest one.
+        '''
+        envelopes = self.envelopes
+        started = self.started
+        limit = self.limit
+        i = 0
+        while i < limit:
+            if not envelopes[i].voice.playing:
+                return i
+            i += 1
+
+        best = 0
+        i = 1
+        while i < limit:
+            difference = envelopes[i].written - envelopes[best].written
+            if difference < -envelopes[i].threshold or (
+                    difference <= envelopes[i].threshold and ticks_diff(started[i], started[best]) < 0):
+                best = i
+            i += 1
+        self.steals += 1
+        return best
+
+    def play(self, sample, level):
+        '''
+        Plays a one-shot sample at level on a voice of the pool.
+        Its voice and envelope are left in voice and envelope, e.g. to fade it.
+        A sound that couldn't be opened, None, is skipped.
+        '''
+        if sample is None:
+            return
+        device = self.device
+        start = device.ticks_us()
+        i = self.allocate()
+        envelope = self.envelopes[i]
+        self.levels.set(envelope, level)
+        voice = envelope.voice
+        voice.play(sample, loop=False)
+        latency = device.ticks_us() - start
+        self.latency_us_last = latency
+        if latency < self.latency_us_min or not self.plays:
+            self.latency_us_min = latency
+        if latency > self.latency_us_max:
+            self.latency_us_max = latency
+        self.started[i] = device.ticks_ms()
+        self.voice = voice
+        self.envelope = envelope
+        self.plays += 1
+        in_use = self.in_use()
+        if in_use > self.peak:
+            self.peak = in_use
+
+    def dump(self):
+        '''
+        Prints the pool statistics over serial.
+        '''
+        print(f'Effect voices: {self.in_use()} of {self.limit} in use, peak {self.peak}, '
+              f'{self.plays} plays, {self.steals} steals')
+        print(f'Effect start, voice.play() only: last {self.latency_us_last} us, '
+              f'min {self.latency_us_min} us, max {self.latency_us_max} us')
@@ -0,0 +1,418 @@
+'''
+Main loop benchmark.
+
+Runs the real Lightsaber state machine on the host backend through a scripted
+session: standby, ignition, ten seconds of swinging with two clashes, retraction
+and a profile change.
+Reports ticks per second of work, the time spent in each stage of the loop,
+the memory allocated per tick and the scheduler's tick statistics.
+
+The session is run twice: once for timing, and once with tracemalloc
+switched on for the allocation figures, so the tracing doesn't skew the timings.
+Allocations are the peak of traced memory above the start of each stage.
+Floats and small tuples come from CPython's free lists and don't show up,
+which matches the saber, where floats don't allocate. The host stand-ins'
+own bookkeeping (e.g. the level write counters of the mixer stage) does show up.
+
+With --zero-alloc the benchmark fails if any of the given stages allocates
+in steady state, i.e. on more than the first few ticks, where CPython
+still warms up its free lists. For example --zero-alloc dsp checks that
+the SmoothSwing path doesn't allocate. Only the dsp stage can be checked
+like this: the imu stage that feeds it handles tick counts, ints that
+CPython allocates above 256 and the saber doesn't, and the stand-in for
+the motion sensor builds its FIFO out of tuples and lists, so the imu
+stage allocates on the host whatever the saber's code does.
+
+With --profiles the first profile of the config is repeated to make a
+config with that many profiles, to see what a large config costs.
+--flicker sets the flicker of every profile, to see what per-pixel
+flicker costs, e.g. with --blade-pixels 288 for two 144 pixel strips.
+
+With --telemetry every profile has "telemetry" on, so the session runs
+with the runtime telemetry (see pythosaber.telemetry) counting and writing
+its frames, to see what it costs. Its work at each mark is counted in
+the stage after the mark, and the millisecond counts it keeps are ints
+that CPython allocates above 256 and the saber doesn't, so they show up
+in the allocations of every stage. tools/telemetry.py records and decodes
+the captures.
+
+With --tasks the session runs on the asyncio task runtime instead of the
+single loop, and the statistics of each task are reported. The stage
+timings and allocations are only measured for the loop.
+
+Usage:
+    python tools/bench.py [--seconds 20] [--blade-pixels 54] [--config main/config.json]
+                          [--profiles N] [--flicker 0.2] [--zero-alloc dsp[,stage...]] [--tasks]
+                          [--telemetry]
+'''
+import argparse
+import contextlib
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber import hal
+from pythosaber.host import write_font
+from pythosaber.lightsaber import Lightsaber
+from pythosaber.probe import Probe, STAGE_NAMES, STAGE_COUNT
+
+# Scripted session, in seconds of device time
+IGNITE_AT = 2.0
+SWING_START = 3.0
+SWING_END = 13.0
+RETRACT_AT = 14.0
+PROFILE_AT = 16.5
+PRESS_LENGTH = 0.08
+
+SWING_AMPLITUDE = 6.0  # rad/s
+SWING_FREQUENCY = 0.5  # Hz
+
+# Clashes: a short spike of acceleration along x
+CLASH_TIMES = (6.0, 10.0)
+CLASH_PEAK = 80.0  # m/s^2
+CLASH_LENGTH = 0.005  # s
+
+# Ticks a zero allocation stage may allocate on while CPython fills its float free list
+WARMUP_TICKS = 10
+
+
+def swing_gyro(t):
+    '''
+    Back and forth swinging around the y-axis between SWING_START and SWING_END.
+    '''
+    if SWING_START <= t < SWING_END:
+        w = SWING_AMPLITUDE * math.sin(2 * math.pi * SWING_FREQUENCY * (t - SWING_START))
+        return (0.0, w, 0.0)
+    return (0.0, 0.0, 0.0)
+
+def clash_accel(t):
+    '''
+    Lying still, except for the spikes of the clashes.
+    '''
+    for start in CLASH_TIMES:
+        if start <= t < start + CLASH_LENGTH:
+            return (CLASH_PEAK, 0.0, 9.80665)
+    return (0.0, 0.0, 9.80665)
+
+
+class TimingProbe(Probe):
+    '''
+    Attributes the time between marks to the stages,
+    and optionally the memory allocated during each tick.
+    '''
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.ticks = 0
+        self.stage_time = [0.0] * STAGE_COUNT
+        # Kept in arrays, so that storing a reading doesn't allocate an int that would be counted
+        self.stage_alloc = array('q', [0] * STAGE_COUNT)
+        self.stage_alloc_ticks = array('q', [0] * STAGE_COUNT)
+        self.stage_base = array('q', [0])
+        self.alloc_peak_total = 0
+        self.alloc_peak_max = 0
+        self.alloc_net_total = 0
+        self.mem_start = 0
+        self.last = 0.0
+
+    def begin(self):
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            self.mem_start = tracemalloc.get_traced_memory()[0]
+            self.stage_base[0] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stage_time[stage] += now - self.last
+        self.last = now
+        if self.track_memory:
+            self.stage_base[0] = tracemalloc.get_traced_memory()[1] - self.stage_base[0]
+            if self.stage_base[0]:
+                self.stage_alloc[stage] += self.stage_base[0]
+                self.stage_alloc_ticks[stage] += 1
+            tracemalloc.reset_peak()
+            self.stage_base[0] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+    def end(self):
+        self.ticks += 1
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak -= self.mem_start
+            self.alloc_peak_total += peak
+            self.alloc_peak_max = max(self.alloc_peak_max, peak)
+            self.alloc_net_total += current - self.mem_start
+
+
+def write_config(source, path, profiles=0, flicker=None, telemetry=False):
+    '''
+    Copies the config to path, repeating its first profile until it has the given number of profiles,
+    and setting the flicker of every profile if given and switching their telemetry on if asked.
+    '''
+    if profiles <= 0 and flicker is None and not telemetry:
+        shutil.copy(source, path)
+        return
+    with open(source) as f:
+        config = json.load(f)
+    name, settings = next(iter(config["profiles"].items()))
+    for i in range(len(config["profiles"]), profiles):
+        config["profiles"][f'{name}_{i + 1}'] = dict(settings)
+    if flicker is not None:
+        for settings in config["profiles"].values():
+            settings["flicker"] = flicker
+    if telemetry:
+        for settings in config["profiles"].values():
+            settings["telemetry"] = True
+    with open(path, "w") as f:
+        json.dump(config, f, separators=(", ", ":  "))
+
+
+def write_fonts(sd_root):
+    '''
+    Writes a soundfont of silent sounds for every profile of the config in sd_root.
+    '''
+    with open(os.path.join(sd_root, "config.json")) as f:
+        config = json.load(f)
+    for name in config["profiles"]:
+        write_font(sd_root + "/sounds/" + name)
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    '''
+    Sends what's printed to nowhere unless verbose, e.g. the saber's own output.
+    '''
+    if verbose:
+        yield
+        return
+    output = open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(output):
+            yield
+    finally:
+        output.close()
+
+
+def boot_saber(config, sd_root, verbose, profiles=0, overrides=None, profile_overrides=None, **device_args):
+    '''
+    Writes the config, repeating its first profile to the given number of profiles,
+    and the soundfonts to sd_root, and boots a Lightsaber from them on the host
+    backend on a virtual clock. overrides are set in the config, profile_overrides
+    in every profile of it, and device_args go to the HostDevice, e.g. the scripted presses.
+    Returns the saber, its device is saber.device.
+    '''
+    path = os.path.join(sd_root, "config.json")
+    write_config(config, path, profiles)
+    if overrides or profile_overrides:
+        with open(path) as f:
+            settings = json.load(f)
+        settings.update(overrides or {})
+        for profile in settings["profiles"].values():
+            profile.update(profile_overrides or {})
+        with open(path, "w") as f:
+            json.dump(settings, f)
+    write_fonts(sd_root)
+    device = hal.create(hal.BACKEND_HOST, sd_root=sd_root, realtime=False, **device_args)
+    saber = Lightsaber(device)
+    with quiet(verbose):
+        saber.boot()
+    return saber
+
+
+def run_session(config, seconds, blade_pixels, track_memory, verbose, profiles=0, flicker=None,
+                telemetry=False):
+    '''
+    Runs one scripted session and returns the probe and the saber.
+    '''
+    with tempfile.TemporaryDirectory() as sd_root:
+        write_config(config, os.path.join(sd_root, "config.json"), profiles, flicker, telemetry)
+        write_fonts(sd_root)
+        device = hal.create(
+            hal.BACKEND_HOST,
+            sd_root=sd_root,
+            blade_pixels=blade_pixels,
+            gyro=swing_gyro,
+            accel=clash_accel,
+            presses_main=((IGNITE_AT, IGNITE_AT + PRESS_LENGTH),
+                          (RETRACT_AT, RETRACT_AT + PRESS_LENGTH)),
+            presses_aux=((PROFILE_AT, PROFILE_AT + PRESS_LENGTH),),
+            )
+        probe = TimingProbe(track_memory)
+        with quiet(verbose):
+            saber = Lightsaber(device, probe)
+            saber.boot()
+            if track_memory:
+                tracemalloc.start()
+            try:
+                saber.run(until=seconds)
+            finally:
+                if track_memory:
+                    tracemalloc.stop()
+                if saber.telemetry is not None:
+                    saber.telemetry.stop()
+    return probe, saber
+
+
+def run_tasks_session(config, seconds, blade_pixels, verbose, profiles=0, flicker=None):
+    '''
+    Runs the scripted session on the task runtime and returns the saber.
+    '''
+    with tempfile.TemporaryDirectory() as sd_root:
+        write_config(config, os.path.join(sd_root, "config.json"), profiles, flicker)
+        write_fonts(sd_root)
+        device = hal.create(
+            hal.BACKEND_HOST,
+            sd_root=sd_root,
+            blade_pixels=blade_pixels,
+            gyro=swing_gyro,
+            accel=clash_accel,
+            presses_main=((IGNITE_AT, IGNITE_AT + PRESS_LENGTH),
+                          (RETRACT_AT, RETRACT_AT + PRESS_LENGTH)),
+            presses_aux=((PROFILE_AT, PROFILE_AT + PRESS_LENGTH),),
+            )
+        start = time.perf_counter()
+        with quiet(verbose):
+            saber = Lightsaber(device)
+            saber.boot()
+            saber.run_tasks(until=seconds)
+        work = time.perf_counter() - start
+    return saber, work
+
+
+def report_levels(saber):
+    '''
+    Prints the mixer level writes made by the session, and how many of them changed a level.
+    '''
+    device = saber.device
+    writes = 0
+    changes = 0
+    for mixer in (device.main_mixer, device.swing_mixer):
+        for voice in mixer.voice:
+            writes += voice.level_writes
+            changes += voice.level_changes
+    print(f'mixer level writes:   {writes}, {changes} of them changes')
+    voices = saber.voices
+    print(f'effect voices:        {voices.limit}, peak {voices.peak} in use, '
+          f'{voices.plays} plays, {voices.steals} steals')
+    cache = saber.sample_cache
+    print(f'sample cache:         {cache.used} of {cache.budget} bytes, '
+          f'cached {", ".join(cache.samples) or "nothing"}, streamed {", ".join(cache.streamed) or "nothing"}')
+    print(f'effect start:         min {voices.latency_us_min} us, max {voices.latency_us_max} us, '
+          f'voice.play() only, not trigger to audio')
+
+
+def report_tasks(saber, work, seconds):
+    device = saber.device
+    runtime = saber.runtime
+    print(f'Pythosaber task runtime benchmark ({device.backend} backend, {device.blade_pixels} pixels)')
+    print(f'device time:        {seconds:.1f} s, {work * 1000:.1f} ms of work')
+    renderer = saber.animator.renderer
+    print(f'blade frames:       {renderer.frames} drawn, {renderer.shows} shown')
+    print(f'clashes:            {saber.clash_detector.clashes} of '
+          f'{sum(1 for t in CLASH_TIMES if t < seconds)} detected')
+    print(f'profile:            {saber.active_profile}, soundfont swaps {saber.fonts.swaps}')
+    report_levels(saber)
+    print()
+    runtime.dump()
+    saber.memory.dump()
+
+
+def report(probe, saber, memory_probe, seconds):
+    device = saber.device
+    work = sum(probe.stage_time) - probe.stage_time[STAGE_NAMES.index("sleep")]
+    ticks = probe.ticks
+    print(f'Pythosaber main loop benchmark ({device.backend} backend, {device.blade_pixels} pixels)')
+    print(f'ticks:              {ticks}')
+    print(f'device time:        {seconds:.1f} s ({ticks / seconds:.1f} ticks/sec with sleeps)')
+    print(f'work time:          {work * 1000:.1f} ms ({ticks / work:.0f} ticks/sec of work)')
+    timer = saber.boot_timer
+    phases = ', '.join(f'{name} {ms:.0f}' for name, ms in timer.phases)
+    print(f'boot:               ready in {timer.total_ms():.0f} ms ({phases} ms)')
+    print()
+    mticks = memory_probe.ticks
+    print(f'{"stage":<10}{"total ms":>12}{"us/tick":>12}{"share":>9}{"B/tick":>10}')
+    for stage, name in enumerate(STAGE_NAMES):
+        if name == "sleep":
+            continue
+        total = probe.stage_time[stage]
+        alloc = memory_probe.stage_alloc[stage] / mticks
+        print(f'{name:<10}{total * 1000:>12.2f}{total * 1e6 / ticks:>12.1f}{100 * total / work:>8.1f}%{alloc:>10.1f}')
+    print()
+    print(f'allocated bytes/tick: mean {memory_probe.alloc_peak_total / mticks:.0f}, '
+          f'max {memory_probe.alloc_peak_max}')
+    print(f'retained bytes/tick:  mean {memory_probe.alloc_net_total / mticks:.1f}')
+    print()
+    renderer = saber.animator.renderer
+    led_time = probe.stage_time[STAGE_NAMES.index("led")]
+    print(f'blade frames:         {renderer.frames} drawn, {renderer.shows} shown, '
+          f'{led_time * 1e6 / max(1, renderer.frames):.1f} us/frame of led stage')
+    clashes = saber.clash_detector
+    expected = sum(1 for t in CLASH_TIMES if t < seconds)
+    latency = ''
+    if clashes.clashes:
+        # The last clash flashed the blade
+        latency = f', {saber.animator.flash_start - CLASH_TIMES[expected - 1] * 1000:.0f} ms to the last flash'
+    print(f'clashes:              {clashes.clashes} of {expected} detected, '
+          f'{clashes.reads} status reads{latency}')
+    report_levels(saber)
+    telemetry = saber.telemetry
+    if telemetry is not None and telemetry.frames:
+        print(f'telemetry:            {telemetry.frames} frames in {telemetry.writes} writes, '
+              f'last write {telemetry.flush_ms} ms, {telemetry.dropped_total} dropped')
+    print()
+    saber.scheduler.dump()
+    saber.memory.dump()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--seconds', type=float, default=20.0,
+                        help='device time to run the session for')
+    parser.add_argument('--blade-pixels', type=int, default=hal.BLADE_PIXELS)
+    parser.add_argument('--config', default=os.path.join(ROOT, "main", "config.json"))
+    parser.add_argument('--profiles', type=int, default=0,
+                        help='number of profiles to repeat the first profile of the config to')
+    parser.add_argument('--flicker', type=float, default=None,
+                        help='flicker of every profile, from 0 to 1')
+    parser.add_argument('--verbose', action='store_true', help="show the saber's own output")
+    parser.add_argument('--zero-alloc', default='',
+                        help='comma separated stages that must not allocate, e.g. dsp')
+    parser.add_argument('--tasks', action='store_true', help='run on the asyncio task runtime')
+    parser.add_argument('--telemetry', action='store_true', help='run with the runtime telemetry on')
+    args = parser.parse_args(argv)
+
+    if args.tasks:
+        saber, work = run_tasks_session(args.config, args.seconds, args.blade_pixels, args.verbose,
+                                        args.profiles, args.flicker)
+        report_tasks(saber, work, args.seconds)
+        return 0
+
+    probe, saber = run_session(args.config, args.seconds, args.blade_pixels, False, args.verbose,
+                               args.profiles, args.flicker, args.telemetry)
+    memory_probe, _ = run_session(args.config, args.seconds, args.blade_pixels, True, False,
+                                  args.profiles, args.flicker, args.telemetry)
+    report(probe, saber, memory_probe, args.seconds)
+
+    failed = False
+    for name in filter(None, args.zero_alloc.split(',')):
+        stage = STAGE_NAMES.index(name)
+        allocating_ticks = memory_probe.stage_alloc_ticks[stage]
+        if allocating_ticks > WARMUP_TICKS:
+            print(f'FAIL: stage {name} allocated {memory_probe.stage_alloc[stage]} bytes '
+                  f'on {allocating_ticks} ticks')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
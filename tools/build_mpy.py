@@ -0,0 +1,99 @@
+'''
+Precompiled firmware build.
+
+CircuitPython compiles every .py module to bytecode as it's imported, on
+every power-up, which takes time and needs heap for the compiler on top of
+the code itself. mpy-cross compiles them on the computer instead, into .mpy
+files that the saber loads as they are.
+
+Builds the files for the CIRCUITPY drive in OUT: code.py as it is, since
+CircuitPython only runs code.py from source and it's small, the pythosaber
+package compiled to .mpy, less the modules that only run on a computer,
+and the libraries of main/lib. Copy them to the drive, and delete the
+.py files of the pythosaber folder on it first: CircuitPython imports a .py
+rather than the .mpy next to it.
+
+mpy-cross has to be the one for the saber's CircuitPython version, see
+https://adafruit-circuit-python.s3.amazonaws.com/index.html?prefix=bin/mpy-cross/
+Fails if it's missing or a module doesn't compile.
+
+Usage:
+    python tools/build_mpy.py [--mpy-cross PATH] [--out build/CIRCUITPY]
+'''
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main")
+
+# Modules of the package that are never imported on the saber
+HOST_MODULES = ("host.py",)
+
+
+def compile_module(mpy_cross, source, target):
+    '''
+    Compiles one module, with the path on the saber in its tracebacks.
+    Returns mpy-cross's error output, or None if it compiled.
+    '''
+    name = os.path.relpath(source, MAIN).replace(os.sep, "/")
+    result = subprocess.run([mpy_cross, "-s", name, "-o", target, source],
+                            capture_output=True, text=True)
+    if result.returncode:
+        return result.stderr.strip() or result.stdout.strip()
+    return None
+
+def build(mpy_cross, out):
+    '''
+    Builds the drive's files in out. Returns the number of modules that failed.
+    '''
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    package = os.path.join(out, "pythosaber")
+    os.makedirs(package)
+    shutil.copy(os.path.join(MAIN, "code.py"), out)
+    shutil.copytree(os.path.join(MAIN, "lib"), os.path.join(out, "lib"))
+
+    failed = 0
+    source_size = 0
+    mpy_size = 0
+    for name in sorted(os.listdir(os.path.join(MAIN, "pythosaber"))):
+        if not name.endswith(".py") or name in HOST_MODULES:
+            continue
+        source = os.path.join(MAIN, "pythosaber", name)
+        target = os.path.join(package, name[:-3] + ".mpy")
+        error = compile_module(mpy_cross, source, target)
+        if error is not None:
+            print(f'FAIL: {name}: {error}')
+            failed += 1
+            continue
+        source_size += os.path.getsize(source)
+        mpy_size += os.path.getsize(target)
+        print(f'{name:<16}{os.path.getsize(source):>8}{os.path.getsize(target):>8}')
+    print(f'{"total":<16}{source_size:>8}{mpy_size:>8} bytes')
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--mpy-cross', default='mpy-cross', help='the mpy-cross executable')
+    parser.add_argument('--out', default=os.path.join(ROOT, "build", "CIRCUITPY"))
+    args = parser.parse_args(argv)
+
+    mpy_cross = shutil.which(args.mpy_cross)
+    if mpy_cross is None:
+        print(f'FAIL: {args.mpy_cross} not found, get the one for your CircuitPython version')
+        return 1
+    version = subprocess.run([mpy_cross, "--version"], capture_output=True, text=True).stdout.strip()
+    print(version)
+    print(f'{"module":<16}{".py":>8}{".mpy":>8}')
+    failed = build(mpy_cross, args.out)
+    if failed:
+        return 1
+    print(f'Built {args.out}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
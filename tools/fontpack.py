@@ -0,0 +1,515 @@
+'''
+Soundfont packer.
+
+Converts a library of Proffie soundfonts into what the saber plays: every
+.wav file of every font is downmixed to mono, resampled to 22050 Hz and
+written as 16-bit signed PCM, the format the mixers are made in. The fonts
+are processed in parallel, one font per CPU core, each file read through a
+memory map. The loudness and peaks are measured a chunk of CHUNK_FRAMES at a
+time, and a font is then converted and written a file at a time, so a library
+of hundreds of fonts converts with no more than one decoded file per core
+in memory.
+
+On the way each font is:
+    normalised  every sound of the font is scaled by the same gain, which
+                brings its hum to the target loudness, the median hum of
+                the library unless --target-db is given. The loudness is
+                the RMS of 400 ms blocks, gated like EBU R128 but without
+                its weighting filter. The gain is lowered if a peak of the
+                font would clip, with a warning that its hum is then quieter
+    trimmed     the one-shot sounds lose the silence before and after them,
+                so a clash sounds when it's triggered
+    looped      hum, swingh and swingl loop on the saber, their ends are
+                crossfaded into their starts so the loop has no click, and
+                each swingh is cut to the length of its swingl, so a pair
+                stays in step however long it loops
+
+The fonts are written to OUT/sounds/<font>/, in the font's own layout, and
+their indexes to OUT/.fontindex/ (see pythosaber.fontindex), so the saber
+doesn't have to scan them the first time. Copy the contents of OUT to the
+root of the microSD. An index written here is taken as it is on the first
+load and saved again with the card's folder times.
+
+Commands:
+    pack    converts the fonts in the subfolders of LIBRARY, fails if
+            a file can't be read or the saber's index of a converted font
+            doesn't list every file written
+    synth   writes a library of synthetic fonts, tones and noise in
+            assorted formats and levels, to try the packer on
+
+Usage:
+    python tools/fontpack.py pack LIBRARY OUT [--jobs N] [--target-db -20] [--silence-db -60]
+                                              [--loop-fade-ms 20] [--sd-root /sd]
+    python tools/fontpack.py synth LIBRARY [--fonts 4]
+'''
+import argparse
+import concurrent.futures
+import math
+import os
+import shutil
+import struct
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber.fontindex import FontIndex, INDEX_FOLDER, WAVE_FORMAT_PCM, split_name
+from pythosaber.hal import SAMPLE_RATE, CHANNEL_COUNT, BITS_PER_SAMPLE
+from pythosaber.soundfont import PAIRED_SOUNDS
+
+WAVE_FORMAT_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sounds that loop on the saber, by their Proffie names
+LOOPED_SOUNDS = ("hum", "swingh", "swingl")
+
+# Loudness: block length, absolute gate and gate below the mean of the blocks above it
+BLOCK_SECONDS = 0.4
+ABSOLUTE_GATE_DB = -70.0
+RELATIVE_GATE_DB = -10.0
+
+# Highest peak after the gain, just under full scale
+PEAK_LIMIT = 0.98
+
+# Default level below which the ends of one-shot sounds are silence
+SILENCE_DB = -60.0
+# Kept before and after the sound when trimming, and faded out at the end
+TRIM_PAD_MS = 5
+
+# Default length of the crossfade of a looped sound's end into its start
+LOOP_FADE_MS = 20
+
+# Taps of the resampling low-pass filter
+FILTER_TAPS = 127
+
+# Frames decoded at a time when measuring
+CHUNK_FRAMES = 1 << 16
+
+
+def db(value):
+    return 20 * math.log10(value) if value > 0 else -math.inf
+
+def read_wav(path):
+    '''
+    Memory maps the samples of a .wav file, PCM of 8 to 32 bits or 32-bit float.
+    Returns (sample rate, array of frames by channels, bits, format).
+    '''
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError(f'{path} is not a .wav file')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{path} has no data chunk')
+            chunk, size = struct.unpack("<4sI", header)
+            if chunk == b"fmt ":
+                fmt = f.read(size + (size & 1))
+            elif chunk == b"data":
+                offset = f.tell()
+                size = min(size, os.path.getsize(path) - offset)
+                break
+            else:
+                f.seek(size + (size & 1), 1)
+    if fmt is None:
+        raise ValueError(f'{path} has no format chunk')
+    format_tag, channels, rate, _, block_align, bits = struct.unpack_from("<HHIIHH", fmt)
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        format_tag = struct.unpack_from("<H", fmt, 24)[0]
+    width = block_align // channels
+    frames = size // block_align
+    if format_tag == WAVE_FORMAT_FLOAT and width == 4:
+        dtype = "<f4"
+    elif format_tag == WAVE_FORMAT_PCM and width in (1, 2, 3, 4):
+        dtype = ("u1", "<i2", "u1", "<i4")[width - 1]
+    else:
+        raise ValueError(f'{path}: format {format_tag} with {bits} bits is not supported')
+    if not frames:
+        return rate, np.zeros((0, channels), np.float32), bits, format_tag
+    if width == 3:
+        data = np.memmap(path, np.uint8, "r", offset, (frames, channels, 3))
+    else:
+        data = np.memmap(path, dtype, "r", offset, (frames, channels))
+    return rate, data, bits, format_tag
+
+def to_mono(data):
+    '''
+    The mean of the channels as floats from -1 to 1.
+    '''
+    if data.dtype == np.uint8 and data.ndim == 3:
+        # 24-bit, assembled into the top of an int32
+        samples = (data[..., 0].astype(np.int32) << 8 | data[..., 1].astype(np.int32) << 16
+                   | data[..., 2].astype(np.int32) << 24).astype(np.float32) / 2 ** 31
+    elif data.dtype == np.uint8:
+        samples = (data.astype(np.float32) - 128) / 128
+    elif data.dtype.kind == "f":
+        samples = np.asarray(data, np.float32)
+    else:
+        samples = data.astype(np.float32) / float(2 ** (8 * data.dtype.itemsize - 1))
+    return samples.mean(axis=1)
+
+def lowpass(cutoff, taps=FILTER_TAPS):
+    '''
+    Windowed sinc low-pass filter, cutoff as a fraction of the sample rate.
+    '''
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(taps)
+    return (h / h.sum()).astype(np.float32)
+
+def resampled_length(frames, rate, target=SAMPLE_RATE):
+    '''
+    Number of samples resample() makes of frames at rate.
+    '''
+    if rate == target or not frames:
+        return frames
+    return max(1, int(round(frames * target / rate)))
+
+def resample(samples, rate, target=SAMPLE_RATE):
+    '''
+    Resamples to the target rate, low-pass filtered first when going down.
+    '''
+    if rate == target or not len(samples):
+        return samples
+    ratio = target / rate
+    if ratio < 1:
+        samples = np.convolve(samples, lowpass(0.45 * ratio), mode="same")
+    positions = np.arange(resampled_length(len(samples), rate, target)) / ratio
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def measure(data, rate, blocks=False):
+    '''
+    Peak of a memory mapped sound and, with blocks, the power of each of its
+    400 ms blocks, decoded a chunk at a time. A sound shorter than a block is one block.
+    Returns (peak, array of block powers).
+    '''
+    block = max(1, int(rate * BLOCK_SECONDS))
+    step = block * max(1, CHUNK_FRAMES // block)
+    peak = 0.0
+    powers = []
+    for start in range(0, len(data), step):
+        samples = to_mono(data[start:start + step])
+        peak = max(peak, float(np.abs(samples).max()))
+        if not blocks:
+            continue
+        count = len(samples) // block
+        if count:
+            powers.append(np.mean(samples[:count * block].reshape(count, block).astype(np.float64) ** 2, axis=1))
+        elif not start:
+            powers.append(np.array([np.mean(samples.astype(np.float64) ** 2)]))
+    return peak, np.concatenate(powers) if powers else np.zeros(0)
+
+def loudness(power):
+    '''
+    Gated RMS loudness in dBFS of block powers, -inf for silence.
+    '''
+    power = power[power > 10 ** (ABSOLUTE_GATE_DB / 10)]
+    if not len(power):
+        return -math.inf
+    power = power[power > power.mean() * 10 ** (RELATIVE_GATE_DB / 10)]
+    return 10 * math.log10(power.mean())
+
+def trim(samples, silence, pad):
+    '''
+    Cuts the silence before and after a sound, leaving pad samples of it on
+    both ends and fading out over the pad at the end. Silence is left as it is.
+    '''
+    loud = np.flatnonzero(np.abs(samples) > silence)
+    if not len(loud):
+        return samples
+    start = max(0, loud[0] - pad)
+    end = min(len(samples), loud[-1] + 1 + pad)
+    samples = samples[start:end].copy()
+    fade = min(pad, len(samples))
+    if fade:
+        samples[-fade:] *= np.linspace(1, 0, fade, dtype=np.float32)
+    return samples
+
+def make_loop(samples, fade):
+    '''
+    Crossfades the last fade samples into the first ones and drops them, so
+    the sound runs on from its end into its start as it did into its tail.
+    '''
+    fade = min(fade, len(samples) // 4)
+    if fade < 2:
+        return samples
+    ramp = np.arange(fade, dtype=np.float32) / fade
+    looped = samples[:-fade].copy()
+    looped[:fade] = samples[:fade] * ramp + samples[-fade:] * (1 - ramp)
+    return looped
+
+def write_wav(path, samples):
+    '''
+    Writes samples from -1 to 1 as a 16-bit mono PCM .wav file.
+    '''
+    data = np.clip(np.round(samples * 32767), -32768, 32767).astype("<i2")
+    byte_rate = SAMPLE_RATE * CHANNEL_COUNT * BITS_PER_SAMPLE // 8
+    block_align = CHANNEL_COUNT * BITS_PER_SAMPLE // 8
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data.nbytes, b"WAVE",
+                            b"fmt ", 16, WAVE_FORMAT_PCM, CHANNEL_COUNT, SAMPLE_RATE,
+                            byte_rate, block_align, BITS_PER_SAMPLE, b"data", data.nbytes))
+        data.tofile(f)
+
+def font_files(font):
+    '''
+    The .wav files of a font folder as (path relative to it, sound, variant number),
+    by the same rules as the saber's index: files in a folder belong to the sound
+    the folder is named after.
+    '''
+    files = []
+    for name in sorted(os.listdir(font)):
+        if name.startswith("."):
+            continue
+        path = os.path.join(font, name)
+        if os.path.isdir(path):
+            for inner in sorted(os.listdir(path)):
+                parts = split_name(inner)
+                if parts is not None:
+                    files.append((name + "/" + inner, name.lower(), parts[1]))
+        else:
+            parts = split_name(name)
+            if parts is not None and parts[0]:
+                files.append((name, parts[0], parts[1]))
+    return files
+
+def measure_font(font):
+    '''
+    The loudness of a font's hum and the highest peak of its sounds.
+    Returns (name, hum loudness in dBFS or None, peak, files, seconds, errors).
+    '''
+    hums = []
+    peak = 0.0
+    seconds = 0.0
+    errors = []
+    files = font_files(font)
+    for file, sound, _ in files:
+        try:
+            rate, data, _, _ = read_wav(os.path.join(font, file))
+            file_peak, power = measure(data, rate, sound == "hum")
+        except (OSError, ValueError, struct.error) as e:
+            errors.append(f'{file}: {e}')
+            continue
+        seconds += len(data) / rate
+        peak = max(peak, file_peak)
+        if sound == "hum":
+            hums.append(loudness(power))
+    hums = [hum for hum in hums if hum > -math.inf]
+    hum = float(np.mean(hums)) if hums else None
+    return os.path.basename(font), hum, peak, len(files), seconds, errors
+
+def pack_font(task):
+    '''
+    Converts one font into out with the given gain, a file at a time.
+    Returns (name, files written, seconds, errors).
+    '''
+    font, out, gain, silence_db, loop_fade_ms = task
+    silence = 10 ** (silence_db / 20)
+    pad = SAMPLE_RATE * TRIM_PAD_MS // 1000
+    fade = SAMPLE_RATE * loop_fade_ms // 1000
+    files = font_files(font)
+    errors = []
+
+    # Each swingh as long as the swingl of its pair, from the lengths in the headers
+    lengths = {}
+    for file, sound, number in files:
+        if sound not in PAIRED_SOUNDS:
+            continue
+        try:
+            rate, data, _, _ = read_wav(os.path.join(font, file))
+        except (OSError, ValueError, struct.error):
+            # Reported when it's converted
+            continue
+        length = resampled_length(len(data), rate)
+        lengths[number] = min(lengths.get(number, length), length)
+
+    written = 0
+    seconds = 0.0
+    for file, sound, number in files:
+        try:
+            rate, data, _, _ = read_wav(os.path.join(font, file))
+            samples = resample(to_mono(data), rate) * np.float32(gain)
+        except (OSError, ValueError, struct.error) as e:
+            errors.append(f'{file}: {e}')
+            continue
+        if sound in PAIRED_SOUNDS:
+            samples = samples[:lengths[number]]
+        if sound in LOOPED_SOUNDS:
+            samples = make_loop(samples, fade)
+        else:
+            samples = trim(samples, silence, pad)
+        path = os.path.join(out, os.path.splitext(file)[0] + ".wav")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_wav(path, samples)
+        written += 1
+        seconds += len(samples) / SAMPLE_RATE
+    return os.path.basename(font), written, seconds, errors
+
+def run_all(function, tasks, jobs):
+    '''
+    Maps function over tasks, in worker processes unless jobs is 1.
+    '''
+    if jobs == 1:
+        return [function(task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, tasks))
+
+def write_index(out, name, sd_root):
+    '''
+    Writes the saber's index of a converted font, without a signature so the
+    saber takes it as it is. Returns the number of variants in it.
+    '''
+    index = FontIndex(os.path.join(out, "sounds", name))
+    index.scan()
+    index.path = sd_root + "/sounds/" + name
+    index.signature = None
+    folder = out + INDEX_FOLDER
+    os.makedirs(folder, exist_ok=True)
+    index.save(os.path.join(folder, name + ".json"))
+    return sum(index.count(sound) for sound in index.sounds)
+
+def command_pack(args):
+    library = args.library
+    fonts = [os.path.join(library, name) for name in sorted(os.listdir(library))
+             if not name.startswith(".") and os.path.isdir(os.path.join(library, name))]
+    if not fonts:
+        print(f'FAIL: no fonts in {library}')
+        return 1
+    jobs = args.jobs or os.cpu_count() or 1
+    print(f'{len(fonts)} fonts, {jobs} jobs')
+
+    measured = run_all(measure_font, fonts, jobs)
+    hums = [hum for _, hum, _, _, _, _ in measured if hum is not None]
+    target = args.target_db
+    if target is None:
+        target = float(np.median(hums)) if hums else 0.0
+    print(f'Target hum loudness {target:.1f} dBFS')
+
+    tasks = []
+    gains = {}
+    for (name, hum, peak, _, _, _), font in zip(measured, fonts):
+        gain_db = target - hum if hum is not None else 0.0
+        limit_db = db(PEAK_LIMIT / peak) if peak > 0 else math.inf
+        gains[name] = (hum, gain_db, min(gain_db, limit_db), gain_db > limit_db)
+        gain = 10 ** (min(gain_db, limit_db) / 20)
+        tasks.append((font, os.path.join(args.out, "sounds", name), gain, args.silence_db, args.loop_fade_ms))
+    out_sounds = os.path.join(args.out, "sounds")
+    for name in gains:
+        if os.path.exists(os.path.join(out_sounds, name)):
+            shutil.rmtree(os.path.join(out_sounds, name))
+    packed = run_all(pack_font, tasks, jobs)
+
+    failed = False
+    print(f'{"font":<24}{"files":>6}{"in s":>8}{"out s":>8}{"hum dB":>8}{"gain dB":>9}')
+    for (name, _, _, _, seconds_in, measure_errors), (_, files, seconds_out, errors) in zip(measured, packed):
+        hum, _, gain_db, limited = gains[name]
+        hum_text = f'{hum:.1f}' if hum is not None else '-'
+        print(f'{name:<24}{files:>6}{seconds_in:>8.1f}{seconds_out:>8.1f}{hum_text:>8}'
+              f'{gain_db:>+9.1f}{" (peak limited)" if limited else ""}')
+        if limited and hum is not None:
+            print(f'WARNING: {name}: a peak limits the gain, its hum is at {hum + gain_db:.1f} dBFS '
+                  f'rather than {target:.1f} dBFS')
+        for error in measure_errors or errors:
+            print(f'FAIL: {name}/{error}')
+            failed = True
+        indexed = write_index(args.out, name, args.sd_root)
+        if indexed != files:
+            print(f'FAIL: {name}: the index lists {indexed} of {files} files')
+            failed = True
+    if not failed:
+        print(f'Packed into {args.out}, copy its contents to the microSD')
+    return 1 if failed else 0
+
+def synth_tone(rate, seconds, frequency, level, noise=0.0, seed=0):
+    '''
+    A tone with a little vibrato and noise, as floats.
+    '''
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(rate * seconds)) / rate
+    phase = 2 * np.pi * frequency * (t + 0.002 * np.sin(2 * np.pi * 3 * t))
+    return (level * (np.sin(phase) + noise * rng.standard_normal(len(t)))).astype(np.float32)
+
+def write_synth_wav(path, samples, rate, channels, form):
+    '''
+    Writes a synthetic sound in one of the formats "int16", "int24" or "float32".
+    '''
+    frames = np.repeat(samples[:, None], channels, axis=1)
+    if form == "float32":
+        data = frames.astype("<f4").tobytes()
+        tag, bits = WAVE_FORMAT_FLOAT, 32
+    elif form == "int24":
+        ints = np.clip(np.round(frames * 2 ** 23), -2 ** 23, 2 ** 23 - 1).astype("<i4")
+        data = ints.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+        tag, bits = WAVE_FORMAT_PCM, 24
+    else:
+        data = np.clip(np.round(frames * 32767), -32768, 32767).astype("<i2").tobytes()
+        tag, bits = WAVE_FORMAT_PCM, 16
+    block_align = channels * bits // 8
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + len(data), b"WAVE",
+                            b"fmt ", 16, tag, channels, rate, rate * block_align, block_align, bits,
+                            b"data", len(data)))
+        f.write(data)
+
+# Synthetic fonts: sample rate, channels, format and hum level of each
+SYNTH_FORMATS = (
+    (44100, 2, "int16", 0.3),
+    (48000, 1, "int24", 0.1),
+    (32000, 2, "float32", 0.5),
+    (22050, 1, "int16", 0.2),
+    )
+
+def command_synth(args):
+    for i in range(args.fonts):
+        rate, channels, form, level = SYNTH_FORMATS[i % len(SYNTH_FORMATS)]
+        font = os.path.join(args.library, f'font{i + 1}')
+        silence = np.zeros(int(rate * 0.2), np.float32)
+        sounds = {
+            "font.wav": synth_tone(rate, 1.0, 440, level),
+            "hum.wav": synth_tone(rate, 2.0, 97.3, level, 0.05, i),
+            "out/out1.wav": synth_tone(rate, 1.2, 220, level * 2),
+            "in/in1.wav": synth_tone(rate, 1.0, 180, level * 2),
+            }
+        for n in range(1, 4):
+            # Clashes start and end with silence, the loudest ones limit the gain
+            clash = synth_tone(rate, 0.3, 600 + 100 * n, min(1.0, level * (1 + n)), 0.3, n)
+            sounds[f'clsh{n}.wav'] = np.concatenate((silence, clash, silence))
+        for n in range(1, 3):
+            sounds[f'swingh/swingh{n}.wav'] = synth_tone(rate, 1.5 + 0.1 * n, 300, level, 0.1, n)
+            sounds[f'swingl/swingl{n}.wav'] = synth_tone(rate, 1.4 + 0.1 * n, 150, level, 0.1, n)
+        for name, samples in sounds.items():
+            write_synth_wav(os.path.join(font, name), samples, rate, channels, form)
+        print(f'{font}: {len(sounds)} sounds, {rate} Hz {form} {channels} channel(s)')
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('pack', help='convert a library of fonts for the microSD')
+    command.add_argument('library', help='folder with a subfolder per font')
+    command.add_argument('out', help='folder to write the sounds and indexes to')
+    command.add_argument('--jobs', type=int, default=0, help='worker processes, one per CPU core by default')
+    command.add_argument('--target-db', type=float, default=None,
+                         help="hum loudness in dBFS, the library's median hum by default")
+    command.add_argument('--silence-db', type=float, default=SILENCE_DB,
+                         help='level below which the ends of one-shot sounds are trimmed')
+    command.add_argument('--loop-fade-ms', type=int, default=LOOP_FADE_MS,
+                         help='crossfade of the end of hum, swingh and swingl into their start')
+    command.add_argument('--sd-root', default="/sd", help='where the microSD is mounted on the saber')
+    command.set_defaults(run=command_pack)
+
+    command = commands.add_parser('synth', help='write a library of synthetic fonts')
+    command.add_argument('library')
+    command.add_argument('--fonts', type=int, default=4)
+    command.set_defaults(run=command_synth)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+'''
+Button gesture check.
+
+Feeds scripted button presses through the host backend's FakeKeys, which
+scans them every KEY_SCAN_INTERVAL like keypad, into ButtonGestures on a
+virtual clock, and compares the gestures it reports, with the time of the
+tick that reported them, to the expected ones:
+
+    click              a short press, the click once the double click window has passed
+    double click       two short presses
+    long press repeat  a held button, a long press every long press time
+    long press edge    a release exactly at the long press time is a click
+    window edge        a second press exactly at the end of the double click window
+                       is a double click
+    past the window    a second press a scan later is a click of its own
+    long then click    a long press doesn't count as the first click of a double click
+    combination        main clicked with aux held consumes aux, like the saber's
+                       telemetry toggle: no long press and no click of aux
+
+The check fails if a scenario gives other gestures, in another order,
+or more than a tick away from the expected time.
+
+Usage:
+    python tools/gesturecheck.py [--tick-ms 10] [--verbose]
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber import hal
+from pythosaber.buttons import (ButtonGestures, CLICK, DOUBLE_CLICK, GESTURE_NAMES, KEY_AUX,
+                                KEY_MAIN, LONG_PRESS, PRESS, RELEASE)
+from pythosaber.hal import KEY_SCAN_INTERVAL
+
+KEY_NAMES = ("main", "aux", "board")
+
+# Scripted presses start and end half a scan before the scan that sees them,
+# so the key events are timestamped at the milliseconds given
+HALF_SCAN = KEY_SCAN_INTERVAL / 2
+# Time run after the last expected gesture, to catch late ones
+AFTER_MS = 1000
+
+
+def press(start_ms, end_ms):
+    '''
+    A scripted press seen by the scans at start_ms and end_ms.
+    '''
+    return (start_ms / 1000 - HALF_SCAN, end_ms / 1000 - HALF_SCAN)
+
+def main_gestures(*gestures):
+    return [(KEY_MAIN, gesture, at) for gesture, at in gestures]
+
+
+# Name, main presses, aux presses, whether a main press consumes a held aux, expected gestures
+SCENARIOS = (
+    ("click", (press(1020, 1120),), (), False,
+     main_gestures((PRESS, 1020), (RELEASE, 1120), (CLICK, 1420))),
+    ("double click", (press(1020, 1120), press(1220, 1320)), (), False,
+     main_gestures((PRESS, 1020), (RELEASE, 1120), (PRESS, 1220), (RELEASE, 1320), (DOUBLE_CLICK, 1320))),
+    ("long press repeat", (press(1020, 2520),), (), False,
+     main_gestures((PRESS, 1020), (LONG_PRESS, 1620), (LONG_PRESS, 2220), (RELEASE, 2520))),
+    ("long press edge", (press(1020, 1620),), (), False,
+     main_gestures((PRESS, 1020), (RELEASE, 1620), (CLICK, 1920))),
+    ("window edge", (press(1020, 1120), press(1420, 1520)), (), False,
+     main_gestures((PRESS, 1020), (RELEASE, 1120), (PRESS, 1420), (RELEASE, 1520), (DOUBLE_CLICK, 1520))),
+    ("past the window", (press(1020, 1120), press(1440, 1540)), (), False,
+     main_gestures((PRESS, 1020), (RELEASE, 1120), (CLICK, 1420), (PRESS, 1440), (RELEASE, 1540),
+                   (CLICK, 1840))),
+    ("long then click", (press(1020, 1820), press(1920, 2020)), (), False,
+     main_gestures((PRESS, 1020), (LONG_PRESS, 1620), (RELEASE, 1820), (PRESS, 1920), (RELEASE, 2020),
+                   (CLICK, 2320))),
+    ("combination", (press(1220, 1320),), (press(1020, 2020),), True,
+     [(KEY_AUX, PRESS, 1020), (KEY_MAIN, PRESS, 1220), (KEY_MAIN, RELEASE, 1320), (KEY_MAIN, CLICK, 1620),
+      (KEY_AUX, RELEASE, 2020)]),
+    )
+
+
+def describe(gestures):
+    return ', '.join(f'{KEY_NAMES[key]} {GESTURE_NAMES[gesture]} at {at}' for key, gesture, at in gestures)
+
+def run_scenario(sd_root, presses_main, presses_aux, combination, until_ms, tick_ms):
+    '''
+    Ticks ButtonGestures every tick_ms until until_ms.
+    Returns the gestures as (key, gesture, ticks_ms of the tick) tuples.
+    '''
+    device = hal.create(hal.BACKEND_HOST, sd_root=sd_root, realtime=False,
+                        presses_main=presses_main, presses_aux=presses_aux)
+    clock = device.clock
+    gestures = ButtonGestures(device)
+    seen = []
+    tick = 0
+    while tick * tick_ms <= until_ms:
+        clock.advance(tick * tick_ms / 1000 - clock.monotonic())
+        gestures.update()
+        now = device.ticks_ms()
+        while gestures.get():
+            key = gestures.key
+            gesture = gestures.gesture
+            seen.append((key, gesture, now))
+            if combination and key == KEY_MAIN and gesture == PRESS and gestures.down[KEY_AUX]:
+                gestures.consume(KEY_AUX)
+        tick += 1
+    return seen
+
+def check(expected, seen, tick_ms):
+    '''
+    Compares the gestures seen to the expected ones. Returns the failures as a list of strings.
+    A gesture may come up to a tick after its time, or a millisecond before it
+    as the clock is read in whole milliseconds.
+    '''
+    failures = []
+    names = [(key, gesture) for key, gesture, _ in seen]
+    if names != [(key, gesture) for key, gesture, _ in expected]:
+        failures.append(f'got {describe(seen)}; expected {describe(expected)}')
+        return failures
+    for (key, gesture, at), (_, _, now) in zip(expected, seen):
+        if not at - 1 <= now <= at + tick_ms:
+            failures.append(f'{KEY_NAMES[key]} {GESTURE_NAMES[gesture]} at {now} ms, expected at {at} ms')
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--tick-ms', type=int, default=10, help='time between updates')
+    parser.add_argument('--verbose', action='store_true', help='show the gestures of every scenario')
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f'Button gesture check, {args.tick_ms} ms ticks, '
+          f'key scan every {KEY_SCAN_INTERVAL * 1000:.0f} ms')
+    with tempfile.TemporaryDirectory() as sd_root:
+        for name, presses_main, presses_aux, combination, expected in SCENARIOS:
+            until_ms = expected[-1][2] + AFTER_MS
+            seen = run_scenario(sd_root, presses_main, presses_aux, combination, until_ms, args.tick_ms)
+            if args.verbose:
+                print(f'  {name}: {describe(seen)}')
+            for failure in check(expected, seen, args.tick_ms):
+                print(f'FAIL: {name}: {failure}')
+                failed = True
+    if not failed:
+        print('OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
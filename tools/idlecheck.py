@@ -0,0 +1,195 @@
+'''
+Idle sleep check.
+
+Runs the real Lightsaber state machine on the host backend, whose
+light_sleep() simulates the pin and time alarms on its virtual clock,
+through a long scripted session in STANDBY: it goes idle, a click of aux
+wakes it up and switches the profile, it goes idle again, a press of main
+wakes it up and ignites the blade, and once the blade is retracted it goes
+idle again.
+
+The check fails if the saber doesn't sleep, if a press doesn't wake it up
+or isn't acted on, if the motion sensor or the audio are on during a sleep,
+if a press takes longer than --max-latency-ms from the wake-up to be acted
+on, or if less than --min-asleep of the session is spent asleep.
+The same session is run without the idle sleep, to compare the number of
+loop ticks, and on the task runtime.
+
+It's run once more with the first FAILED_SLEEPS sleeps failing, having let
+go of the keys, and fails unless the saber tries again after the back-off,
+doubled after each failure, the aux click is acted on in between and the
+sleep after the failures goes through.
+
+Usage:
+    python tools/idlecheck.py [--timeout 5] [--wake-interval 20] [--max-latency-ms 50]
+                              [--min-asleep 0.7] [--config main/config.json] [--verbose]
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from pythosaber.idle import RETRY_MS
+
+import bench
+
+# Scripted session, in seconds of device time
+PROFILE_AT = 30.0
+IGNITE_AT = 50.0
+RETRACT_AT = 55.0
+SESSION_SECONDS = 120.0
+PRESS_LENGTH = 0.08
+FAILED_SLEEPS = 2
+
+
+def fail_sleeps(device, failures):
+    '''
+    Makes the first failures light sleeps of the device fail with the keys let go of.
+    Returns the list the device time of every attempt is added to.
+    '''
+    attempts = []
+    light_sleep = device.light_sleep
+
+    def attempt(seconds):
+        attempts.append(device.monotonic())
+        if len(attempts) <= failures:
+            device.keys = None
+            raise RuntimeError('scripted failure')
+        return light_sleep(seconds)
+
+    device.light_sleep = attempt
+    return attempts
+
+def run_session(config, timeout, wake_interval, tasks, verbose, failed_sleeps=0):
+    '''
+    Runs the session and returns the saber and the failures as a list of strings.
+    With failed_sleeps, that many light sleeps fail first and the attempts are checked.
+    '''
+    failures = []
+    with tempfile.TemporaryDirectory() as sd_root:
+        saber = bench.boot_saber(
+            config,
+            sd_root,
+            verbose,
+            profiles=2,
+            overrides={"idle_timeout": timeout, "idle_wake_interval": wake_interval},
+            presses_main=((IGNITE_AT, IGNITE_AT + PRESS_LENGTH),
+                          (RETRACT_AT, RETRACT_AT + PRESS_LENGTH)),
+            presses_aux=((PROFILE_AT, PROFILE_AT + PRESS_LENGTH),),
+            )
+        device = saber.device
+        # The saber doesn't sleep before its first tick
+        attempts = fail_sleeps(device, failed_sleeps)
+        first_profile = saber.active_profile
+        run = saber.run_tasks if tasks else saber.run
+        with bench.quiet(verbose):
+            run(until=PROFILE_AT - 1)
+            if timeout and not failed_sleeps and not device.light_sleeps:
+                failures.append(f'not asleep {PROFILE_AT - 1:.0f} s into STANDBY')
+            run(until=PROFILE_AT + 1)
+            if saber.active_profile == first_profile:
+                failures.append('the aux click didn\'t switch the profile')
+            run(until=IGNITE_AT + 1)
+            if saber.current_state != "ACTIVE":
+                failures.append(f'not ACTIVE after the main press, {saber.current_state}')
+            run(until=SESSION_SECONDS)
+            if saber.current_state != "STANDBY":
+                failures.append(f'not back in STANDBY, {saber.current_state}')
+        if failed_sleeps:
+            failures += check_attempts(attempts, failed_sleeps, device)
+    return saber, failures
+
+def check_sleeps(saber, max_latency_ms, min_asleep):
+    '''
+    Checks how the saber slept. Returns the failures as a list of strings.
+    '''
+    failures = []
+    idle = saber.idle
+    sleeps = saber.device.light_sleeps
+    woken = [key for _, _, key, _, _ in sleeps if key is not None]
+    if len(woken) != 2:
+        failures.append(f'{len(woken)} button wake-ups, expected 2')
+    for start, _, _, playing, imu_rate in sleeps:
+        if playing:
+            failures.append(f'audio playing in the sleep at {start:.2f} s')
+        if imu_rate:
+            failures.append(f'motion sensor at {imu_rate} Hz in the sleep at {start:.2f} s')
+    if idle.latencies != len(woken):
+        failures.append(f'{idle.latencies} of {len(woken)} wake-up presses acted on')
+    if idle.latency_ms_max > max_latency_ms:
+        failures.append(f'wake latency {idle.latency_ms_max} ms, over {max_latency_ms} ms')
+    if idle.asleep_fraction() < min_asleep:
+        failures.append(f'{100 * idle.asleep_fraction():.1f}% asleep, under {100 * min_asleep:.0f}%')
+    return failures
+
+def check_attempts(attempts, failed_sleeps, device):
+    '''
+    Checks that the failed sleeps were tried again after the back-off and that one
+    went through in the end. Returns the failures as a list of strings.
+    '''
+    failures = []
+    if len(attempts) <= failed_sleeps or not device.light_sleeps:
+        failures.append(f'{len(attempts)} sleeps tried, {len(device.light_sleeps)} slept, '
+                        f'expected one to go through after {failed_sleeps} failures')
+    retry = RETRY_MS / 1000
+    for i in range(1, min(len(attempts), failed_sleeps + 1)):
+        gap = attempts[i] - attempts[i - 1]
+        # The clock is read in whole milliseconds
+        if gap < retry - 0.001:
+            failures.append(f'sleep {i + 1} tried {gap:.1f} s after failure {i}, expected at least {retry:.0f} s')
+        retry *= 2
+    return failures
+
+def ticks(saber):
+    if saber.runtime is not None:
+        runtime = saber.runtime
+        return sum(scheduler.ticks for scheduler in (runtime.motion, runtime.blade, runtime.input, runtime.audio))
+    return saber.scheduler.ticks
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--timeout', type=float, default=5.0, help='idle timeout in seconds')
+    parser.add_argument('--wake-interval', type=float, default=20.0, help='longest sleep in seconds')
+    parser.add_argument('--max-latency-ms', type=int, default=50)
+    parser.add_argument('--min-asleep', type=float, default=0.7, help='least fraction of the time asleep')
+    parser.add_argument('--config', default=os.path.join(ROOT, "main", "config.json"))
+    parser.add_argument('--verbose', action='store_true', help="show the saber's own output")
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f'Idle sleep check, {SESSION_SECONDS:.0f} s session, timeout {args.timeout} s, '
+          f'wake interval {args.wake_interval} s')
+    for tasks in (False, True):
+        name = "task runtime" if tasks else "loop"
+        awake, _ = run_session(args.config, 0, args.wake_interval, tasks, args.verbose)
+        saber, failures = run_session(args.config, args.timeout, args.wake_interval, tasks, args.verbose)
+        failures += check_sleeps(saber, args.max_latency_ms, args.min_asleep)
+        idle = saber.idle
+        print(f'{name}:')
+        print(f'  sleeps:        {idle.sleeps}, {idle.button_wakes} woken by a button')
+        print(f'  asleep:        {100 * idle.asleep_fraction():.1f}% of the time')
+        print(f'  wake latency:  avg {idle.latency_ms_total / max(1, idle.latencies):.1f} ms, '
+              f'max {idle.latency_ms_max} ms')
+        print(f'  ticks:         {ticks(saber)}, {ticks(awake)} without idle sleep')
+        for failure in failures:
+            print(f'FAIL: {name}: {failure}')
+            failed = True
+
+        saber, failures = run_session(args.config, args.timeout, args.wake_interval, tasks, args.verbose,
+                                      FAILED_SLEEPS)
+        idle = saber.idle
+        print(f'  failing sleeps: {idle.failures} failed, then {idle.sleeps} sleeps')
+        for failure in failures:
+            print(f'FAIL: {name}, failing sleeps: {failure}')
+            failed = True
+    if not failed:
+        print('OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,453 @@
+'''
+SmoothSwing trace replay.
+
+Replays motion traces recorded by the saber (see pythosaber.trace, switched on
+with "imu_trace" in config.json) through SmoothSwing on a computer. The swing
+pipeline is run over the whole trace at once with NumPy, step by step the same
+as lowpass_filter(), accumulate_swing_angle(), calculate_swing_strength() and
+do_crossfade(), and gives the mixer levels the saber would have set after
+every sample. The ignition fade isn't modelled, the levels start out as they
+are once the blade is fully lit, and neither is the level threshold below
+which the saber skips a write.
+
+Commands:
+    replay  runs traces with a profile of the config and prints a summary,
+            --csv writes the timeline of every sample
+    sweep   runs every combination of the given setting values over all
+            the traces, e.g. --swing-threshold 0.5,0.7,1.0 --filter-alpha 0.2,0.4,
+            and prints how much each combination swings and crossfades
+    check   runs the traces through the saber's own SmoothSwing class, sample
+            by sample, and fails if it differs from the NumPy replay, so
+            recorded traces serve as regression tests for the swing engine.
+            Without traces a synthetic one is used.
+    synth   records a synthetic trace of scripted swings on the host backend,
+            through the same TraceRecorder the saber uses
+
+Usage:
+    python tools/replay.py replay TRACE... [--config main/config.json] [--profile NAME] [--csv OUT]
+    python tools/replay.py sweep TRACE... [--profile NAME] [--swing-threshold V,V...] [--csv OUT]
+    python tools/replay.py check [TRACE...] [--tolerance 0.005]
+    python tools/replay.py synth OUT [--seconds 10] [--rate 208]
+'''
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber import hal
+from pythosaber.lightsaber import MAX_HUM_VOLUME, SWING_RELEASE_MS
+from pythosaber.motion import MotionSampler
+from pythosaber.profiles import compile_profiles
+from pythosaber.smoothswing import MAX_VOLUME, MIN_HUM_VOLUME, SmoothSwing
+from pythosaber.trace import HEADER_FORMAT, MAGIC, TraceRecorder
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<u4"),
+    ("dt", "<f4"),
+    ("gyro", "<i2", 3),
+    ("accel", "<i2", 3),
+    ])
+
+# Settings of a profile that sweep can vary, from their config.json keys to the Profile fields
+SWEEP_SETTINGS = (
+    ("swing_threshold", "swing_threshold"),
+    ("filter_alpha", "lowpass_alpha"),
+    ("swing_sharpness", "swing_sharpness"),
+    ("transition_region_1", "transition_region_1"),
+    ("transition_region_2", "transition_region_2"),
+    ("transition_point_1", "transition_point_1"),
+    ("transition_point_2", "transition_point_2"),
+    )
+
+# Largest difference between the replay and the SmoothSwing class, in volume
+CHECK_TOLERANCE = 0.005
+
+# Synthetic trace: swings of growing strength around the y-axis with rests between them
+SYNTH_SWING_SECONDS = 0.8
+SYNTH_REST_SECONDS = 0.7
+SYNTH_PEAK = 4.0  # rad/s of the first swing
+SYNTH_GROWTH = 1.5  # rad/s more on every swing
+
+TIMELINE_FIELDS = ("time", "gyro_filtered", "accumulated_swing", "swing_strength",
+                   "swinging", "crossfaded", "hum_level", "swing_level",
+                   "swingh_level", "swingl_level")
+
+
+class Trace:
+    '''
+    A recorded trace, with the samples converted to seconds and SI units.
+    '''
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, header_size, rate, gyro_scale, accel_scale = struct.unpack_from(HEADER_FORMAT, data)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a trace')
+        self.path = path
+        self.version = version
+        self.rate = rate
+        count = (len(data) - header_size) // RECORD_DTYPE.itemsize
+        records = np.frombuffer(data, RECORD_DTYPE, count, header_size)
+
+        # Timestamps wrap like ticks_ms(), the time is counted from the first sample
+        steps = np.diff(records["timestamp"].astype(np.int64)) % (1 << 32)
+        self.time = np.concatenate(([0.0], np.cumsum(steps) / 1000))
+        self.dt = records["dt"].astype(np.float64)
+        self.gyro = records["gyro"] * gyro_scale
+        self.accel = records["accel"] * accel_scale
+
+    def __len__(self):
+        return len(self.dt)
+
+    def seconds(self):
+        return float(self.dt.sum())
+
+
+def profile_settings(profile):
+    return {field: getattr(profile, field) for _, field in SWEEP_SETTINGS}
+
+def lowpass(data, alpha):
+    '''
+    lowpass_filter() over a whole array, starting from its first value.
+    The recursion is unrolled in blocks: within a block each output is the
+    block's start value and the inputs weighted by powers of (1 - alpha),
+    short enough that the powers don't overflow.
+    '''
+    decay = 1.0 - alpha
+    if decay <= 0.0 or len(data) == 0:
+        return data.copy()
+    if decay >= 1.0:
+        return np.full_like(data, data[0])
+    block = int(min(4096, max(1, 600 / -math.log(decay))))
+    powers = decay ** np.arange(1, block + 1)
+    out = np.empty_like(data)
+    previous = data[0]
+    for start in range(0, len(data), block):
+        chunk = data[start:start + block]
+        n = len(chunk)
+        out[start:start + n] = powers[:n] * (previous + alpha * np.cumsum(chunk / powers[:n]))
+        previous = out[start + n - 1]
+    return out
+
+def hold(values, mask, initial):
+    '''
+    Each value where mask is set, and the last of those where it isn't.
+    '''
+    index = np.where(mask, np.arange(len(mask)), -1)
+    np.maximum.accumulate(index, out=index)
+    return np.where(index >= 0, values[np.maximum(index, 0)], initial)
+
+def release(values, swinging, time, rest):
+    '''
+    Each value while swinging, moving from the last of those to rest
+    over SWING_RELEASE_MS once the swing ended.
+    '''
+    last = hold(values, swinging, rest)
+    ended = hold(time, swinging, time[0] - SWING_RELEASE_MS / 1000)
+    progress = np.clip((time - ended) / (SWING_RELEASE_MS / 1000), 0.0, 1.0)
+    return np.where(swinging, values, last + (rest - last) * progress)
+
+def crossfade(angle, transition_region, transition_point, max_volume):
+    '''
+    do_crossfade() over an array, returns the fade out and fade in volumes.
+    '''
+    progress = np.clip((angle - transition_point) / transition_region, 0.0, 1.0)
+    return np.clip(max_volume - progress, 0.0, max_volume), np.clip(progress, 0.0, max_volume)
+
+def replay(trace, settings, max_volume=MAX_VOLUME):
+    '''
+    Runs a trace through the swing pipeline with the given settings.
+    Returns a dict of arrays with a value per sample, see TIMELINE_FIELDS,
+    along with the SmoothSwing volumes ahead of the mixers.
+    '''
+    gyro_rms = np.abs(trace.gyro[:, 1] - trace.gyro[:, 2]) * 0.5
+    gyro_filtered = lowpass(gyro_rms, settings["lowpass_alpha"])
+    swinging = gyro_filtered > settings["swing_threshold"]
+
+    # The angle accumulates from 0 over each run of swinging samples, wrapping at 2*PI
+    steps = np.cumsum(np.where(swinging, gyro_filtered * trace.dt, 0.0))
+    start = hold(steps, ~swinging, 0.0)
+    angle = np.where(swinging, (steps - start) % (2 * math.pi), 0.0)
+
+    strength = np.where(swinging, np.minimum(gyro_filtered / math.pi, 1.0) ** settings["swing_sharpness"], 0.0)
+    hum_volume = np.where(swinging, np.clip(max_volume - strength, MIN_HUM_VOLUME, 1.0), max_volume)
+    swing_volume = np.clip(strength, 0.0, 1.0)
+
+    # The second transition overrides the first, below both the volumes are left as they were
+    above_1 = swinging & (angle > settings["transition_point_1"])
+    above_2 = swinging & (angle > settings["transition_point_2"])
+    out_1, in_1 = crossfade(angle, settings["transition_region_1"], settings["transition_point_1"], max_volume)
+    out_2, in_2 = crossfade(angle, settings["transition_region_2"], settings["transition_point_2"], max_volume)
+    swingh = np.where(above_2, in_2, np.where(above_1, out_1, 0.0))
+    swingl = np.where(above_2, out_2, np.where(above_1, in_1, 0.0))
+    crossfaded = above_1 | above_2
+    swingh_volume = hold(swingh, crossfaded | ~swinging, 0.0)
+    swingl_volume = hold(swingl, crossfaded | ~swinging, 0.0)
+
+    # The hum and swing settle back after a swing, the swing mixer only changes on a crossfade
+    return {
+        "time": trace.time,
+        "gyro_filtered": gyro_filtered,
+        "accumulated_swing": angle,
+        "swing_strength": strength,
+        "swinging": swinging,
+        "crossfaded": crossfaded,
+        "hum_volume": hum_volume,
+        "swing_volume": swing_volume,
+        "swingh_volume": swingh_volume,
+        "swingl_volume": swingl_volume,
+        "hum_level": release(hum_volume, swinging, trace.time, MAX_HUM_VOLUME),
+        "swing_level": release(swing_volume, swinging, trace.time, 0.0),
+        "swingh_level": hold(swingh, crossfaded, 0.0),
+        "swingl_level": hold(swingl, crossfaded, 0.0),
+        }
+
+def summarize(timeline, seconds):
+    '''
+    How much a timeline swings and crossfades.
+    '''
+    swinging = timeline["swinging"]
+    onsets = int(np.count_nonzero(swinging[1:] & ~swinging[:-1]) + (1 if len(swinging) and swinging[0] else 0))
+    return {
+        "swinging": float(swinging.mean()) if len(swinging) else 0.0,
+        "swings_per_s": onsets / seconds if seconds else 0.0,
+        "crossfading": float(timeline["crossfaded"].mean()) if len(swinging) else 0.0,
+        "swing_level": float(timeline["swing_volume"][swinging].mean()) if swinging.any() else 0.0,
+        }
+
+def write_timeline(path, timeline):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(TIMELINE_FIELDS)
+        columns = [timeline[name] for name in TIMELINE_FIELDS]
+        for row in zip(*columns):
+            writer.writerow([f'{value:.6g}' for value in row])
+
+def reference(trace, settings, use_tables=True):
+    '''
+    Runs a trace through the SmoothSwing class one sample at a time.
+    Returns the same volumes as replay() as lists.
+    '''
+    swing = SmoothSwing(use_tables=use_tables)
+    swing.configure(settings["swing_threshold"], settings["lowpass_alpha"], settings["swing_sharpness"],
+                    settings["transition_region_1"], settings["transition_region_2"],
+                    settings["transition_point_1"], settings["transition_point_2"])
+    names = ("accumulated_swing", "swing_strength", "hum_volume", "swing_volume",
+             "swingh_volume", "swingl_volume")
+    results = {name: [] for name in names}
+    results["swinging"] = []
+    gyro = trace.gyro
+    for i in range(len(trace)):
+        results["swinging"].append(swing.update(gyro[i, 1], gyro[i, 2], trace.dt[i]))
+        for name in names:
+            results[name].append(getattr(swing, name))
+    return results
+
+def compare(trace, settings):
+    '''
+    Largest difference between replay() and the SmoothSwing class on a trace,
+    and the number of samples they disagree on whether it's swinging.
+    Angles are compared on the circle.
+    '''
+    timeline = replay(trace, settings)
+    expected = reference(trace, settings)
+    mismatches = int(np.count_nonzero(np.array(expected["swinging"]) != timeline["swinging"]))
+    error = 0.0
+    for name, values in expected.items():
+        if name == "swinging":
+            continue
+        difference = np.asarray(values) - timeline[name]
+        if name == "accumulated_swing":
+            difference = (difference + math.pi) % (2 * math.pi) - math.pi
+        if len(difference):
+            error = max(error, float(np.abs(difference).max()))
+    return error, mismatches
+
+def synth_gyro(t):
+    '''
+    Swings of growing strength around the y-axis, each a sine squared bump, with rests between.
+    '''
+    period = SYNTH_SWING_SECONDS + SYNTH_REST_SECONDS
+    n, phase = divmod(t, period)
+    if phase < SYNTH_REST_SECONDS:
+        return (0.0, 0.0, 0.0)
+    peak = SYNTH_PEAK + SYNTH_GROWTH * n
+    w = peak * math.sin(math.pi * (phase - SYNTH_REST_SECONDS) / SYNTH_SWING_SECONDS) ** 2
+    return (0.0, w, -0.2 * w)
+
+def synth(path, seconds, rate, loop_rate=100.0):
+    '''
+    Records a synthetic trace with the host backend's scripted IMU, the motion
+    sampler and the TraceRecorder, the way the saber records one.
+    '''
+    folder = tempfile.mkdtemp()
+    try:
+        device = hal.create(hal.BACKEND_HOST, sd_root=folder, gyro=synth_gyro, realtime=False)
+        sampler = MotionSampler(device)
+        sampler.set_rate(rate)
+        sampler.start_fifo()
+        recorder = TraceRecorder(device)
+        recorder.start(sampler)
+        while device.clock.monotonic() < seconds:
+            device.clock.advance(1 / loop_rate)
+            sampler.read()
+            recorder.record(sampler)
+        recorder.stop()
+        shutil.copyfile(recorder.path, path)
+    finally:
+        shutil.rmtree(folder)
+    return path
+
+def parse_values(text):
+    return [float(value) for value in text.split(",")]
+
+def load_profile(config_path, name):
+    with open(config_path) as f:
+        profiles = compile_profiles(json.load(f), "")
+    if not profiles:
+        raise SystemExit('No valid profiles in the config')
+    if name is None:
+        return profiles[0]
+    for profile in profiles:
+        if profile.name == name:
+            return profile
+    raise SystemExit(f'No profile {name} in the config')
+
+def command_replay(args):
+    profile = load_profile(args.config, args.profile)
+    settings = profile_settings(profile)
+    print(f'Profile {profile.name}')
+    print(f'{"trace":<24} {"samples":>8} {"seconds":>8} {"swinging":>9} {"swings/s":>9} {"xfading":>8}')
+    for path in args.traces:
+        trace = Trace(path)
+        timeline = replay(trace, settings)
+        summary = summarize(timeline, trace.seconds())
+        print(f'{os.path.basename(path):<24} {len(trace):>8} {trace.seconds():>8.2f} '
+              f'{summary["swinging"]:>9.1%} {summary["swings_per_s"]:>9.2f} {summary["crossfading"]:>8.1%}')
+        if args.csv:
+            out = args.csv
+            if len(args.traces) > 1:
+                out = f'{os.path.splitext(args.csv)[0]}_{os.path.splitext(os.path.basename(path))[0]}.csv'
+            write_timeline(out, timeline)
+    return 0
+
+def command_sweep(args):
+    profile = load_profile(args.config, args.profile)
+    base = profile_settings(profile)
+    grid = []
+    for key, field in SWEEP_SETTINGS:
+        values = getattr(args, key)
+        grid.append((field, parse_values(values) if values else [base[field]]))
+    traces = [Trace(path) for path in args.traces]
+    seconds = sum(trace.seconds() for trace in traces)
+    swept = [field for field, values in grid if len(values) > 1]
+
+    rows = []
+    for combination in itertools.product(*(values for _, values in grid)):
+        settings = dict(zip((field for field, _ in grid), combination))
+        totals = {"swinging": 0.0, "swings_per_s": 0.0, "crossfading": 0.0, "swing_level": 0.0}
+        for trace in traces:
+            # Weighted by the length of each trace
+            summary = summarize(replay(trace, settings), trace.seconds())
+            weight = trace.seconds() / seconds if seconds else 0.0
+            for name in totals:
+                totals[name] += summary[name] * weight
+        rows.append((settings, totals))
+
+    print(f'{len(rows)} combinations over {len(traces)} traces, {seconds:.1f} s, base profile {profile.name}')
+    header = ' '.join(f'{field:>19}' for field in swept)
+    print(f'{header} {"swinging":>9} {"swings/s":>9} {"xfading":>8} {"level":>6}')
+    for settings, totals in rows:
+        values = ' '.join(f'{settings[field]:>19.4g}' for field in swept)
+        print(f'{values} {totals["swinging"]:>9.1%} {totals["swings_per_s"]:>9.2f} '
+              f'{totals["crossfading"]:>8.1%} {totals["swing_level"]:>6.3f}')
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            names = [field for _, field in SWEEP_SETTINGS]
+            writer.writerow(names + list(rows[0][1]))
+            for settings, totals in rows:
+                writer.writerow([settings[name] for name in names] + list(totals.values()))
+    return 0
+
+def command_check(args):
+    with open(args.config) as f:
+        profiles = compile_profiles(json.load(f), "")
+    folder = None
+    paths = args.traces
+    if not paths:
+        folder = tempfile.mkdtemp()
+        paths = [synth(os.path.join(folder, "synth.bin"), 10.0, 208)]
+    try:
+        print(f'Replay against SmoothSwing, tolerance {args.tolerance}')
+        failed = False
+        for path in paths:
+            trace = Trace(path)
+            for profile in profiles:
+                error, mismatches = compare(trace, profile_settings(profile))
+                print(f'{os.path.basename(path)} {profile.name}: max error {error:.6f}, '
+                      f'{mismatches} swinging mismatches')
+                if error > args.tolerance or mismatches:
+                    print(f'FAIL: {os.path.basename(path)} with {profile.name}')
+                    failed = True
+    finally:
+        if folder:
+            shutil.rmtree(folder)
+    return 1 if failed else 0
+
+def command_synth(args):
+    synth(args.out, args.seconds, args.rate)
+    trace = Trace(args.out)
+    print(f'{args.out}: {len(trace)} samples, {trace.seconds():.2f} s')
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    config = os.path.join(ROOT, "main", "config.json")
+
+    command = commands.add_parser('replay', help='replay traces with a profile')
+    command.add_argument('traces', nargs='+')
+    command.add_argument('--config', default=config)
+    command.add_argument('--profile', help='profile name, the first one by default')
+    command.add_argument('--csv', help='write the timeline to this file')
+    command.set_defaults(run=command_replay)
+
+    command = commands.add_parser('sweep', help='replay traces over a grid of settings')
+    command.add_argument('traces', nargs='+')
+    command.add_argument('--config', default=config)
+    command.add_argument('--profile', help='profile with the settings that are not swept')
+    for key, _ in SWEEP_SETTINGS:
+        command.add_argument('--' + key.replace('_', '-'), dest=key, help='comma separated values')
+    command.add_argument('--csv', help='write the results to this file')
+    command.set_defaults(run=command_sweep)
+
+    command = commands.add_parser('check', help='compare the replay with the SmoothSwing class')
+    command.add_argument('traces', nargs='*')
+    command.add_argument('--config', default=config)
+    command.add_argument('--tolerance', type=float, default=CHECK_TOLERANCE)
+    command.set_defaults(run=command_check)
+
+    command = commands.add_parser('synth', help='record a synthetic trace')
+    command.add_argument('out')
+    command.add_argument('--seconds', type=float, default=10.0)
+    command.add_argument('--rate', type=float, default=208.0, help='IMU rate in Hz')
+    command.set_defaults(run=command_synth)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
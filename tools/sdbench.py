@@ -0,0 +1,64 @@
+'''
+SD card streaming benchmark on the host.
+
+Runs the saber's SD benchmark (see pythosaber.sdbench) on the host backend,
+which reads the files at the speed the model in pythosaber.host gives an
+SD card over SPI: a cost per read, and per 512 byte block the time to clock
+it out at the baudrate. A soundfont of silent sounds is written to a
+temporary SD root to stream from.
+
+For each SPI baudrate it prints the throughput, load and underruns of each
+WaveFile buffer size and the recommended buffer size, the same as the saber
+prints with "sd_bench" in config.json. The model's constants are rough, so
+use this to see how the settings trade off and the saber's own run to pick them.
+Fails if no baudrate and buffer size keeps up with the streams.
+
+Usage:
+    python tools/sdbench.py [--baudrates 4000000,8000000,12000000] [--effect-voices 3]
+                            [--streams N] [--seconds 1]
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber import hal
+from pythosaber.host import write_font
+from pythosaber.sdbench import SDBenchmark, BENCH_SECONDS
+
+BAUDRATES = (4000000, 8000000, 12000000, 24000000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--baudrates', default=','.join(str(b) for b in BAUDRATES),
+                        help='comma separated SPI baudrates of the SD card')
+    parser.add_argument('--effect-voices', type=int, default=hal.EFFECT_VOICE_COUNT)
+    parser.add_argument('--streams', type=int, default=None,
+                        help='streams at once, by default the hum, swingh, swingl and the effect voices')
+    parser.add_argument('--seconds', type=float, default=BENCH_SECONDS,
+                        help='device time measured per buffer size')
+    args = parser.parse_args(argv)
+
+    recommended = 0
+    with tempfile.TemporaryDirectory() as sd_root:
+        font_path = sd_root + "/sounds/bench"
+        write_font(font_path)
+        for baudrate in (int(b) for b in args.baudrates.split(',')):
+            device = hal.create(hal.BACKEND_HOST, sd_root=sd_root, realtime=False, sd_baudrate=baudrate)
+            device.init_mixers(args.effect_voices)
+            bench = SDBenchmark(device, font_path)
+            recommended = bench.run(args.streams, seconds=args.seconds) or recommended
+            bench.report()
+            print()
+    if not recommended:
+        print('FAIL: no baudrate and buffer size keeps up')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
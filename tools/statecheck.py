@@ -0,0 +1,214 @@
+'''
+Saved state check.
+
+Runs the real Lightsaber state machine on the host backend, on a virtual
+clock, through scripted sessions that change the profile with the aux
+button, and counts the writes to the NVM, which the host backend keeps in
+a file (host.FileNVM) so that it survives a reboot like it survives a
+reset. Every session but the first boots from the NVM the one before left.
+
+    first boot   nothing saved yet, the selection from config.json is saved once
+    cycle        quick clicks through the profiles are saved once, not before
+                 the selection has been left alone for the save delay
+    unchanged    clicking all the way around to the saved profile saves nothing
+    settle       clicks further apart than the save delay are saved once each
+    ignition     the blade ignited within the save delay saves the selection at once
+    corrupt      a record with a bad checksum is ignored and saved over
+
+The check fails if a session writes the NVM more or less often than
+expected, or boots into a different profile than it should.
+
+Usage:
+    python tools/statecheck.py [--profiles 4] [--config main/config.json] [--verbose]
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from pythosaber.state import RECORD_SIZE, SAVE_DELAY_MS
+
+import bench
+
+# Scripted sessions, in seconds of device time
+CLICK_AT = 5.0
+CLICK_LENGTH = 0.08
+QUICK_INTERVAL = 0.5
+SLOW_INTERVAL = SAVE_DELAY_MS / 1000 + 1.0
+IGNITE_DELAY = 0.6
+SETTLE_SECONDS = SAVE_DELAY_MS / 1000 + 2.0
+
+
+def clicks(count, interval, start=CLICK_AT):
+    '''
+    Presses of the button for count clicks, interval seconds apart.
+    '''
+    return tuple((start + i * interval, start + i * interval + CLICK_LENGTH) for i in range(count))
+
+class Sessions:
+    '''
+    Boots sabers from one SD card and one NVM, one after the other.
+    '''
+    def __init__(self, config, sd_root, profiles, verbose):
+        self.config = config
+        self.sd_root = sd_root
+        self.nvm_path = os.path.join(sd_root, "nvm.bin")
+        self.verbose = verbose
+        with open(config) as f:
+            settings = json.load(f)
+        self.profiles = max(profiles, len(settings["profiles"]))
+        self.config_selection = settings["save_state"]
+
+    def run(self, presses_aux=(), presses_main=(), checkpoints=(), until=None):
+        '''
+        Boots a saber and runs it until the last checkpoint or until, whichever is later.
+        checkpoints is a list of device times at which to count the NVM writes.
+        Returns the saber, the selection it booted into and the write counts.
+        '''
+        # No idle sleep, it saves the selection too
+        saber = bench.boot_saber(
+            self.config,
+            self.sd_root,
+            self.verbose,
+            profiles=self.profiles,
+            overrides={"idle_timeout": 0},
+            nvm_path=self.nvm_path,
+            presses_main=presses_main,
+            presses_aux=presses_aux,
+            )
+        device = saber.device
+        booted = saber.current_selection
+        writes = []
+        with bench.quiet(self.verbose):
+            for checkpoint in checkpoints:
+                saber.run(until=checkpoint)
+                writes.append(device.nvm.writes)
+            if until is not None:
+                saber.run(until=until)
+        return saber, booted, writes
+
+    def corrupt(self, offset=RECORD_SIZE - 1):
+        '''
+        Flips the bits of a byte of the saved record, by default its checksum.
+        '''
+        with open(self.nvm_path, "r+b") as f:
+            f.seek(offset)
+            value = f.read(1)[0]
+            f.seek(offset)
+            f.write(bytes((value ^ 0xFF,)))
+
+def expect(failures, name, what, value, expected):
+    if value != expected:
+        failures.append(f'{name}: {what} {value}, expected {expected}')
+
+def run_checks(sessions, verbose):
+    '''
+    Runs the sessions in order. Returns the failures as a list of strings.
+    '''
+    failures = []
+    count = sessions.profiles
+    selection = sessions.config_selection
+
+    def report(name, saber, writes):
+        if verbose:
+            print(f'{name}: selection {saber.current_selection}, NVM writes {writes}')
+
+    name = 'first boot'
+    saber, booted, writes = sessions.run(checkpoints=(SETTLE_SECONDS,))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, selection)
+    expect(failures, name, 'NVM writes', writes, [1])
+
+    # The last click is acted on once the double click window has passed
+    name = 'cycle'
+    presses = clicks(count - 1, QUICK_INTERVAL)
+    settled = presses[-1][1] + SAVE_DELAY_MS / 1000
+    saber, booted, writes = sessions.run(
+        presses_aux=presses,
+        checkpoints=(settled, settled + 1.0, settled + SETTLE_SECONDS))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, selection)
+    expect(failures, name, 'NVM writes', writes, [0, 1, 1])
+    selection = (selection + count - 1) % count
+    expect(failures, name, 'selected profile', saber.current_selection, selection)
+
+    name = 'unchanged'
+    presses = clicks(count, QUICK_INTERVAL)
+    saber, booted, writes = sessions.run(
+        presses_aux=presses,
+        checkpoints=(presses[-1][1] + SETTLE_SECONDS,))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, selection)
+    expect(failures, name, 'NVM writes', writes, [0])
+    expect(failures, name, 'selected profile', saber.current_selection, selection)
+
+    name = 'settle'
+    presses = clicks(2, SLOW_INTERVAL)
+    saber, booted, writes = sessions.run(
+        presses_aux=presses,
+        checkpoints=(presses[1][0], presses[1][1] + SETTLE_SECONDS))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, selection)
+    expect(failures, name, 'NVM writes', writes, [1, 2])
+    selection = (selection + 2) % count
+
+    # Ignite well within the save delay, and stay on past it
+    name = 'ignition'
+    presses = clicks(1, QUICK_INTERVAL)
+    ignite_at = presses[0][1] + IGNITE_DELAY
+    saber, booted, writes = sessions.run(
+        presses_aux=presses,
+        presses_main=((ignite_at, ignite_at + CLICK_LENGTH),),
+        checkpoints=(ignite_at - 0.1, ignite_at + 0.1, ignite_at + SETTLE_SECONDS))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, selection)
+    expect(failures, name, 'NVM writes', writes, [0, 1, 1])
+    expect(failures, name, 'state', saber.current_state, "ACTIVE")
+    selection = (selection + 1) % count
+
+    name = 'reboot'
+    saber, booted, writes = sessions.run(checkpoints=(SETTLE_SECONDS,))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, selection)
+    expect(failures, name, 'NVM writes', writes, [0])
+
+    # A bad record falls back on config.json and is written again
+    name = 'corrupt'
+    sessions.corrupt()
+    saber, booted, writes = sessions.run(checkpoints=(SETTLE_SECONDS,))
+    report(name, saber, writes)
+    expect(failures, name, 'booted into profile', booted, sessions.config_selection)
+    expect(failures, name, 'NVM writes', writes, [1])
+    saber, booted, writes = sessions.run(checkpoints=(SETTLE_SECONDS,))
+    report(name, saber, writes)
+    expect(failures, name, 'rebooted into profile', booted, sessions.config_selection)
+    expect(failures, name, 'NVM writes after the reboot', writes, [0])
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--profiles', type=int, default=4, help='profiles to cycle through, at least 3')
+    parser.add_argument('--config', default=os.path.join(ROOT, "main", "config.json"))
+    parser.add_argument('--verbose', action='store_true', help="show the saber's own output")
+    args = parser.parse_args(argv)
+    if args.profiles < 3:
+        parser.error('--profiles must be at least 3')
+
+    with tempfile.TemporaryDirectory() as sd_root:
+        sessions = Sessions(args.config, sd_root, args.profiles, args.verbose)
+        print(f'Saved state check, {sessions.profiles} profiles, save delay {SAVE_DELAY_MS} ms')
+        failures = run_checks(sessions, args.verbose)
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if not failures:
+        print('OK')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+'''
+Swing angle accuracy check.
+
+Replays a scripted swing through the motion sampler and SmoothSwing on the
+host backend and compares the accumulated swing angle with the exact
+integral of the scripted angular velocity. The filter and threshold are
+switched off (alpha 1, threshold 0) so the accumulated angle is nothing but
+the integral of the gyro readings.
+
+The loop runs on a virtual clock with ticks of random length around the
+loop period, like a loop that now and then overruns its budget.
+Two ways of integrating are compared for every sensor rate:
+    fifo    every sample from the FIFO over its own sample period
+    newest  the newest sample only, over the whole tick, as the loop did before
+The check fails if the FIFO integration is off by more than the tolerance.
+
+It also checks SmoothSwing's lookup tables against the functions they were
+baked from, for the profiles in the config: every output of a table driven
+SmoothSwing is compared to a directly computed one over a sweep of angular
+velocities and swing angles, and the check fails if any differs by more
+than TABLE_TOLERANCE.
+
+Usage:
+    python tools/swingcheck.py [--seconds 2] [--loop-rate 100] [--jitter 0.5] [--tolerance 0.01]
+                               [--config main/config.json]
+'''
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber import hal
+from pythosaber.motion import MotionSampler
+from pythosaber.profiles import compile_profiles
+from pythosaber.smoothswing import SmoothSwing
+
+# Angular velocity around the y-axis, always above the threshold so the swing never resets
+SWING_OFFSET = 3.0  # rad/s
+SWING_AMPLITUDE = 2.0  # rad/s
+SWING_FREQUENCY = 2.0  # Hz
+SENSOR_RATES = (26, 104, 208, 416)
+
+# Largest difference between the table and the direct outputs, in volume or strength
+TABLE_TOLERANCE = 0.005
+TABLE_SWEEP_STEPS = 2000
+
+
+def swing_gyro(t):
+    return (0.0, SWING_OFFSET + SWING_AMPLITUDE * math.sin(2 * math.pi * SWING_FREQUENCY * t), 0.0)
+
+def swing_angle(t):
+    '''
+    Exact integral of the gyro RMS estimate, i.e. half the y rate, from 0 to t.
+    '''
+    omega = 2 * math.pi * SWING_FREQUENCY
+    return 0.5 * (SWING_OFFSET * t + SWING_AMPLITUDE * (1 - math.cos(omega * t)) / omega)
+
+def angle_error(angle, truth):
+    '''
+    Difference of two angles on the circle, as the accumulated angle wraps at 2*PI.
+    '''
+    return (angle - truth + math.pi) % (2 * math.pi) - math.pi
+
+def replay(sensor_rate, loop_rate, jitter, seconds, use_fifo, seed=0):
+    '''
+    Runs the sampler and SmoothSwing on a virtual clock, with tick lengths
+    spread by jitter (a fraction of the loop period) around the loop period.
+    Returns the accumulated angle and the ground truth angle it should match.
+    '''
+    rng = random.Random(seed)
+    device = hal.create(hal.BACKEND_HOST, gyro=swing_gyro, realtime=False)
+    sampler = MotionSampler(device, use_fifo=use_fifo)
+    sampler.set_rate(sensor_rate)
+    swing = SmoothSwing()
+    swing.configure(0.0, 1.0, 1.0, 1.0, 1.0, 10.0, 10.0)
+
+    period = 1 / loop_rate
+    while device.clock.monotonic() < seconds:
+        device.clock.advance(period * (1 + jitter * (2 * rng.random() - 1)))
+        count = sampler.read()
+        if use_fifo:
+            swing.update_batch(sampler.gyro_y, sampler.gyro_z, sampler.dt, count)
+        elif count:
+            swing.update(sampler.gyro_y[0], sampler.gyro_z[0], sampler.elapsed)
+
+    # The FIFO integrates up to its newest sample, the register read up to now
+    if use_fifo:
+        end = device.motion.fifo_time - len(device.motion.fifo) / 2 / sampler.rate
+    else:
+        end = device.clock.monotonic()
+    return swing.accumulated_swing, swing_angle(end)
+
+def table_error(profile, steps=TABLE_SWEEP_STEPS):
+    '''
+    Largest difference between the outputs of table driven and direct SmoothSwing
+    for a profile, over angular velocities from 0 to 2*PI rad/s and all swing angles.
+    '''
+    tables = SmoothSwing(use_tables=True)
+    direct = SmoothSwing(use_tables=False)
+    settings = (profile.swing_threshold, 1.0, profile.swing_sharpness,
+                profile.transition_region_1, profile.transition_region_2,
+                profile.transition_point_1, profile.transition_point_2)
+    tables.configure(*settings)
+    direct.configure(*settings)
+
+    error = 0.0
+    for i in range(steps):
+        # Sweep the strength with the angle standing still, then the angle
+        omega = 2 * math.pi * i / steps
+        for swing in (tables, direct):
+            swing.reset()
+            swing.previous_gyro_filtered = None
+            swing.accumulated_swing = 2 * math.pi * random.random()
+        angle = tables.accumulated_swing = direct.accumulated_swing
+        for swing in (tables, direct):
+            swing.update(2 * omega, 0.0, 0.0)
+        for name in ("swing_strength", "hum_volume", "swing_volume", "swingh_volume", "swingl_volume"):
+            error = max(error, abs(getattr(tables, name) - getattr(direct, name)))
+        if tables.crossfaded != direct.crossfaded:
+            print(f'crossfaded differs at {angle:.4f} rad')
+            error = math.inf
+    return error
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--seconds', type=float, default=2.0, help='length of the swing')
+    parser.add_argument('--loop-rate', type=float, default=100.0, help='main loop rate in Hz')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='spread of the tick length as a fraction of the loop period')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='largest relative error of the FIFO integration')
+    parser.add_argument('--config', default=os.path.join(ROOT, "main", "config.json"))
+    args = parser.parse_args(argv)
+
+    print(f'Swing of {args.seconds} s, loop at {args.loop_rate} Hz +-{args.jitter:.0%}')
+    print(f'{"ODR Hz":>7} {"truth rad":>10} {"fifo err":>10} {"newest err":>11}')
+    failed = False
+    for rate in SENSOR_RATES:
+        fifo_angle, fifo_truth = replay(rate, args.loop_rate, args.jitter, args.seconds, True)
+        newest_angle, newest_truth = replay(rate, args.loop_rate, args.jitter, args.seconds, False)
+        fifo_error = abs(angle_error(fifo_angle, fifo_truth)) / fifo_truth
+        newest_error = abs(angle_error(newest_angle, newest_truth)) / newest_truth
+        print(f'{rate:>7} {fifo_truth:>10.4f} {fifo_error:>9.3%} {newest_error:>10.3%}')
+        if fifo_error > args.tolerance:
+            print(f'FAIL: FIFO integration at {rate} Hz is off by {fifo_error:.3%}')
+            failed = True
+
+    print()
+    print(f'Lookup tables against the functions, tolerance {TABLE_TOLERANCE}')
+    with open(args.config) as f:
+        profiles = compile_profiles(json.load(f), "")
+    for profile in profiles:
+        error = table_error(profile)
+        print(f'{profile.name}: max error {error:.6f}')
+        if error > TABLE_TOLERANCE:
+            print(f'FAIL: tables of {profile.name} are off by {error:.6f}')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+'''
+Runtime telemetry decoder.
+
+Decodes the captures of the saber's runtime telemetry (see pythosaber.telemetry,
+switched on with "telemetry" in a profile or by holding aux and pressing main)
+into tables and plots. A capture is either a file from sd_root/telemetry, the
+bytes read from usb_cdc.data, or a log of the serial console with the
+telemetry's base64 lines among the saber's other output.
+
+Commands:
+    decode  prints, per state, the ms per tick of each stage of the main loop,
+            the longest tick and how much of the time was swinging, then the
+            stages ranked by their share of the work, and the heap, garbage
+            collections and telemetry writes. --csv writes every frame,
+            --plot draws the stages, the heap and the mixer levels over time
+            (needs matplotlib)
+    record  records a capture on the host backend, through the scripted
+            session of tools/bench.py with the telemetry of every profile
+            on, and decodes it. Fails if no frames were recorded or some
+            were dropped
+
+Usage:
+    python tools/telemetry.py decode CAPTURE... [--csv OUT] [--plot OUT.png]
+    python tools/telemetry.py record OUT [--seconds 20] [--sink sd|serial] [--config main/config.json]
+'''
+import argparse
+import base64
+import contextlib
+import csv
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+from pythosaber import hal
+from pythosaber.lightsaber import Lightsaber
+from pythosaber.probe import STAGE_NAMES, STAGE_COUNT
+from pythosaber.telemetry import HEADER_FORMAT, HEADER_SIZE, MAGIC, VERSION, FRAME_SIZE, \
+    SERIAL_PREFIX, SINK_SD, SINK_SERIAL, STATE_NAMES
+
+import bench
+
+FRAME_DTYPE = np.dtype([
+    ("timestamp", "<u4"),
+    ("ticks", "<u2"),
+    ("work_max", "<u2"),
+    ("stage_ms", "<u2", STAGE_COUNT),
+    ("mem_free", "<u4"),
+    ("mem_alloc", "<u4"),
+    ("collections", "u1"),
+    ("state", "u1"),
+    ("swinging", "u1"),
+    ("dropped", "u1"),
+    ("levels", "u1", 4),
+    ("flush_ms", "<u2"),
+    ])
+assert FRAME_DTYPE.itemsize == FRAME_SIZE
+
+LEVEL_NAMES = ("hum", "swing", "swingh", "swingl")
+
+# The stages that are the loop's work, all but the sleep
+WORK_STAGES = tuple(i for i, name in enumerate(STAGE_NAMES) if name != "sleep")
+
+
+def read_bytes(path):
+    '''
+    The telemetry bytes of a capture: the file as it is if it starts with a
+    header, otherwise the base64 lines of a serial console log.
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(MAGIC):
+        return data
+    prefix = SERIAL_PREFIX.encode()
+    chunks = []
+    for line in data.splitlines():
+        if line.startswith(prefix):
+            chunks.append(base64.b64decode(line[len(prefix):]))
+    return b"".join(chunks)
+
+
+class Capture:
+    '''
+    The frames of a capture, one run of the telemetry after another, with
+    the time of every frame counted from the first frame of its run.
+    '''
+    def __init__(self, path):
+        data = read_bytes(path)
+        if not data.startswith(MAGIC):
+            raise ValueError(f'{path} is not a telemetry capture')
+        self.path = path
+        chunks = []
+        runs = []
+        run = -1
+        position = 0
+        while position + HEADER_SIZE <= len(data):
+            if data[position:position + len(MAGIC)] == MAGIC:
+                magic, version, header_size, frame_size, stage_count, frame_ticks = \
+                    struct.unpack_from(HEADER_FORMAT, data, position)
+                if version != VERSION or frame_size != FRAME_SIZE or stage_count != STAGE_COUNT:
+                    raise ValueError(f'{path}: telemetry version {version} with {stage_count} stages '
+                                     f'in {frame_size} byte frames is not supported')
+                position += header_size
+                run += 1
+                continue
+            if position + FRAME_SIZE > len(data):
+                break
+            chunks.append(data[position:position + FRAME_SIZE])
+            runs.append(run)
+            position += FRAME_SIZE
+        self.frames = np.frombuffer(b"".join(chunks), FRAME_DTYPE)
+        self.run = np.array(runs, dtype=np.int64)
+        self.runs = run + 1
+
+        # Timestamps wrap like ticks_ms()
+        self.time = np.zeros(len(self.frames))
+        for i in range(self.runs):
+            mask = self.run == i
+            stamps = self.frames["timestamp"][mask].astype(np.int64)
+            steps = np.diff(stamps) % hal.TICKS_PERIOD
+            self.time[mask] = np.concatenate(([0], np.cumsum(steps))) / 1000
+
+    def __len__(self):
+        return len(self.frames)
+
+    def ticks(self):
+        return int(self.frames["ticks"].sum())
+
+
+def stage_table(frames):
+    '''
+    Per stage: mean ms per tick over the frames, and the most per tick in any frame.
+    '''
+    ticks = frames["ticks"].astype(np.float64)
+    total = max(1.0, ticks.sum())
+    stage_ms = frames["stage_ms"].astype(np.float64)
+    per_tick = stage_ms / np.maximum(ticks, 1)[:, None]
+    mean = stage_ms.sum(axis=0) / total
+    worst = per_tick.max(axis=0) if len(frames) else np.zeros(STAGE_COUNT)
+    return mean, worst
+
+def print_states(capture):
+    frames = capture.frames
+    print(f'{"state":<11}{"frames":>7}{"ticks":>7}' + ''.join(f'{name:>7}' for name in STAGE_NAMES)
+          + f'{"work":>7}{"max":>5}{"swing":>7}')
+    for code, name in enumerate(STATE_NAMES):
+        selected = frames[frames["state"] == code]
+        if not len(selected):
+            continue
+        mean, _ = stage_table(selected)
+        ticks = int(selected["ticks"].sum())
+        work = mean[list(WORK_STAGES)].sum()
+        swinging = selected["swinging"].sum() / max(1, ticks)
+        print(f'{name:<11}{len(selected):>7}{ticks:>7}' + ''.join(f'{ms:>7.2f}' for ms in mean)
+              + f'{work:>7.2f}{int(selected["work_max"].max()):>5}{swinging:>7.0%}')
+    print('(ms per tick, max is the longest tick\'s work in ms)')
+
+def print_hot_spots(capture):
+    '''
+    The stages of the loop's work, the most expensive first.
+    '''
+    mean, worst = stage_table(capture.frames)
+    work = mean[list(WORK_STAGES)].sum()
+    print(f'{"stage":<8}{"ms/tick":>9}{"share":>8}{"worst":>8}')
+    for stage in sorted(WORK_STAGES, key=lambda stage: -mean[stage]):
+        share = mean[stage] / work if work else 0.0
+        print(f'{STAGE_NAMES[stage]:<8}{mean[stage]:>9.3f}{share:>8.1%}{worst[stage]:>8.1f}')
+    print('(worst is the most ms per tick of any frame)')
+
+def print_memory(capture):
+    frames = capture.frames
+    print(f'heap free:   min {int(frames["mem_free"].min())} bytes, '
+          f'last {int(frames["mem_free"][-1])} bytes')
+    print(f'heap alloc:  max {int(frames["mem_alloc"].max())} bytes')
+    print(f'collections: {int(frames["collections"].sum())}')
+    print(f'writes:      max {int(frames["flush_ms"].max())} ms, '
+          f'{int(frames["dropped"].sum())} frames dropped')
+
+def write_frames(path, capture):
+    frames = capture.frames
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("run", "time", "state", "ticks", "work_max")
+                        + tuple(f'{name}_ms' for name in STAGE_NAMES)
+                        + ("mem_free", "mem_alloc", "collections", "swinging")
+                        + LEVEL_NAMES + ("flush_ms", "dropped"))
+        for i, frame in enumerate(frames):
+            ticks = max(1, int(frame["ticks"]))
+            writer.writerow(
+                [int(capture.run[i]), f'{capture.time[i]:.3f}', STATE_NAMES[min(frame["state"], 3)],
+                 int(frame["ticks"]), int(frame["work_max"])]
+                + [f'{ms / ticks:.3f}' for ms in frame["stage_ms"]]
+                + [int(frame["mem_free"]), int(frame["mem_alloc"]), int(frame["collections"]),
+                   f'{frame["swinging"] / ticks:.2f}']
+                + [f'{level / 255:.3f}' for level in frame["levels"]]
+                + [int(frame["flush_ms"]), int(frame["dropped"])])
+
+def plot(path, capture):
+    '''
+    Draws the stages per tick, the heap and the mixer levels over time.
+    Returns False without matplotlib.
+    '''
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('No plot, matplotlib is not installed')
+        return False
+    frames = capture.frames
+    ticks = np.maximum(frames["ticks"], 1)[:, None]
+    per_tick = frames["stage_ms"] / ticks
+    figure, (stages, heap, levels) = plt.subplots(3, 1, sharex=True, figsize=(10, 8))
+    stages.stackplot(capture.time, [per_tick[:, stage] for stage in WORK_STAGES],
+                     labels=[STAGE_NAMES[stage] for stage in WORK_STAGES])
+    stages.set_ylabel("ms per tick")
+    stages.legend(loc="upper right", fontsize="small")
+    heap.plot(capture.time, frames["mem_free"] / 1024, label="free")
+    heap.plot(capture.time, frames["mem_alloc"] / 1024, label="allocated")
+    heap.set_ylabel("heap KB")
+    heap.legend(loc="upper right", fontsize="small")
+    for i, name in enumerate(LEVEL_NAMES):
+        levels.plot(capture.time, frames["levels"][:, i] / 255, label=name)
+    levels.fill_between(capture.time, 0, frames["swinging"] / ticks[:, 0], alpha=0.2, label="swinging")
+    levels.set_ylabel("level")
+    levels.set_xlabel("seconds")
+    levels.legend(loc="upper right", fontsize="small")
+    figure.tight_layout()
+    figure.savefig(path)
+    return True
+
+def decode(path):
+    capture = Capture(path)
+    print(f'{os.path.basename(path)}: {len(capture)} frames of {capture.ticks()} ticks '
+          f'in {capture.runs} runs')
+    if len(capture):
+        print()
+        print_states(capture)
+        print()
+        print_hot_spots(capture)
+        print()
+        print_memory(capture)
+    return capture
+
+def record(path, seconds, sink, config):
+    '''
+    Runs the scripted session of tools/bench.py with the telemetry on and copies its capture to path.
+    Returns the saber.
+    '''
+    with tempfile.TemporaryDirectory() as sd_root:
+        config_path = os.path.join(sd_root, "config.json")
+        bench.write_config(config, config_path, telemetry=True)
+        with open(config_path) as f:
+            settings = json.load(f)
+        settings["telemetry_sink"] = sink
+        with open(config_path, "w") as f:
+            json.dump(settings, f)
+        bench.write_fonts(sd_root)
+        device = hal.create(
+            hal.BACKEND_HOST,
+            sd_root=sd_root,
+            gyro=bench.swing_gyro,
+            accel=bench.clash_accel,
+            presses_main=((bench.IGNITE_AT, bench.IGNITE_AT + bench.PRESS_LENGTH),
+                          (bench.RETRACT_AT, bench.RETRACT_AT + bench.PRESS_LENGTH)),
+            presses_aux=((bench.PROFILE_AT, bench.PROFILE_AT + bench.PRESS_LENGTH),),
+            )
+        # The serial sink prints, so the console is the capture
+        output = open(path, "w") if sink == SINK_SERIAL else open(os.devnull, "w")
+        with output, contextlib.redirect_stdout(output):
+            saber = Lightsaber(device)
+            saber.boot()
+            try:
+                saber.run(until=seconds)
+            finally:
+                saber.telemetry.stop()
+        if sink == SINK_SD:
+            shutil.copyfile(saber.telemetry.sink.name, path)
+    return saber
+
+def command_decode(args):
+    failed = False
+    for path in args.captures:
+        try:
+            capture = decode(path)
+        except (OSError, ValueError) as e:
+            print(f'FAIL: {e}')
+            failed = True
+            continue
+        print()
+        if args.csv:
+            out = args.csv
+            if len(args.captures) > 1:
+                out = f'{os.path.splitext(args.csv)[0]}_{os.path.splitext(os.path.basename(path))[0]}.csv'
+            write_frames(out, capture)
+        if args.plot:
+            out = args.plot
+            if len(args.captures) > 1:
+                out = f'{os.path.splitext(args.plot)[0]}_{os.path.splitext(os.path.basename(path))[0]}.png'
+            failed = not plot(out, capture) or failed
+    return 1 if failed else 0
+
+def command_record(args):
+    saber = record(args.out, args.seconds, args.sink, args.config)
+    telemetry = saber.telemetry
+    print(f'{args.out}: {telemetry.frames} frames in {telemetry.writes} writes to {args.sink}')
+    capture = decode(args.out)
+    if not len(capture) or len(capture) != telemetry.frames:
+        print(f'FAIL: {len(capture)} of {telemetry.frames} frames decoded')
+        return 1
+    if telemetry.dropped_total:
+        print(f'FAIL: {telemetry.dropped_total} frames dropped')
+        return 1
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('decode', help='print the tables of captures')
+    command.add_argument('captures', nargs='+')
+    command.add_argument('--csv', help='write the frames to this file')
+    command.add_argument('--plot', help='draw the frames to this image')
+    command.set_defaults(run=command_decode)
+
+    command = commands.add_parser('record', help='record a capture on the host backend')
+    command.add_argument('out')
+    command.add_argument('--seconds', type=float, default=20.0, help='device time to run the session for')
+    command.add_argument('--sink', choices=(SINK_SD, SINK_SERIAL), default=SINK_SD)
+    command.add_argument('--config', default=os.path.join(ROOT, "main", "config.json"))
+    command.set_defaults(run=command_record)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
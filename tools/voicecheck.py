@@ -0,0 +1,127 @@
+'''
+Voice stealing check.
+
+Boots the real Lightsaber on the host backend, on a virtual clock, and
+starts more overlapping effects on its voice pool than the profile's
+effect_voices: the ignition on the first voice, the quieter retraction on
+the second, clashes on the others, and then clashes every STEP_MS while
+they all still play. Every effect past the limit has to steal a voice:
+first the retraction's, the quietest, then the oldest of the others in
+turn, then the retraction's voice again, now the oldest.
+Once they've all ended one more clash has to take a free voice.
+
+The check fails if a steal is missed or made with a voice free, if the
+wrong voice is stolen, or if the peak number of voices in use isn't the
+limit.
+
+Usage:
+    python tools/voicecheck.py [--voices 3] [--config main/config.json] [--verbose]
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from pythosaber import hal
+from pythosaber.lightsaber import CLASH_VOLUME, EXTINGUISH_VOLUME
+
+import bench
+
+# Time between effects, well within the shortest sound of the bench fonts
+STEP_MS = 20
+# Long enough for every sound of the bench fonts to end
+END_SECONDS = 2.0
+
+
+def expected_steals(limit):
+    '''
+    The voices the effects past the limit should steal, in order.
+    '''
+    return [1, 0] + list(range(2, limit)) + [1]
+
+def play(saber, sample, level):
+    '''
+    Plays an effect, writes the levels like a tick would and moves the clock on.
+    Returns the index of the voice it played on and whether it stole it.
+    '''
+    voices = saber.voices
+    steals = voices.steals
+    voices.play(sample, level)
+    saber.levels.update()
+    saber.device.clock.advance(STEP_MS / 1000)
+    return voices.envelopes.index(voices.envelope), voices.steals > steals
+
+def run_check(saber):
+    '''
+    Runs the effects through the pool. Returns the failures as a list of strings.
+    '''
+    failures = []
+    voices = saber.voices
+    limit = voices.limit
+    if limit != saber.effect_voices:
+        failures.append(f'the pool uses {limit} voices, the profile asks for {saber.effect_voices}')
+
+    samples = [(saber.ignite, 1.0), (saber.extinguish, EXTINGUISH_VOLUME)]
+    samples += [(saber.clash, CLASH_VOLUME)] * (limit - 2)
+    for i, (sample, level) in enumerate(samples):
+        voice, stole = play(saber, sample, level)
+        if stole:
+            failures.append(f'effect {i + 1} stole voice {voice} with {limit - i} free')
+        elif voice != i:
+            failures.append(f'effect {i + 1} played on voice {voice}, expected the free voice {i}')
+
+    for i, expected in enumerate(expected_steals(limit)):
+        in_use = voices.in_use()
+        if in_use != limit:
+            failures.append(f'{in_use} of {limit} voices in use before steal {i + 1}, the sounds are too short')
+            break
+        voice, stole = play(saber, saber.clash, CLASH_VOLUME)
+        if not stole:
+            failures.append(f'clash {i + 1} past the limit played without stealing')
+        if voice != expected:
+            failures.append(f'clash {i + 1} past the limit stole voice {voice}, expected {expected}')
+
+    saber.device.clock.advance(END_SECONDS)
+    steals = voices.steals
+    voice, stole = play(saber, saber.clash, CLASH_VOLUME)
+    if stole or voices.steals != steals:
+        failures.append(f'the clash after the others ended stole voice {voice}')
+
+    if voices.steals != len(expected_steals(limit)):
+        failures.append(f'{voices.steals} steals, expected {len(expected_steals(limit))}')
+    if voices.peak != limit:
+        failures.append(f'peak of {voices.peak} voices in use, expected {limit}')
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--voices', type=int, default=hal.EFFECT_VOICE_COUNT,
+                        help='effect voices of the profile, at least 2')
+    parser.add_argument('--config', default=os.path.join(ROOT, "main", "config.json"))
+    parser.add_argument('--verbose', action='store_true', help="show the saber's own output")
+    args = parser.parse_args(argv)
+    if args.voices < 2:
+        parser.error('--voices must be at least 2 to steal a quieter voice')
+
+    with tempfile.TemporaryDirectory() as sd_root:
+        saber = bench.boot_saber(args.config, sd_root, args.verbose,
+                                 profile_overrides={"effect_voices": args.voices})
+        failures = run_check(saber)
+    voices = saber.voices
+    print(f'Voice stealing check, {voices.limit} effect voices')
+    print(f'  plays:  {voices.plays}')
+    print(f'  steals: {voices.steals}')
+    print(f'  peak:   {voices.peak} in use')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if not failures:
+        print('OK')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())